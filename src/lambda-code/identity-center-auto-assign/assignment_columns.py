@@ -0,0 +1,121 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+# pylint: disable=C0301
+# pylint: disable=W1202,W0703
+# pylint: disable=E0401
+###########################################################################
+# Compact assignment sets. Account, permission set and principal ids are #
+# interned to small integers and every assignment is packed into one    #
+# 64-bit key kept in a sorted array, about 8 bytes per assignment        #
+# instead of a tuple of three strings.                                   #
+###########################################################################
+from array import array
+from bisect import bisect_left
+from heapq import merge
+
+FIELD_BITS = 21
+FIELD_LIMIT = 1 << FIELD_BITS
+# Keys sorted as Python ints at a time; sorting them all at once would box every key.
+SORT_CHUNK_KEYS = 1 << 16
+
+
+class Interner:
+    """Map strings to consecutive integers"""
+
+    def __init__(self):
+        self.ids = {}
+
+    def intern(self, value):
+        """Return the integer of a string, assigning the next one if it is new"""
+        index = self.ids.setdefault(value, len(self.ids))
+        if index >= FIELD_LIMIT:
+            raise ValueError(f"More than {FIELD_LIMIT} distinct ids cannot be packed")
+        return index
+
+    def lookup(self, value):
+        """Return the integer of a string, or None if it was never interned"""
+        return self.ids.get(value)
+
+
+class AssignmentSet:
+    """Set of (account, permission set, principal) assignments packed into a sorted array"""
+
+    def __init__(self):
+        self.accounts = Interner()
+        self.permission_sets = Interner()
+        self.principals = Interner()
+        self.keys = array('Q')
+        self.frozen = True
+
+    def add(self, account_id, perm_set_arn, principal_id):
+        """Add one assignment"""
+        self.keys.append(
+            (self.accounts.intern(str(account_id)) << (2 * FIELD_BITS)) |
+            (self.permission_sets.intern(perm_set_arn) << FIELD_BITS) |
+            self.principals.intern(principal_id))
+        self.frozen = False
+
+    def freeze(self):
+        """Sort and deduplicate the packed keys, chunk by chunk, and merge the sorted chunks"""
+        if not self.frozen:
+            keys, self.keys = self.keys, None
+            runs = [array('Q', sorted(keys[start:start + SORT_CHUNK_KEYS]))
+                    for start in range(0, len(keys), SORT_CHUNK_KEYS)]
+            del keys
+            packed = array('Q')
+            previous = None
+            for key in merge(*runs):
+                if key != previous:
+                    packed.append(key)
+                    previous = key
+            self.keys = packed
+            self.frozen = True
+        return self
+
+    def _key(self, account_id, perm_set_arn, principal_id):
+        account = self.accounts.lookup(str(account_id))
+        perm_set = self.permission_sets.lookup(perm_set_arn)
+        principal = self.principals.lookup(principal_id)
+        if account is None or perm_set is None or principal is None:
+            return None
+        return (account << (2 * FIELD_BITS)) | (perm_set << FIELD_BITS) | principal
+
+    def assigned_principals(self, account_id, perm_set_arn, principal_ids):
+        """
+        Return the principal ids, of those given, that are assigned in the account
+        with the permission set. Their packed keys are sorted and merged with the
+        contiguous run of keys of that account and permission set.
+        """
+        self.freeze()
+        account = self.accounts.lookup(str(account_id))
+        perm_set = self.permission_sets.lookup(perm_set_arn)
+        if account is None or perm_set is None:
+            return set()
+        prefix = (account << (2 * FIELD_BITS)) | (perm_set << FIELD_BITS)
+        given = {}
+        for principal_id in principal_ids:
+            principal = self.principals.lookup(principal_id)
+            if principal is not None:
+                given[prefix | principal] = principal_id
+        position = bisect_left(self.keys, prefix)
+        end = bisect_left(self.keys, prefix + FIELD_LIMIT, position)
+        assigned = set()
+        for key in array('Q', sorted(given)):
+            while position < end and self.keys[position] < key:
+                position += 1
+            if position == end:
+                break
+            if self.keys[position] == key:
+                assigned.add(given[key])
+        return assigned
+
+    def contains(self, account_id, perm_set_arn, principal_id):
+        """Return True if the assignment is in the set"""
+        self.freeze()
+        key = self._key(account_id, perm_set_arn, principal_id)
+        if key is None:
+            return False
+        position = bisect_left(self.keys, key)
+        return position < len(self.keys) and self.keys[position] == key
+
+    def __len__(self):
+        return len(self.keys)
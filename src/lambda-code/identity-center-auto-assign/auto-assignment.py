@@ -5,11 +5,49 @@
 import os
 import json
 import logging
-from time import sleep
+from time import sleep, time
+from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor
 import boto3
 from botocore.exceptions import ClientError
+from checkpoint import (SAFETY_MARGIN_MS, DeadlineApproaching, deadline_reached, new_cursor,
+                        advance_cursor, save_checkpoint, load_checkpoint,
+                        delete_checkpoint, continue_in_pipeline,
+                        continue_by_self_invocation)
+from fanout import (partition, LambdaTransport, SnsTransport, SqsTransport,
+                    LocalTransport, S3ResultStore, MemoryResultStore,
+                    wait_for_shards, aggregate_shard_results)
+from rate_budget import DynamoDBRateBudget, attach_rate_budget
+from work_queue import (OperationQueue, is_operation_batch, process_operation_batch,
+                        THROTTLING_ERRORS)
+from operation_ledger import OperationLedger
+from lease_lock import LeaseLock, LeaseLost, serve_rerun, report_waiting_jobs
+from management_exclusion import get_management_permission_sets
+from handoff_manifest import read_manifest, change_scope
+from assignment_columns import AssignmentSet
+from inventory import InventoryBuilder, write_inventory
+from group_directory import GroupDirectory
+from org_index import (TAG_SELECTOR, UnresolvedSelector, get_org_index, uses_selectors,
+                       organization_changed, expand_target_mappings)
+from mapping_delta import (GLOBAL_TARGET, current_versions, read_version,
+                           load_applied_versions, save_applied_versions,
+                           full_run_due, changed_permission_sets, mapping_entries,
+                           diff_entries)
+from change_report import (ChangeReport, report_part, run_report_prefix,
+                           report_url, execution_details, bounded)
+from profiling import profiled
+from ready_signals import ReadySignals
+from plan_engine import (ApiCallCounter, ShadowRun, expected_assignments as planned_assignments,
+                         current_assignments, plan_assignments, publish_shadow_report)
+from api_cassette import ApiRecorder, default_session, recorded
 
 runtime_region = os.environ['Lambda_Region']
+# Every API call of an invocation is recorded to a cassette in S3 when set to true.
+# The hooks must be installed before the clients are created.
+api_recorder = None
+if os.environ.get('RecordApiTraffic', 'false').lower() == 'true':
+    api_recorder = ApiRecorder('auto-assignment', os.environ.get('ApiCassetteSalt'))
+    api_recorder.install(default_session())
 global_mapping_file_name = os.environ.get('GlobalFileName')
 identity_store_id = os.environ.get('IdentityStore_Id')
 identitystore_client = boto3.client(
@@ -18,152 +56,376 @@ orgs_client = boto3.client('organizations', region_name=runtime_region)
 pipeline = boto3.client('codepipeline', region_name=runtime_region)
 s3client = boto3.client('s3', region_name=runtime_region)
 ic_admin = boto3.client('sso-admin', region_name=runtime_region)
+lambda_client = boto3.client('lambda', region_name=runtime_region)
+sns_client = boto3.client('sns', region_name=runtime_region)
+sqs_client = boto3.client('sqs', region_name=runtime_region)
+dynamodb = boto3.client('dynamodb', region_name=runtime_region)
 ic_bucket_name = os.environ.get('IC_S3_BucketName')
 ic_instance_arn = os.environ.get('IC_InstanceArn')
 target_mapping_file_name = os.environ.get('TargetFileName')
 management_account_id = os.environ.get('Org_Management_Account')
+# auto-permissionsets.py refreshes this list at the start of every pipeline run.
+management_perm_sets_cache_seconds = int(os.environ.get('ManagementPermissionSetsCacheSeconds') or 3600)
 delegated = os.environ.get('AdminDelegated')
+sns_topic_name = os.environ.get('SNS_Topic_Name')
+# Accounts per worker invocation. 0 reconciles every account in this invocation.
+shard_size = int(os.environ.get('ShardSize', '0') or 0)
+fanout_transport = os.environ.get('FanOutTransport', 'lambda')
+shard_queue_url = os.environ.get('ShardQueueUrl')
+rate_budget_table_name = os.environ.get('RateBudgetTableName')
+rate_budget_per_second = int(os.environ.get('RateBudgetPerSecond', '20'))
+operation_queue_url = os.environ.get('OperationQueueUrl')
+run_lock_table_name = os.environ.get('RunLockTableName')
+group_directory_table_name = os.environ.get('GroupDirectoryTableName')
+# Directory events keep the table current; this only bounds missed ones.
+group_directory_max_age_seconds = int(os.environ.get('GroupDirectoryMaxAgeSeconds') or 86400)
+# Organizations events refresh the index; this only bounds changes made without one.
+org_index_cache_seconds = int(os.environ.get('OrgIndexCacheSeconds') or 3600)
+# Pipeline runs apply only the mapping file delta until a full run is this old. 0 always runs in full.
+full_reconciliation_interval_seconds = int(os.environ.get('FullReconciliationIntervalSeconds') or 86400)
+# Invocations run under cProfile and tracemalloc and report their hot spots to S3 when set to true.
+profiling_enabled = os.environ.get('ProfileInvocations', 'false').lower() == 'true'
+profile_top_n = int(os.environ.get('ProfileTopN') or 25)
+# Full reconciliations also compute the plan of the plan-only engine and compare it when set to true.
+shadow_plan_enabled = os.environ.get('ShadowPlanMode', 'false').lower() == 'true'
+# A ready signal consumer gives up if the permission set sync does not complete within this time.
+ready_wait_seconds = int(os.environ.get('ReadyWaitSeconds') or 3600)
+# The consumer polls for ready signals with exponential backoff between these intervals.
+READY_POLL_SECONDS = 1
+READY_POLL_MAX_SECONDS = 30
+# Lease kept for the continuation invocation of a run that hands off at the deadline.
+HANDOFF_LEASE_SECONDS = 900
+# Lock held by the current run; writes stop if another run has fenced it off.
+active_lock = None
+# Change report of the current invocation.
+change_report = None
+if fanout_transport == 'local':
+    shard_result_store = MemoryResultStore()
+else:
+    shard_result_store = S3ResultStore(s3client, ic_bucket_name)
+if rate_budget_table_name and shard_size > 0:
+    # Parallel shard workers share one call rate towards each service. Without
+    # sharding one invocation runs at a time and needs no shared budget.
+    attach_rate_budget(ic_admin, DynamoDBRateBudget(
+        dynamodb, rate_budget_table_name, 'sso-admin', rate_budget_per_second))
+    attach_rate_budget(identitystore_client, DynamoDBRateBudget(
+        dynamodb, rate_budget_table_name, 'identitystore', rate_budget_per_second))
+# Write operations are queued for the SQS consumer when a queue is configured.
+if operation_queue_url:
+    operation_queue = OperationQueue(sqs_client, operation_queue_url, 'auto-assignment')
+else:
+    operation_queue = None
+if group_directory_table_name:
+    group_directory = GroupDirectory(dynamodb, group_directory_table_name, identitystore_client,
+                                     identity_store_id, group_directory_max_age_seconds)
+else:
+    group_directory = None
+failed_operations_table_name = os.environ.get('FailedOperationsTableName')
+# Operations that fail inline are recorded here and replayed by the next run.
+if failed_operations_table_name:
+    operation_ledger = OperationLedger(dynamodb, failed_operations_table_name, 'auto-assignment')
+else:
+    operation_ledger = None
+OPERATION_EXECUTORS = {
+    'CreateAccountAssignment': ic_admin.create_account_assignment,
+    'DeleteAccountAssignment': ic_admin.delete_account_assignment
+}
+# Shadow plan of the current reconciliation, collecting the operations it submits.
+shadow_run = None
+api_call_counter = ApiCallCounter(ic_admin, identitystore_client) if shadow_plan_enabled else None
+# Threads listing the provisioned accounts of the permission sets concurrently.
+PROVISIONED_INDEX_WORKERS = int(os.environ.get('ProvisionedIndexWorkers', '8'))
+# Reconciliation phases in execution order, used by the resume cursor.
+ASSIGNMENT_PHASES = ['global', 'target', 'enumerate']
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
-def list_all_current_account_assignment(acct_list, current_aws_permission_sets,
-                                        pipeline_id):
-    """List all the current account assignments information"""
-    all_assignments = []
-    for each_perm_set_name in current_aws_permission_sets:
-        try:
-            for account in acct_list:
-                if account['Status'] != "SUSPENDED":
-                    response = ic_admin.list_account_assignments(
-                        InstanceArn=ic_instance_arn,
-                        AccountId=str(account['Id']),
-                        PermissionSetArn=current_aws_permission_sets[each_perm_set_name]['Arn'],
-                        MaxResults=100
-                    )
-                    account_assignment = response['AccountAssignments']
-                    while 'NextToken' in response:
-                        response = ic_admin.list_account_assignments(
-                            InstanceArn=ic_instance_arn,
-                            AccountId=str(account['Id']),
-                            PermissionSetArn=current_aws_permission_sets[each_perm_set_name]['Arn'],
-                            MaxResults=100,
-                            NextToken=response['NextToken']
-                        )
-                        account_assignment += response['AccountAssignments']
-                        logger.info("Account %s assigment: %s",
-                                    account['Id'], response['AccountAssignments'])
-                        sleep(0.1)  # Aviod hitting API limit.
-                    # Eliminate the empty assignment responses.
-                    if len(account_assignment) != 0:
-                        for each_assignment in account_assignment:
-                            ################################################################
-                            # This Env only allows 'GROUP' assignee rather than 'USER' #
-                            ################################################################
-                            if str(each_assignment['PrincipalType']) == "USER":
-                                delete_user_assignment = ic_admin.delete_account_assignment(
-                                    InstanceArn=ic_instance_arn,
-                                    TargetId=each_assignment['AccountId'],
-                                    TargetType='AWS_ACCOUNT',
-                                    PermissionSetArn=each_assignment['PermissionSetArn'],
-                                    PrincipalType=each_assignment['PrincipalType'],
-                                    PrincipalId=each_assignment['PrincipalId']
-                                )
-                                logger.info("PrincipalType 'USER' is not recommended in this solution,\
-                                    remove USER assignee:%s", delete_user_assignment)
-                            # After remove USER assignee, append all other GROUP assignee to the list.
-                            else:
-                                all_assignments.append(each_assignment)
-        except ic_admin.exceptions.ThrottlingException as error:
-            logger.warning(
-                "%s. Hit IAM Identity Center API limit. Sleep 3s...", error)
-            sleep(3)
-        except Exception as error:
-            logger.error("%s", error)
-            pipeline.put_job_failure_result(
-                jobId=pipeline_id,
-                failureDetails={'type': 'JobFailed', 'message': str(error)}
-            )
-    logger.info("Current GROUP assignments: %s", all_assignments)
-    return all_assignments
-
-def drift_detect_update(all_assignments, global_file_contents,
-                        target_file_contents, current_aws_permission_sets,
-                        pipeline_id):
-    """Use new mapping information to update IAM Identity Center assignments"""
-    check_list = all_assignments
-    remove_list = []
-    for each_assignment in check_list:
-        try:
-            logger.debug("list each global assignment:%s", each_assignment)
-            for global_mapping in global_file_contents:
-                for each_perm_set_name in global_mapping['PermissionSetName']:
-                    global_group_id = get_groupid(
-                        global_mapping['GlobalGroupName'])
-                    permission_set_arn = current_aws_permission_sets[each_perm_set_name]['Arn']
-                    # Remove matched assignment from list:
-                    if each_assignment['PrincipalId'] == global_group_id and each_assignment["PermissionSetArn"] == permission_set_arn:
-                        remove_list.append(each_assignment)
-        except ic_admin.exceptions.ThrottlingException as error:
-            logger.warning(
-                "%s. Hit IAM Identity Center API limit. Sleep 3s...", error)
-            sleep(3)
-        except Exception as error:
-            logger.error("%s", error)
-            pipeline.put_job_failure_result(
-                jobId=pipeline_id,
-                failureDetails={'type': 'JobFailed', 'message': str(error)}
+def record_change(kind, **details):
+    """Add an entry to the change report of the current invocation"""
+    if change_report is not None:
+        change_report.record(kind, **details)
+
+
+def operation_status(response):
+    """Status of an account assignment create or delete response, QUEUED or DEFERRED if it was not run"""
+    for key in ('AccountAssignmentCreationStatus', 'AccountAssignmentDeletionStatus'):
+        if key in response:
+            return response[key]['Status']
+    return 'DEFERRED' if 'Deferred' in response else 'QUEUED'
+
+
+def submit_operation(operation, **params):
+    """Queue an assignment operation for the consumer, or run it now without a queue"""
+    if active_lock is not None:
+        active_lock.check()
+    if shadow_run is not None:
+        shadow_run.record(operation, params)
+    if operation_queue is not None:
+        operation_queue.submit(operation, params, group=params.get('TargetId'))
+        return {'Queued': operation}
+    try:
+        return OPERATION_EXECUTORS[operation](**params)
+    except ClientError as error:
+        if operation_ledger is None:
+            raise
+        operation_ledger.record(operation, params, error)
+        if error.response['Error']['Code'] not in THROTTLING_ERRORS:
+            raise
+        # The next run replays it from the ledger; carry on with the other operations.
+        logger.warning("%s in %s deferred to the next run: %s",
+                       operation, params['TargetId'], error)
+        sleep(3)
+        return {'Deferred': operation}
+
+
+def replay_failed_operations(cursor, acct_list, manifest, pipeline_id):
+    """
+    Apply the assignment operations that failed in earlier runs and that the
+    current mapping files still call for; the others are resolved without
+    being applied. Returns the number of operations applied.
+    """
+    def on_applied(operation, params, response):
+        record_change('ReplayedOperation', Operation=operation, AccountId=params['TargetId'],
+                      PermissionSetArn=params['PermissionSetArn'],
+                      PrincipalId=params['PrincipalId'], Status=operation_status(response))
+
+    try:
+        if next(operation_ledger.pending(), None) is None:
+            return 0
+        global_file_contents = get_global_mapping_contents(
+            ic_bucket_name, global_mapping_file_name, pipeline_id)
+        target_file_contents = load_target_mappings(cursor, acct_list, pipeline_id)
+        global_expected, target_expected = expected_assignments(
+            global_file_contents, target_file_contents, load_permission_sets(manifest, pipeline_id))
+        active_account_ids = {str(account['Id']) for account in acct_list
+                              if account['Status'] != "SUSPENDED"}
+
+        def wanted(operation, params):
+            defined = params['PrincipalType'] == 'GROUP' and (
+                ((params['PrincipalId'], params['PermissionSetArn']) in global_expected and
+                 str(params['TargetId']) in active_account_ids) or
+                target_expected.contains(params['TargetId'], params['PermissionSetArn'],
+                                         params['PrincipalId']))
+            return defined if operation == 'CreateAccountAssignment' else not defined
+
+        return operation_ledger.replay(OPERATION_EXECUTORS, on_applied, wanted)
+    except ClientError as error:
+        logger.warning("Cannot replay the operation ledger: %s", error)
+        return 0
+
+
+def provisioned_accounts(perm_set_arn):
+    """Return the ids of the accounts a permission set is provisioned to, or None if they cannot be listed"""
+    params = {'InstanceArn': ic_instance_arn, 'PermissionSetArn': perm_set_arn}
+    try:
+        response = ic_admin.list_accounts_for_provisioned_permission_set(**params)
+        account_ids = set(response['AccountIds'])
+        while 'NextToken' in response:
+            response = ic_admin.list_accounts_for_provisioned_permission_set(
+                NextToken=response['NextToken'], **params)
+            account_ids.update(response['AccountIds'])
+    except ClientError as error:
+        logger.warning("Cannot list the accounts %s is provisioned to, scanning every account: %s",
+                       perm_set_arn, error)
+        return None
+    return account_ids
+
+
+def provisioned_account_index(perm_set_arns):
+    """
+    Map every permission set to the accounts it is provisioned to, listed
+    concurrently. A permission set only has assignments in those accounts.
+    """
+    with ThreadPoolExecutor(max_workers=PROVISIONED_INDEX_WORKERS) as executor:
+        index = dict(zip(perm_set_arns, executor.map(provisioned_accounts, perm_set_arns)))
+    logger.info("%s account and permission set pairs are provisioned",
+                sum(len(account_ids) for account_ids in index.values() if account_ids is not None))
+    return index
+
+
+def iter_account_assignments(acct_list, perm_set_arn, provisioned_account_ids=None):
+    """
+    Yield the account assignments of one permission set page by page,
+    only querying the accounts it is provisioned to when those are known.
+    """
+    for account in acct_list:
+        if account['Status'] == "SUSPENDED":
+            continue
+        if provisioned_account_ids is not None and str(account['Id']) not in provisioned_account_ids:
+            continue
+        params = {
+            'InstanceArn': ic_instance_arn,
+            'AccountId': str(account['Id']),
+            'PermissionSetArn': perm_set_arn,
+            'MaxResults': 100
+        }
+        response = ic_admin.list_account_assignments(**params)
+        yield from response['AccountAssignments']
+        while 'NextToken' in response:
+            sleep(0.1)  # Aviod hitting API limit.
+            response = ic_admin.list_account_assignments(
+                NextToken=response['NextToken'], **params)
+            yield from response['AccountAssignments']
+
+
+def remove_user_assignments(assignments):
+    """Delete USER assignments as they stream by and pass GROUP assignments on"""
+    for each_assignment in assignments:
+        ################################################################
+        # This Env only allows 'GROUP' assignee rather than 'USER' #
+        ################################################################
+        if str(each_assignment['PrincipalType']) == "USER":
+            delete_user_assignment = submit_operation(
+                'DeleteAccountAssignment',
+                InstanceArn=ic_instance_arn,
+                TargetId=each_assignment['AccountId'],
+                TargetType='AWS_ACCOUNT',
+                PermissionSetArn=each_assignment['PermissionSetArn'],
+                PrincipalType=each_assignment['PrincipalType'],
+                PrincipalId=each_assignment['PrincipalId']
             )
-    for each_assignment in check_list:
+            record_change('DeleteUserAssignment', AccountId=each_assignment['AccountId'],
+                          PermissionSetArn=each_assignment['PermissionSetArn'],
+                          PrincipalId=each_assignment['PrincipalId'],
+                          Status=operation_status(delete_user_assignment))
+        else:
+            yield each_assignment
+
+
+def expected_assignments(global_file_contents, target_file_contents,
+                         current_aws_permission_sets, group_names=None):
+    """
+    Build the assignments defined in the mapping files: (PrincipalId, PermissionSetArn)
+    pairs valid in every account and a compact AssignmentSet of target assignments.
+    group_names, if given, is filled with the name of every group id.
+    """
+    group_ids = {}
+
+    def group_id_of(group_name):
+        if group_name not in group_ids:
+            group_ids[group_name] = get_groupid(group_name)
+            if group_names is not None and group_ids[group_name]:
+                group_names[group_ids[group_name]] = group_name
+        return group_ids[group_name]
+
+    global_expected = set()
+    for global_mapping in global_file_contents:
+        global_group_id = group_id_of(global_mapping['GlobalGroupName'])
+        for each_perm_set_name in global_mapping['PermissionSetName']:
+            global_expected.add(
+                (global_group_id, current_aws_permission_sets[each_perm_set_name]['Arn']))
+    target_expected = AssignmentSet()
+    for target_mapping in target_file_contents:
+        target_group_id = group_id_of(target_mapping['TargetGroupName'])
+        if not target_group_id:
+            continue
+        for each_perm_set_name in target_mapping['PermissionSetName']:
+            permission_set_arn = current_aws_permission_sets[each_perm_set_name]['Arn']
+            for target_account_id in target_mapping['TargetAccountid']:
+                target_expected.add(target_account_id, permission_set_arn, target_group_id)
+    logger.info("Mapping files define %s global and %s target assignments",
+                len(global_expected), len(target_expected.freeze()))
+    return global_expected, target_expected
+
+
+def classify_drift(assignments, global_expected, target_expected, inventory=None):
+    """
+    Yield the streamed GROUP assignments that the mapping files do not define.
+    The defined ones are added to the inventory with the mapping that defines them.
+    The stream arrives one account and permission set at a time; each of these
+    groups is diffed against the target assignments in one sorted merge.
+    """
+    for (account_id, permission_set_arn), group in groupby(
+            assignments, key=lambda assignment: (assignment['AccountId'], assignment['PermissionSetArn'])):
+        group = list(group)
+        targeted = target_expected.assigned_principals(
+            account_id, permission_set_arn, [each_assignment['PrincipalId'] for each_assignment in group])
+        for each_assignment in group:
+            principal_id = each_assignment['PrincipalId']
+            if (principal_id, permission_set_arn) in global_expected:
+                source = 'Global'
+            elif principal_id in targeted:
+                source = 'Target'
+            else:
+                yield each_assignment
+                continue
+            if inventory is not None:
+                inventory.add(AccountId=account_id, PermissionSetArn=permission_set_arn,
+                              PrincipalType=each_assignment['PrincipalType'], PrincipalId=principal_id,
+                              Source=source)
+
+
+def remove_drift_assignments(drifted_assignments):
+    """Delete the assignments that are not defined in the mapping files. Returns the count."""
+    removed = 0
+    for delta_assignment in drifted_assignments:
+        delete_drift_assignment = submit_operation(
+            'DeleteAccountAssignment',
+            InstanceArn=ic_instance_arn,
+            TargetId=delta_assignment['AccountId'],
+            TargetType='AWS_ACCOUNT',
+            PermissionSetArn=delta_assignment['PermissionSetArn'],
+            PrincipalType='GROUP',
+            PrincipalId=delta_assignment['PrincipalId']
+        )
+        record_change('RemoveDrift', AccountId=delta_assignment['AccountId'],
+                      PermissionSetArn=delta_assignment['PermissionSetArn'],
+                      PrincipalId=delta_assignment['PrincipalId'],
+                      Status=operation_status(delete_drift_assignment))
+        removed += 1
+    return removed
+
+
+def reconcile_current_assignments(acct_list, enumerated_permission_sets,
+                                  global_file_contents, target_file_contents,
+                                  current_aws_permission_sets, pipeline_id,
+                                  context=None, start=0, inventory=None):
+    """
+    Stream the current assignments of every permission set through USER
+    cleanup and drift classification into the delete operations, so drift
+    is removed while enumeration continues and nothing is collected in memory
+    except the inventory of the assignments that stay.
+    """
+    global_expected, target_expected = expected_assignments(
+        global_file_contents, target_file_contents, current_aws_permission_sets,
+        inventory.group_names if inventory is not None else None)
+    if inventory is not None:
+        inventory.perm_set_names.update({perm_set['Arn']: name for name, perm_set
+                                         in current_aws_permission_sets.items()})
+    perm_set_names = sorted(enumerated_permission_sets)
+    provisioned_index = provisioned_account_index(
+        [enumerated_permission_sets[name]['Arn'] for name in perm_set_names[start:]])
+    removed = 0
+    for position in range(start, len(perm_set_names)):
+        each_perm_set_name = perm_set_names[position]
+        if deadline_reached(context):
+            raise DeadlineApproaching('enumerate', position)
+        perm_set_arn = enumerated_permission_sets[each_perm_set_name]['Arn']
         try:
-            for target_mapping in target_file_contents:
-                if each_assignment['AccountId'] in target_mapping['TargetAccountid']:
-                    for each_perm_set_name in target_mapping['PermissionSetName']:
-                        permission_set_arn = current_aws_permission_sets[each_perm_set_name]['Arn']
-                        target_group_id = get_groupid(
-                            target_mapping['TargetGroupName'])
-                    if each_assignment['PrincipalId'] == target_group_id and each_assignment['PermissionSetArn'] == permission_set_arn:
-                        remove_list.append(each_assignment)
+            assignments = iter_account_assignments(
+                acct_list, perm_set_arn, provisioned_index[perm_set_arn])
+            removed += remove_drift_assignments(classify_drift(
+                remove_user_assignments(assignments), global_expected, target_expected,
+                inventory))
         except ic_admin.exceptions.ThrottlingException as error:
             logger.warning(
                 "%s. Hit IAM Identity Center API limit. Sleep 3s...", error)
             sleep(3)
+        except LeaseLost:
+            raise
         except Exception as error:
             logger.error("%s", error)
             pipeline.put_job_failure_result(
                 jobId=pipeline_id,
                 failureDetails={'type': 'JobFailed', 'message': str(error)}
             )
-    for item in remove_list:
-        check_list.remove(item)
-    # Search drift by checking the element that remain in check_list.
-    if len(check_list) == 0:
+    if removed == 0:
         logger.info(
             "IAM Identity Center assignments has been applied. No drift was found within current assignments :)")
     else:
-        for delta_assignment in check_list:
-            try:
-                print(f"Assignment with drift: {delta_assignment}")
-                delete_user_assignment = ic_admin.delete_account_assignment(
-                    InstanceArn=ic_instance_arn,
-                    TargetId=delta_assignment['AccountId'],
-                    TargetType='AWS_ACCOUNT',
-                    PermissionSetArn=delta_assignment['PermissionSetArn'],
-                    PrincipalType='GROUP',
-                    PrincipalId=delta_assignment['PrincipalId']
-                )
-                logger.warning(
-                    "Warning. Drift has been detected and removing..%s", delete_user_assignment)
-            except ic_admin.exceptions.ThrottlingException as error:
-                logger.warning("%s. Hit API limits. Sleep 3s...", error)
-                sleep(3)
-            except Exception as error:
-                logger.error("%s", error)
-                pipeline.put_job_failure_result(
-                    jobId=pipeline_id,
-                    failureDetails={'type': 'JobFailed', 'message': str(error)}
-                )
+        logger.info("Removed %s assignments with drift", removed)
 
 
 def get_global_mapping_contents(bucketname, global_mapping_file, pipeline_id):
@@ -209,13 +471,174 @@ def get_target_mapping_contents(bucketname, target_mapping_file, pipeline_id):
     return json_object
 
 
+def load_target_mappings(cursor, acct_list, pipeline_id, refresh_index=True):
+    """Load the target mapping file and expand its OU and tag selectors to account ids"""
+    target_file_contents = get_target_mapping_contents(
+        ic_bucket_name, target_mapping_file_name, pipeline_id)
+    return expand_selectors(cursor, target_file_contents, acct_list, refresh_index)
+
+
+def expand_selectors(cursor, target_file_contents, acct_list, refresh_index=True):
+    """Expand the OU and tag selectors of target mappings to account ids"""
+    selectors = uses_selectors(target_file_contents)
+    if selectors:
+        org_index = get_org_index(
+            orgs_client, s3client, ic_bucket_name, org_index_cache_seconds,
+            include_tags=TAG_SELECTOR in selectors,
+            refresh=refresh_index and organization_changed(cursor.get('Entities', [])))
+        try:
+            return expand_target_mappings(target_file_contents, org_index, acct_list)
+        except UnresolvedSelector as error:
+            if not org_index.get('FromCache'):
+                raise
+            # The cache may predate the change; a selector the current organization
+            # cannot resolve either fails the run before any assignment is deleted.
+            logger.warning("%s Rebuilding the organization index.", error)
+        org_index = get_org_index(
+            orgs_client, s3client, ic_bucket_name, org_index_cache_seconds,
+            include_tags=TAG_SELECTOR in selectors, refresh=True)
+        target_file_contents = expand_target_mappings(target_file_contents, org_index, acct_list)
+    return target_file_contents
+
+
+def mapping_delta_allowed(cursor, account_ids):
+    """Return True if this run may apply a mapping file delta at all"""
+    return not (account_ids is not None or not cursor.get('PipelineId') or cursor.get('Entities') or
+                cursor.get('Rerun') or cursor['Invocation'] != 1 or cursor['Phase'] != ASSIGNMENT_PHASES[0] or
+                not cursor.get('MappingVersions') or full_reconciliation_interval_seconds <= 0)
+
+
+def mapping_delta_base(cursor, account_ids):
+    """
+    Return the record of the mapping versions applied last if this run can
+    apply only the delta against them, or None if it must run in full.
+    """
+    if not mapping_delta_allowed(cursor, account_ids):
+        return None
+    applied = load_applied_versions(s3client, ic_bucket_name)
+    if full_run_due(applied, full_reconciliation_interval_seconds):
+        logger.info("A full reconciliation is due.")
+        return None
+    if set(applied.get('Versions', {})) != set(cursor['MappingVersions']):
+        return None
+    return applied
+
+
+def read_mapping_versions(cursor, versions, acct_list):
+    """Read the given versions of both mapping files, with the target selectors expanded"""
+    global_contents = read_version(s3client, ic_bucket_name, global_mapping_file_name,
+                                   versions[global_mapping_file_name])
+    target_contents = expand_selectors(cursor, read_version(
+        s3client, ic_bucket_name, target_mapping_file_name,
+        versions[target_mapping_file_name]), acct_list)
+    return global_contents, target_contents
+
+
+def create_entry_assignments(entries, acct_list, current_aws_permission_sets, context, mapping):
+    """Create the assignments of (group name, permission set name, target) mapping entries"""
+    active_account_ids = [str(account['Id']) for account in acct_list
+                          if account['Status'] != "SUSPENDED"]
+    for group_name, perm_set_name, target in entries:
+        if deadline_reached(context):
+            # The continuation reconciles in full from the start.
+            raise DeadlineApproaching(ASSIGNMENT_PHASES[0], 0)
+        group_id = get_groupid(group_name)
+        if not group_id or perm_set_name not in current_aws_permission_sets:
+            logger.error("Cannot assign permission set %s to group %s", perm_set_name, group_name)
+            continue
+        permission_set_arn = current_aws_permission_sets[perm_set_name]['Arn']
+        for account_id in (active_account_ids if target == GLOBAL_TARGET else [target]):
+            assignment_response = submit_operation(
+                'CreateAccountAssignment',
+                InstanceArn=ic_instance_arn,
+                TargetId=account_id,
+                TargetType='AWS_ACCOUNT',
+                PrincipalType='GROUP',
+                PermissionSetArn=permission_set_arn,
+                PrincipalId=group_id
+            )
+            record_change('CreateAssignment', Mapping=mapping, AccountId=account_id,
+                          PermissionSetArn=permission_set_arn, PrincipalId=group_id,
+                          Status=operation_status(assignment_response))
+
+
+def apply_mapping_delta(cursor, applied, acct_list, current_aws_permission_sets, context):
+    """Create and delete only the assignments of the mapping entries added or removed since the applied versions"""
+    global_file_contents, target_file_contents = read_mapping_versions(
+        cursor, cursor['MappingVersions'], acct_list)
+    added, removed = diff_entries(
+        mapping_entries(*read_mapping_versions(cursor, applied['Versions'], acct_list)),
+        mapping_entries(global_file_contents, target_file_contents))
+    logger.info("Applying the mapping file delta: %s entries added, %s removed",
+                len(added), len(removed))
+    ready_applied = set(cursor.get('ReadyApplied', []))
+    create_entry_assignments([entry for entry in added if entry[1] not in ready_applied],
+                             acct_list, current_aws_permission_sets, context, 'Delta')
+    if not removed:
+        return
+    active_account_ids = [str(account['Id']) for account in acct_list
+                          if account['Status'] != "SUSPENDED"]
+    global_expected, target_expected = expected_assignments(
+        global_file_contents, target_file_contents, current_aws_permission_sets)
+    for group_name, perm_set_name, target in removed:
+        if deadline_reached(context):
+            raise DeadlineApproaching(ASSIGNMENT_PHASES[0], 0)
+        group_id = get_groupid(group_name)
+        if not group_id or perm_set_name not in current_aws_permission_sets:
+            # Deleted groups and permission sets take their assignments with them.
+            continue
+        permission_set_arn = current_aws_permission_sets[perm_set_name]['Arn']
+        if target == GLOBAL_TARGET:
+            account_ids = provisioned_accounts(permission_set_arn)
+            account_ids = active_account_ids if account_ids is None else sorted(
+                account_ids.intersection(active_account_ids))
+        else:
+            account_ids = [target]
+        for account_id in account_ids:
+            if ((group_id, permission_set_arn) in global_expected or
+                    target_expected.contains(account_id, permission_set_arn, group_id)):
+                continue
+            try:
+                delete_response = submit_operation(
+                    'DeleteAccountAssignment',
+                    InstanceArn=ic_instance_arn,
+                    TargetId=account_id,
+                    TargetType='AWS_ACCOUNT',
+                    PermissionSetArn=permission_set_arn,
+                    PrincipalType='GROUP',
+                    PrincipalId=group_id
+                )
+            except ClientError as error:
+                if error.response['Error']['Code'] == 'ResourceNotFoundException':
+                    continue
+                raise
+            record_change('DeleteAssignment', Mapping='Delta', AccountId=account_id,
+                          PermissionSetArn=permission_set_arn, PrincipalId=group_id,
+                          Status=operation_status(delete_response))
+
+
+def record_applied_mappings(cursor):
+    """Remember the mapping versions a pipeline run applied, for the delta of the next run"""
+    if not cursor.get('MappingVersions') or not cursor.get('PipelineId') or cursor.get('Entities'):
+        return
+    full_run_at = cursor.get('MappingDelta', {}).get('FullRunAt')
+    try:
+        save_applied_versions(s3client, ic_bucket_name, cursor['MappingVersions'], full_run_at,
+                              cursor.get('PermissionSetArns'))
+    except ClientError as error:
+        logger.warning("Cannot record the applied mapping versions: %s", error)
+
+
 def global_group_array_mapping(acct_list, global_file_contents,
                                current_aws_permission_sets,
-                               pipeline_id):
+                               pipeline_id, context=None, start=0):
     """Create global group mapping assignments"""
     logger.info("Starting global group assignement")
     if global_file_contents:
-        for account in acct_list:
+        for position in range(start, len(acct_list)):
+            account = acct_list[position]
+            if deadline_reached(context):
+                raise DeadlineApproaching('global', position)
             if account['Status'] != "SUSPENDED":
                 for mapping in global_file_contents:
                     if mapping['TargetAccountid'].upper() == "GLOBAL":
@@ -228,7 +651,8 @@ def global_group_array_mapping(acct_list, global_file_contents,
                                     logger.error(
                                         "Cannot assign permission set:%s.", mapping['GlobalGroupName'])
                                 else:
-                                    assignment_response = ic_admin.create_account_assignment(
+                                    assignment_response = submit_operation(
+                                        'CreateAccountAssignment',
                                         InstanceArn=ic_instance_arn,
                                         TargetId=str(account['Id']),
                                         TargetType='AWS_ACCOUNT',
@@ -237,9 +661,11 @@ def global_group_array_mapping(acct_list, global_file_contents,
                                         PrincipalId=group_id
                                     )
                                     sleep(0.1)  # Aviod hitting API limit.
-                                    logger.info("Performed global IAM Identity Center group assigment on \
-                                                account: %s. Response:%s", account['Id'],
-                                                assignment_response)
+                                    record_change('CreateAssignment', Mapping='Global',
+                                                  AccountId=str(account['Id']),
+                                                  PermissionSetArn=permission_set_arn,
+                                                  PrincipalId=group_id,
+                                                  Status=operation_status(assignment_response))
                         except ic_admin.exceptions.ThrottlingException as error:
                             logger.warning(
                                 "%s. Hit IAM Identity Center API limit. Sleep 3s...", error)
@@ -265,12 +691,16 @@ def global_group_array_mapping(acct_list, global_file_contents,
             "No global mapping information is loaded in existing files.")
 
 def target_group_array_mapping(target_file_contents,
-                               current_aws_permission_sets, pipeline_id):
+                               current_aws_permission_sets, pipeline_id,
+                               context=None, start=0):
     """Create target group mapping assignments"""
     logger.info("Starting target group assignement")
     if target_file_contents:
         try:
-            for mapping in target_file_contents:
+            for position in range(start, len(target_file_contents)):
+                mapping = target_file_contents[position]
+                if deadline_reached(context):
+                    raise DeadlineApproaching('target', position)
                 for each_perm_set_name in mapping['PermissionSetName']:
                     for target_account_id in mapping['TargetAccountid']:
                         permission_set_arn = current_aws_permission_sets[each_perm_set_name]['Arn']
@@ -279,7 +709,8 @@ def target_group_array_mapping(target_file_contents,
                             logger.error("Cannot assign permission set to \
                                          group %s", mapping['TargetGroupName'])
                         else:
-                            assignment_response = ic_admin.create_account_assignment(
+                            assignment_response = submit_operation(
+                                'CreateAccountAssignment',
                                 InstanceArn=ic_instance_arn,
                                 TargetId=str(target_account_id),
                                 TargetType='AWS_ACCOUNT',
@@ -288,8 +719,11 @@ def target_group_array_mapping(target_file_contents,
                                 PrincipalId=group_id
                             )
                             sleep(0.1)  # Aviod hitting API limit.
-                            logger.info("Performed target IAM Identity Center group assigment on account %s.\
-                                        Response: %s.", target_account_id, assignment_response)
+                            record_change('CreateAssignment', Mapping='Target',
+                                          AccountId=str(target_account_id),
+                                          PermissionSetArn=permission_set_arn,
+                                          PrincipalId=group_id,
+                                          Status=operation_status(assignment_response))
         except ic_admin.exceptions.ThrottlingException as error:
             logger.warning(
                 "%s. Hit IAM Identity Center API limit. Sleep 3s...", error)
@@ -369,7 +803,8 @@ def get_all_permission_sets(pipeline_id):
             jobId=pipeline_id,
             failureDetails={'type': 'JobFailed', 'message': str(error)}
         )
-    print(f"Skipped Permission Set Name and ARN: {skipped_perm_set}")
+    for perm_set_arn, perm_set_name in skipped_perm_set.items():
+        record_change('SkippedPermissionSet', PermissionSetArn=perm_set_arn, Name=perm_set_name)
     return permission_set_name_and_arn
 
 
@@ -390,6 +825,9 @@ def get_all_permission_sets_if_delegate(pipeline_id):
             )
             ic_permission_sets += response['PermissionSets']
 
+        management_perm_sets = get_management_permission_sets(
+            ic_admin, s3client, ic_bucket_name, ic_instance_arn,
+            management_account_id, management_perm_sets_cache_seconds)
         skipped_perm_set = {}
         for perm_set_arn in ic_permission_sets:
             describe_perm_set = ic_admin.describe_permission_set(
@@ -399,24 +837,7 @@ def get_all_permission_sets_if_delegate(pipeline_id):
             sleep(0.1)  # Aviod hitting API limit.
             perm_set_name = describe_perm_set['PermissionSet']['Name']
             perm_set_arn = describe_perm_set['PermissionSet']['PermissionSetArn']
-            list_accounts_for_provisioned_perm_set = ic_admin.list_accounts_for_provisioned_permission_set(
-                InstanceArn=ic_instance_arn,
-                PermissionSetArn=perm_set_arn,
-                MaxResults=100,
-            )
-            accounts_for_perm_set = list_accounts_for_provisioned_perm_set['AccountIds']
-            sleep(0.1)  # Aviod hitting API limit.
-            while 'NextToken' in list_accounts_for_provisioned_perm_set:
-                list_accounts_for_provisioned_perm_set = ic_admin.list_accounts_for_provisioned_permission_set(
-                    PermissionSetArn=perm_set_arn,
-                    MaxResults=100,
-                    NextToken=list_accounts_for_provisioned_perm_set['NextToken']
-                )
-                sleep(0.1)  # Aviod hitting API limit.
-                accounts_for_perm_set += list_accounts_for_provisioned_perm_set['AccountIds']
-            print(
-                f"Accounts for permission set {perm_set_arn} is {accounts_for_perm_set}")
-            if management_account_id in accounts_for_perm_set:
+            if perm_set_arn in management_perm_sets:
                 skipped_perm_set.update({perm_set_arn: perm_set_name})
                 continue
             permission_set_name_and_arn[perm_set_name] = {'Arn': perm_set_arn}
@@ -432,13 +853,20 @@ def get_all_permission_sets_if_delegate(pipeline_id):
             jobId=pipeline_id,
             failureDetails={'type': 'JobFailed', 'message': str(error)}
         )
-    print(f"Skipped Permission Set Name and ARN: {skipped_perm_set}")
+    for perm_set_arn, perm_set_name in skipped_perm_set.items():
+        record_change('SkippedPermissionSet', PermissionSetArn=perm_set_arn, Name=perm_set_name)
     return permission_set_name_and_arn
 
 
 def get_groupid(group_display_name):
     """Get the all the IAM Identity Center group names and ids"""
+    group_id = None
     try:
+        if group_directory is not None:
+            group_id = group_directory.group_id(group_display_name)
+            if group_id is None:
+                logger.error("%s does not exist.", group_display_name)
+            return group_id
         response = identitystore_client.list_groups(
             IdentityStoreId=identity_store_id,
             Filters=[
@@ -491,70 +919,619 @@ def get_org_accounts_if_delegate():
         org_accts = None
 
     org_accts = [acct for acct in org_accts if acct['Id'] != management_account_id]
-    print(org_accts)
     return org_accts
 
 
 
+def get_fanout_transport(context):
+    """Build the transport that delivers shard payloads to worker invocations"""
+    if fanout_transport == 'sns':
+        accountid = context.invoked_function_arn.split(':')[4]
+        return SnsTransport(sns_client, 'arn:aws:sns:' + runtime_region + ':' +
+                            str(accountid) + ':' + sns_topic_name)
+    if fanout_transport == 'sqs':
+        return SqsTransport(sqs_client, shard_queue_url)
+    if fanout_transport == 'local':
+        return LocalTransport(lambda payload: run_in_process(payload, context))
+    return LambdaTransport(lambda_client, context.function_name)
+
+
+def reset_run_state():
+    """Clear the state an earlier run left in the module globals, as in a warm container"""
+    global change_report, shadow_run, active_lock
+    change_report = shadow_run = active_lock = None
+    if operation_queue is not None:
+        operation_queue.start_run()
+
+
+def run_in_process(payload, context):
+    """
+    Invoke the handler in this process, as the local transport does for shard
+    workers, and restore the run state of the calling invocation afterwards.
+    """
+    global change_report, shadow_run
+    saved = change_report, shadow_run
+    queue_state = operation_queue.run_state() if operation_queue is not None else None
+    change_report = shadow_run = None
+    try:
+        return lambda_handler(payload, context)
+    finally:
+        change_report, shadow_run = saved
+        if queue_state is not None:
+            operation_queue.resume_run(queue_state)
+
+
+def coordinate_shards(cursor, acct_list, context):
+    """Fan the account list out to worker invocations and aggregate their results"""
+    if cursor['Phase'] != 'aggregate':
+        active_account_ids = [str(account['Id']) for account in acct_list
+                              if account['Status'] != "SUSPENDED"]
+        shards = partition(active_account_ids, shard_size)
+        transport = get_fanout_transport(context)
+        for shard_id, account_ids in enumerate(shards):
+            transport.dispatch({'ShardWorker': {
+                'RunId': cursor['RunId'],
+                'ShardId': shard_id,
+                'AccountIds': account_ids,
+                'Manifest': cursor.get('Manifest'),
+                'Entities': cursor.get('Entities', [])
+            }})
+        logger.info("Dispatched %s accounts to %s shards through %s",
+                    len(active_account_ids), len(shards), fanout_transport)
+        cursor['Phase'] = 'aggregate'
+        cursor['Pending'] = {'ShardCount': len(shards), 'Results': {}}
+    shard_count = cursor['Pending']['ShardCount']
+    results = wait_for_shards(shard_result_store, cursor['RunId'], shard_count,
+                              cursor['Pending']['Results'],
+                              should_stop=lambda: deadline_reached(context))
+    if len(results) < shard_count:
+        raise DeadlineApproaching('aggregate', 0, {'ShardCount': shard_count,
+                                                   'Results': results})
+    summary = aggregate_shard_results(results)
+    logger.info("Shard results: %s", summary)
+    if change_report is not None:
+        for result in results.values():
+            change_report.merge_counts(result.get('Changes', {}))
+    if summary['Failed']:
+        raise Exception(f"{len(summary['Failed'])} of {summary['Shards']} shards failed: {summary['Failed']}")
+
+
+def narrow_mappings(mapping_contents, perm_set_names):
+    """Keep only the mappings, and the permission sets within them, named in perm_set_names"""
+    narrowed = []
+    for mapping in mapping_contents:
+        names = [name for name in mapping['PermissionSetName'] if name in perm_set_names]
+        if names:
+            narrowed.append(dict(mapping, PermissionSetName=names))
+    return narrowed
+
+
+def start_shadow_plan(acct_list, global_file_contents, target_file_contents,
+                      enumerated_permission_sets, current_aws_permission_sets):
+    """Compute the read-only plan of the plan engine before the current code path runs"""
+    global shadow_run
+    perm_set_arns = {name: perm_set['Arn'] for name, perm_set in current_aws_permission_sets.items()}
+    enumerated_arns = sorted(perm_set['Arn'] for perm_set in enumerated_permission_sets.values())
+
+    def compute():
+        expected = planned_assignments(acct_list, global_file_contents, target_file_contents,
+                                       perm_set_arns, get_groupid)
+        current = current_assignments(ic_admin, ic_instance_arn, acct_list, enumerated_arns,
+                                      PROVISIONED_INDEX_WORKERS)
+        return plan_assignments(expected, current, set(enumerated_arns)), current
+
+    run = ShadowRun(api_call_counter)
+    try:
+        run.plan(compute)
+    except ClientError as error:
+        logger.warning("Cannot compute the shadow plan: %s", error)
+        return
+    shadow_run = run
+
+
+def finish_shadow_plan(cursor):
+    """Compare the shadow plan with the operations the current code path submitted"""
+    global shadow_run
+    run, shadow_run = shadow_run, None
+    if run is not None:
+        publish_shadow_report(s3client, ic_bucket_name, cursor['RunId'], run.finish(), 'auto-assignment')
+
+
+def load_permission_sets(manifest, pipeline_id):
+    """Return the current permission sets by name, from the handoff manifest if there is one"""
+    if manifest is not None:
+        current_aws_permission_sets = {name: {'Arn': arn} for name, arn
+                                       in manifest['PermissionSets'].items()}
+        print("INFO: Using the permission sets of the handoff manifest.")
+    elif delegated == "true":
+        current_aws_permission_sets = get_all_permission_sets_if_delegate(
+            pipeline_id)
+        print("INFO: Admin delegated. Running in delegated admin account.")
+    else:
+        current_aws_permission_sets = get_all_permission_sets(pipeline_id)
+        print("INFO: Admin NOT delegated. Running in Management account.")
+    if not current_aws_permission_sets:
+        logger.error(
+            "Cannot load existing Permission Sets from AWS IAM Identity Center!")
+        pipeline.put_job_failure_result(
+            jobId=pipeline_id,
+            failureDetails={
+                'type': 'JobFailed',
+                'message': "No Permission Set information!"
+            })
+        quit()
+    else:
+        logger.info("The current permision sets in this account: %s",
+                    bounded(sorted(current_aws_permission_sets)))
+    return current_aws_permission_sets
+
+
+def reconcile_assignments(cursor, pipeline_id, context, account_ids=None):
+    """
+    Apply the mapping files and remove drift, starting from the cursor phase.
+    account_ids limits the run to the accounts of one shard.
+    """
+    global shadow_run
+    shadow_run = None
+
+    def start_of(phase):
+        return cursor['Position'] if cursor['Phase'] == phase else 0
+
+    manifest = None
+    if cursor.get('Manifest'):
+        # Reuse what the permission set function listed instead of enumerating it again.
+        manifest = read_manifest(s3client, ic_bucket_name, cursor['Manifest'])
+    ready_plan = None
+    if cursor.get('ReadySignals') and 'ReadyApplied' not in cursor:
+        signals = ReadySignals(s3client, ic_bucket_name, cursor['ReadySignals'])
+        cursor['ReadyApplied'] = sorted(signals.applied())
+        ready_plan = signals.plan()
+    # Prepare account id.
+    if manifest is not None:
+        acct_list = manifest['Accounts']
+        if delegated == 'true':
+            acct_list = [acct for acct in acct_list if acct['Id'] != management_account_id]
+    elif delegated == 'true':
+        acct_list = get_org_accounts_if_delegate()
+    else:
+        acct_list = get_org_accounts()
+    logger.info("Loaded %s accounts", len(acct_list))
+    replayed = 0
+    if operation_ledger is not None and account_ids is None and cursor['Invocation'] == 1:
+        # Replayed before the mapping files are applied, against the same desired state.
+        replayed = replay_failed_operations(cursor, acct_list, manifest, pipeline_id)
+    if ready_plan is not None:
+        # The same mapping versions and delta base the ready signal consumer created from.
+        cursor['MappingVersions'] = ready_plan['MappingVersions']
+    if account_ids is None and 'MappingVersions' not in cursor:
+        cursor['MappingVersions'] = current_versions(
+            s3client, ic_bucket_name, [global_mapping_file_name, target_mapping_file_name])
+    if ready_plan is not None:
+        delta_base = ready_plan['DeltaBase'] if mapping_delta_allowed(cursor, account_ids) else None
+    else:
+        delta_base = mapping_delta_base(cursor, account_ids)
+    current_aws_permission_sets = None
+    if delta_base is not None:
+        current_aws_permission_sets = load_permission_sets(manifest, pipeline_id)
+        recreated = changed_permission_sets(delta_base, current_aws_permission_sets)
+        if replayed or recreated:
+            # The delta has no entries for these; only the drift pass checks replayed
+            # operations, and unchanged entries of a recreated permission set are not applied.
+            logger.info("Reconciling in full: %s operations replayed, permission sets created "
+                        "or recreated: %s", replayed, bounded(recreated))
+            delta_base = None
+    if delta_base is None and ready_plan is not None and ready_plan['DeltaBase'] is not None:
+        # The ready signal consumer only created the delta of the permission sets it applied.
+        cursor['ReadyApplied'] = []
+    if account_ids is None and cursor['Phase'] != 'aggregate':
+        if current_aws_permission_sets is None:
+            current_aws_permission_sets = load_permission_sets(manifest, pipeline_id)
+        # Recorded with the applied mapping versions for the next delta run.
+        cursor['PermissionSetArns'] = {name: perm_set['Arn'] for name, perm_set
+                                       in current_aws_permission_sets.items()}
+    if account_ids is not None:
+        shard_accounts = set(account_ids)
+        acct_list = [account for account in acct_list
+                     if str(account['Id']) in shard_accounts]
+    elif delta_base is None and (cursor['Phase'] == 'aggregate' or 0 < shard_size < len(acct_list)):
+        if cursor['Phase'] != 'aggregate':
+            # Build or refresh the organization index once for every shard worker.
+            load_target_mappings(cursor, acct_list, pipeline_id)
+        coordinate_shards(cursor, acct_list, context)
+        return
+    phase_index = ASSIGNMENT_PHASES.index(cursor['Phase'])
+    if group_directory is not None:
+        group_directory.load()
+    # Check if Source files exist.
+    global_file_contents = get_global_mapping_contents(
+        ic_bucket_name, global_mapping_file_name, pipeline_id)
+    target_file_contents = load_target_mappings(
+        cursor, acct_list, pipeline_id, refresh_index=account_ids is None)
+    logger.info("Loading mapping information from the files in s3...")
+    if account_ids is not None:
+        target_file_contents = [
+            dict(mapping, TargetAccountid=[target for target in mapping['TargetAccountid']
+                                           if str(target) in shard_accounts])
+            for mapping in target_file_contents]
+    # Get current account's permission set info.
+    if current_aws_permission_sets is None:
+        current_aws_permission_sets = load_permission_sets(manifest, pipeline_id)
+    if delta_base is not None:
+        apply_mapping_delta(cursor, delta_base, acct_list, current_aws_permission_sets, context)
+        cursor['MappingDelta'] = {'FullRunAt': delta_base['FullRunAt']}
+        return
+    enumerated_permission_sets = current_aws_permission_sets
+    scope = change_scope(manifest, cursor.get('Entities', [])) if manifest is not None else None
+    if scope is not None:
+        # The events only touched these permission sets; leave the others alone.
+        in_scope = {name for name, perm_set in current_aws_permission_sets.items()
+                    if perm_set['Arn'] in scope}
+        logger.info("Reconciling only the changed permission sets: %s", bounded(sorted(in_scope)))
+        global_file_contents = narrow_mappings(global_file_contents, in_scope)
+        target_file_contents = narrow_mappings(target_file_contents, in_scope)
+        enumerated_permission_sets = {name: current_aws_permission_sets[name]
+                                      for name in in_scope}
+    if shadow_plan_enabled and phase_index == 0 and start_of('global') == 0:
+        # Only a reconciliation that starts and ends in this invocation is compared.
+        start_shadow_plan(acct_list, global_file_contents, target_file_contents,
+                          enumerated_permission_sets, current_aws_permission_sets)
+    create_global_contents, create_target_contents = global_file_contents, target_file_contents
+    if cursor.get('ReadyApplied'):
+        # The ready signal consumer already created the assignments of these permission sets.
+        pending = set(current_aws_permission_sets) - set(cursor['ReadyApplied'])
+        create_global_contents = narrow_mappings(global_file_contents, pending)
+        create_target_contents = narrow_mappings(target_file_contents, pending)
+    # Use S3 mapping files(sycned from source) as the only source of truth.
+    if phase_index <= ASSIGNMENT_PHASES.index('global'):
+        global_group_array_mapping(
+            acct_list, create_global_contents, current_aws_permission_sets,
+            pipeline_id, context, start_of('global'))
+    if phase_index <= ASSIGNMENT_PHASES.index('target'):
+        target_group_array_mapping(
+            create_target_contents, current_aws_permission_sets, pipeline_id,
+            context, start_of('target'))
+    if phase_index <= ASSIGNMENT_PHASES.index('enumerate'):
+        # Only a pass over every permission set leaves a complete inventory.
+        inventory = InventoryBuilder() if scope is None else None
+        try:
+            reconcile_current_assignments(
+                acct_list, enumerated_permission_sets, global_file_contents,
+                target_file_contents, current_aws_permission_sets, pipeline_id,
+                context, start_of('enumerate'), inventory)
+        finally:
+            if inventory is not None:
+                write_inventory_part(cursor, inventory)
+    finish_shadow_plan(cursor)
+
+
+def ready_create_entries(cursor, acct_list, signals):
+    """
+    The mapping entries the pass after the permission set sync will create:
+    the added ones if it applies the mapping file delta, otherwise all of them.
+    The versions and delta base are recorded with the signals on the first
+    invocation, so continuations and the pass after the sync use the same ones.
+    """
+    plan = signals.plan()
+    if plan is None:
+        cursor['MappingVersions'] = current_versions(
+            s3client, ic_bucket_name, [global_mapping_file_name, target_mapping_file_name])
+        plan = {'MappingVersions': cursor['MappingVersions'],
+                'DeltaBase': mapping_delta_base(cursor, None)}
+        signals.save_plan(plan)
+    cursor['MappingVersions'] = plan['MappingVersions']
+    if cursor['MappingVersions'] is None:
+        return mapping_entries(
+            get_global_mapping_contents(ic_bucket_name, global_mapping_file_name, ''),
+            load_target_mappings(cursor, acct_list, '', refresh_index=False))
+    entries = mapping_entries(*read_mapping_versions(cursor, cursor['MappingVersions'], acct_list))
+    applied = plan['DeltaBase']
+    if applied is None:
+        return entries
+    return entries - mapping_entries(*read_mapping_versions(cursor, applied['Versions'], acct_list))
+
+
+def ready_poll_wait(poll_seconds, message, context):
+    """Seconds to wait for the next ready signal, bounded by the deadline and the wait limit"""
+    wait = min(poll_seconds, max(message['Since'] + ready_wait_seconds - time(), 0))
+    if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+        wait = min(wait, max(context.get_remaining_time_in_millis() - SAFETY_MARGIN_MS, 0) / 1000)
+    return wait
+
+
+def run_ready_consumer(message, context):
+    """
+    Create the assignments of each permission set as soon as the permission
+    set function signals it ready, until it signals the sync complete. Only
+    creates; the pass after the sync reconciles in full and skips the
+    permission sets marked applied here.
+    """
+    global change_report
+    signals = ReadySignals(s3client, ic_bucket_name, message['ConsumeReadySignals'])
+    cursor = new_cursor('auto-assignment-ready', message.get('ForPipelineId', ''), ASSIGNMENT_PHASES[0])
+    change_report = ChangeReport('auto-assignment', cursor['RunId'], report_part(cursor))
+    if operation_queue is not None:
+        operation_queue.start_run()
+    try:
+        acct_list = get_org_accounts_if_delegate() if delegated == 'true' else get_org_accounts()
+        if group_directory is not None:
+            group_directory.load()
+        entries = ready_create_entries(cursor, acct_list, signals)
+        applied = signals.applied()
+        poll_seconds = READY_POLL_SECONDS
+        while True:
+            complete = signals.is_complete()
+            for perm_set_name, perm_set_arn in sorted(signals.ready().items()):
+                if perm_set_name in applied:
+                    continue
+                if deadline_reached(context):
+                    break
+                create_entry_assignments(
+                    sorted(entry for entry in entries if entry[1] == perm_set_name),
+                    acct_list, {perm_set_name: {'Arn': perm_set_arn}}, None, 'Ready')
+                if operation_queue is not None:
+                    operation_queue.flush()
+                signals.mark_applied(perm_set_name)
+                applied.add(perm_set_name)
+                poll_seconds = READY_POLL_SECONDS
+            if complete:
+                logger.info("The permission set sync is complete; %s permission sets were applied early",
+                            len(applied))
+                return
+            if time() - message['Since'] > ready_wait_seconds:
+                logger.warning("The permission set sync did not complete within %ss, stopping.",
+                               ready_wait_seconds)
+                return
+            if deadline_reached(context):
+                lambda_client.invoke(FunctionName=context.function_name,
+                                     InvocationType='Event', Payload=json.dumps(message))
+                return
+            sleep(ready_poll_wait(poll_seconds, message, context))
+            poll_seconds = min(poll_seconds * 2, READY_POLL_MAX_SECONDS)
+    finally:
+        logger.info("Assignment changes in this invocation: %s", change_report.summary())
+        finish_change_report()
+
+
+def clear_ready_signals(cursor):
+    """Delete the ready signals the pass after a pipelined sync consumed"""
+    if not cursor.get('ReadySignals'):
+        return
+    try:
+        ReadySignals(s3client, ic_bucket_name, cursor['ReadySignals']).clear()
+    except ClientError as error:
+        logger.warning("Cannot delete the ready signals: %s", error)
+
+
+def write_inventory_part(cursor, inventory):
+    """Write the inventory rows of this invocation; a sharded run writes one part per shard"""
+    part = f"{cursor.get('InventoryPart', 'main')}-{cursor['Invocation']}"
+    try:
+        write_inventory(s3client, ic_bucket_name, inventory, cursor['StartedAt'],
+                        cursor.get('InventoryRunId', cursor['RunId']), part)
+    except ClientError as error:
+        logger.warning("Cannot write the assignment inventory: %s", error)
+
+
+def hand_off(cursor, deadline, pipeline_id, context, extra=None):
+    """Save the progress cursor and continue in a new invocation"""
+    if operation_queue is not None:
+        operation_queue.flush()
+    key = save_checkpoint(s3client, ic_bucket_name,
+                          advance_cursor(cursor, deadline))
+    if pipeline_id:
+        # CodePipeline invokes the permission set function again with the token,
+        # which forwards it here through the SNS topic.
+        continue_in_pipeline(pipeline, pipeline_id, key)
+    else:
+        continue_by_self_invocation(lambda_client, context.function_name, key, extra)
+
+
+def parse_trigger(event):
+    """Normalize direct, SNS and SQS invocations into one trigger message"""
+    if 'Records' not in event:
+        return event
+    record = event['Records'][0]
+    body = record['Sns']['Message'] if 'Sns' in record else record.get('body', '')
+    if body.startswith('{'):
+        return json.loads(body)
+    if body == 'AWS API Call via CloudTrail':
+        return {}
+    return {'PipelineId': body}
+
+
+def finish_change_report():
+    """Upload the change report of this invocation; a failed upload does not fail the run"""
+    global change_report
+    report, change_report = change_report, None
+    if report is None:
+        return
+    try:
+        report.upload(s3client, ic_bucket_name)
+    except Exception as error:
+        logger.warning("Cannot upload the change report: %s", error)
+        report.discard()
+
+
+def pipeline_execution_details(cursor):
+    """CodePipeline execution details with the change summary and links to the change reports"""
+    prefixes = [cursor.get('ChangeReport'), run_report_prefix('auto-assignment', cursor['RunId'])]
+    links = [report_url(ic_bucket_name, prefix, runtime_region) for prefix in prefixes if prefix]
+    return execution_details(cursor['RunId'], change_report.summary(), links)
+
+
+def run_shard_worker(worker, resume_key, context):
+    """Reconcile the accounts of one shard and record the result for the coordinator"""
+    global change_report
+    cursor = None
+    if resume_key:
+        cursor = load_checkpoint(s3client, ic_bucket_name, resume_key)
+    if cursor is None:
+        cursor = new_cursor('auto-assignment-shard', '', ASSIGNMENT_PHASES[0])
+        cursor['Manifest'] = worker.get('Manifest')
+        cursor['Entities'] = worker.get('Entities', [])
+        # The parts of every shard belong to the inventory of the coordinating run.
+        cursor['InventoryRunId'] = worker['RunId']
+        cursor['InventoryPart'] = f"shard-{worker['ShardId']}"
+    logger.info("Shard %s of run %s: %s accounts", worker['ShardId'],
+                worker['RunId'], len(worker['AccountIds']))
+    result = {'Accounts': len(worker['AccountIds'])}
+    change_report = ChangeReport('auto-assignment', worker['RunId'],
+                                 f"shard-{worker['ShardId']}-{report_part(cursor)}")
+    if operation_queue is not None:
+        operation_queue.start_run()
+    try:
+        reconcile_assignments(cursor, '', context, worker['AccountIds'])
+        if operation_queue is not None:
+            operation_queue.flush()
+        delete_checkpoint(s3client, ic_bucket_name, cursor)
+        result['Status'] = 'SUCCEEDED'
+    except DeadlineApproaching as deadline:
+        logger.warning("%s. Shard continues in a new invocation.", deadline)
+        hand_off(cursor, deadline, '', context, {'ShardWorker': worker})
+        return
+    except (Exception, SystemExit) as error:
+        logger.error("Shard %s failed: %s", worker['ShardId'], error)
+        result['Status'] = 'FAILED'
+        result['Error'] = str(error)
+    finally:
+        # Counts of earlier invocations of this shard are not carried over.
+        result['Changes'] = dict(change_report.counts)
+        finish_change_report()
+    shard_result_store.put(worker['RunId'], worker['ShardId'], result)
+
+
+def run_assignment_pass(cursor, pipeline_id, context):
+    """Run one reconciliation pass and report it. Returns False if it was handed off at the deadline."""
+    global change_report
+    logger.info("Start the Process, pipeline jobid is %s", pipeline_id)
+    change_report = ChangeReport('auto-assignment', cursor['RunId'], report_part(cursor))
+    if operation_queue is not None:
+        operation_queue.start_run()
+    try:
+        return report_assignment_pass(cursor, pipeline_id, context)
+    finally:
+        logger.info("Assignment changes in this invocation: %s", change_report.summary())
+        finish_change_report()
+
+
+def report_assignment_pass(cursor, pipeline_id, context):
+    """Reconcile, then report success or failure to the pipeline job"""
+    try:
+        reconcile_assignments(cursor, pipeline_id, context)
+        if operation_queue is not None:
+            logger.info("Queued %s assignment operations",
+                        operation_queue.flush())
+        delete_checkpoint(s3client, ic_bucket_name, cursor)
+        record_applied_mappings(cursor)
+        clear_ready_signals(cursor)
+        # End of Assignment
+        pipeline.put_job_success_result(
+            jobId=pipeline_id,
+            executionDetails=pipeline_execution_details(cursor))
+        report_waiting_jobs(pipeline, cursor)
+        logger.info("Execution is complete.")
+
+    except DeadlineApproaching as deadline:
+        logger.warning("%s. Saving progress and continuing in a new invocation.", deadline)
+        try:
+            hand_off(cursor, deadline, pipeline_id, context)
+        except Exception as error:
+            logger.error("Cannot continue the run: %s", error)
+            pipeline.put_job_failure_result(
+                jobId=pipeline_id,
+                failureDetails={'type': 'JobFailed', 'message': str(error)}
+            )
+            report_waiting_jobs(pipeline, cursor, str(error))
+        return False
+    except Exception as error:
+        logger.error('%s', error)
+        pipeline.put_job_failure_result(
+            jobId=pipeline_id,
+            failureDetails={'type': 'JobFailed', 'message': str(error)}
+        )
+        report_waiting_jobs(pipeline, cursor, str(error))
+    return True
+
+
+def run_single_flight(cursor, pipeline_id, context):
+    """
+    Run the reconciliation under the single-flight lock. A run that finds
+    the lock held leaves a rerun request instead, and the holder serves it
+    with one more pass before releasing.
+    """
+    global active_lock
+    if not run_lock_table_name:
+        run_assignment_pass(cursor, pipeline_id, context)
+        return
+    lock = LeaseLock(dynamodb, run_lock_table_name, 'auto-assignment', cursor['RunId'])
+    if not lock.acquire_or_request_rerun(pipeline_id):
+        return
+    active_lock = lock
+    try:
+        while True:
+            if not run_assignment_pass(cursor, pipeline_id, context):
+                lock.suspend(HANDOFF_LEASE_SECONDS)
+                return
+            rerun = lock.release()
+            if rerun is None:
+                return
+            # The rerun pass serves requests that may each have scoped a different
+            # change, so it runs in full instead of merging them: the new cursor has
+            # no Entities, Manifest or ReadySignals, and Rerun keeps it off the
+            # mapping file delta, which would miss an organization change.
+            cursor = new_cursor('auto-assignment', '', ASSIGNMENT_PHASES[0])
+            cursor['PipelineId'] = pipeline_id = serve_rerun(rerun, cursor)
+            cursor['RunId'] = lock.owner
+            cursor['Rerun'] = True
+    except BaseException as error:
+        # Let the lease lapse now; a pending rerun request stays for the next run.
+        lock.suspend(0)
+        report_waiting_jobs(pipeline, cursor, str(error))
+        raise
+    finally:
+        active_lock = None
+
+
+@recorded(api_recorder, s3client, ic_bucket_name)
+@profiled('auto-assignment', s3client, ic_bucket_name, profiling_enabled, profile_top_n)
 def lambda_handler(event, context):
     """Lambda_handler"""
     logger.info(event)
     logger.debug(context)
     print(f"Delegated: {delegated}")
 
+    if is_operation_batch(event):
+        return process_operation_batch(event, OPERATION_EXECUTORS)
 
+    pipeline_id = ''
+    cursor = None
     try:
-        sns_message_from_auto_perm = event['Records'][0]['Sns']['Message']
-        if sns_message_from_auto_perm == 'AWS API Call via CloudTrail':
-            pipeline_id = ''
+        message = parse_trigger(event)
+        if 'ShardWorker' in message:
+            run_shard_worker(message['ShardWorker'], message.get('ResumeCheckpoint'), context)
+            return
+        if 'ConsumeReadySignals' in message:
+            run_ready_consumer(message, context)
+            return
+        pipeline_id = message.get('PipelineId', '')
+        resume_key = message.get('ResumeCheckpoint')
+        if resume_key:
+            cursor = load_checkpoint(s3client, ic_bucket_name, resume_key)
+        if cursor is None:
+            cursor = new_cursor('auto-assignment', pipeline_id, ASSIGNMENT_PHASES[0])
+            cursor['Entities'] = message.get('Entities', [])
+            cursor['Manifest'] = message.get('Manifest')
+            cursor['ChangeReport'] = message.get('ChangeReport')
+            cursor['ReadySignals'] = message.get('ReadySignals')
+            # Pipeline jobs of a rerun of the permission set function that wait on this run.
+            cursor['WaitingPipelineIds'] = message.get('WaitingPipelineIds', [])
+            if cursor['Entities']:
+                logger.info("Triggered by coalesced events affecting: %s", bounded(cursor['Entities']))
         else:
-            pipeline_id = sns_message_from_auto_perm
-        logger.info("Start the Process, pipeline jobid is %s", pipeline_id)
-        # Prepare account id.
-        if delegated == 'true':
-            acct_list = get_org_accounts_if_delegate()
-        else:
-            acct_list = get_org_accounts()
-        logger.info(acct_list)
-        # Check if Source files exist.
-        global_file_contents = get_global_mapping_contents(
-            ic_bucket_name, global_mapping_file_name, pipeline_id)
-        target_file_contents = get_target_mapping_contents(
-            ic_bucket_name, target_mapping_file_name, pipeline_id)
-        logger.info("Loading mapping information from the files in s3...")
-        # Get current account's permission set info.
-        if delegated == "true":
-            current_aws_permission_sets = get_all_permission_sets_if_delegate(
-                pipeline_id)
-            print("INFO: Admin delegated. Running in delegated admin account.")
-        else:
-            current_aws_permission_sets = get_all_permission_sets(pipeline_id)
-            print("INFO: Admin NOT delegated. Running in Management account.")
-        if not current_aws_permission_sets:
-            logger.error(
-                "Cannot load existing Permission Sets from AWS IAM Identity Center!")
-            pipeline.put_job_failure_result(
-                jobId=pipeline_id,
-                failureDetails={
-                    'type': 'JobFailed',
-                    'message': "No Permission Set information!"
-                })
-            quit()
-        else:
-            logger.info("The current permision sets in this account:%s",
-                        current_aws_permission_sets)
-        # Use S3 mapping files(sycned from source) as the only source of truth.
-        global_group_array_mapping(
-                acct_list, global_file_contents, current_aws_permission_sets, pipeline_id)
-        target_group_array_mapping(
-            target_file_contents, current_aws_permission_sets, pipeline_id)
-        all_assignments = list_all_current_account_assignment(
-                acct_list, current_aws_permission_sets, pipeline_id)
-        drift_detect_update(all_assignments, global_file_contents,
-                            target_file_contents, current_aws_permission_sets, pipeline_id)
-        # End of Assignment
-        pipeline.put_job_success_result(jobId=pipeline_id)
-        logger.info("Execution is complete.")
+            # A continued pipeline action reports to the new job id.
+            cursor['PipelineId'] = pipeline_id or cursor['PipelineId']
+            pipeline_id = cursor['PipelineId']
+        run_single_flight(cursor, pipeline_id, context)
 
     except Exception as error:
         logger.error('%s', error)
@@ -0,0 +1,84 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+# pylint: disable=C0301
+# pylint: disable=W1202,W0703
+# pylint: disable=E0401
+###########################################################################
+# Point-in-time inventory of the assignments a full reconciliation       #
+# observed. Rows are stored column by column, each column dictionary     #
+# encoded to small integers, as gzip JSON objects partitioned by date:   #
+#   automation-state/inventory/date=YYYY-MM-DD/run=<run id>/part-*.gz    #
+# One run may write several parts, one per invocation and shard.         #
+###########################################################################
+import gzip
+import json
+import logging
+from array import array
+from datetime import datetime, timezone
+from assignment_columns import Interner
+
+logger = logging.getLogger()
+
+INVENTORY_PREFIX = 'automation-state/inventory/'
+INVENTORY_FORMAT = 'columnar-json-gzip/1'
+COLUMNS = ('AccountId', 'PermissionSetArn', 'PrincipalType', 'PrincipalId', 'Source')
+
+
+class InventoryBuilder:
+    """Collects inventory rows into dictionary encoded columns"""
+
+    def __init__(self):
+        self.dictionaries = {column: Interner() for column in COLUMNS}
+        self.columns = {column: array('I') for column in COLUMNS}
+        self.perm_set_names = {}
+        self.group_names = {}
+
+    def add(self, **row):
+        """Add one assignment row with a value for every column"""
+        for column in COLUMNS:
+            self.columns[column].append(self.dictionaries[column].intern(str(row[column])))
+
+    def __len__(self):
+        return len(self.columns[COLUMNS[0]])
+
+    def encode(self, run_id):
+        """Return the part as gzip compressed JSON"""
+        return gzip.compress(json.dumps({
+            'Format': INVENTORY_FORMAT,
+            'RunId': run_id,
+            'SnapshotAt': datetime.now(timezone.utc).isoformat(),
+            'Rows': len(self),
+            'Dictionaries': {column: list(self.dictionaries[column].ids)
+                             for column in COLUMNS},
+            'Columns': {column: self.columns[column].tolist() for column in COLUMNS},
+            'PermissionSetNames': self.perm_set_names,
+            'GroupNames': self.group_names
+        }, separators=(',', ':')).encode('utf-8'))
+
+
+def inventory_run_prefix(started_at, run_id):
+    """S3 prefix of the parts of one run in the date partition it started in"""
+    return f"{INVENTORY_PREFIX}date={started_at[:10]}/run={run_id}/"
+
+
+def write_inventory(s3client, bucket_name, builder, started_at, run_id, part):
+    """Upload one inventory part and return its key"""
+    key = f"{inventory_run_prefix(started_at, run_id)}part-{part}.json.gz"
+    s3client.put_object(
+        Bucket=bucket_name,
+        Key=key,
+        Body=builder.encode(run_id),
+        ContentType='application/json',
+        ContentEncoding='gzip'
+    )
+    logger.info("Wrote %s inventory rows to %s", len(builder), key)
+    return key
+
+
+def decode_part(body):
+    """Return the header and the rows, as tuples in COLUMNS order, of one compressed part"""
+    part = json.loads(gzip.decompress(body))
+    if part.get('Format') != INVENTORY_FORMAT:
+        raise ValueError(f"Unknown inventory format {part.get('Format')}")
+    decoded = [[part['Dictionaries'][column][code] for code in part['Columns'][column]]
+               for column in COLUMNS]
+    return part, list(zip(*decoded))
@@ -0,0 +1,107 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+# pylint: disable=C0301
+# pylint: disable=W1202,W0703
+# pylint: disable=E0401
+###########################################################################
+# Structural delta between versions of the mapping files. Each pipeline  #
+# run records the S3 object versions of the mapping files it applied;    #
+# the next run reads those versions back from the versioned bucket and   #
+# applies only the (group, permission set, target) entries that were     #
+# added or removed since, with a full reconciliation at a fixed interval #
+# and whenever a permission set ARN changed since the recorded run.      #
+###########################################################################
+import json
+import time
+import logging
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+APPLIED_MAPPINGS_KEY = 'automation-state/applied-mapping-versions.json'
+GLOBAL_TARGET = 'Global'
+
+
+def current_versions(s3client, bucket_name, keys):
+    """Return the latest object version id of every key, or None if any has no version"""
+    versions = {}
+    for key in keys:
+        try:
+            version_id = s3client.head_object(Bucket=bucket_name, Key=key).get('VersionId')
+        except ClientError as error:
+            logger.warning("Cannot read the version of %s: %s", key, error)
+            return None
+        if not version_id or version_id == 'null':
+            return None
+        versions[key] = version_id
+    return versions
+
+
+def read_version(s3client, bucket_name, key, version_id):
+    """Return the parsed JSON of one object version"""
+    response = s3client.get_object(Bucket=bucket_name, Key=key, VersionId=version_id)
+    return json.loads(response['Body'].read())
+
+
+def load_applied_versions(s3client, bucket_name):
+    """Return the record of the last applied mapping versions, or None"""
+    try:
+        response = s3client.get_object(Bucket=bucket_name, Key=APPLIED_MAPPINGS_KEY)
+        return json.loads(response['Body'].read())
+    except (ClientError, ValueError) as error:
+        logger.info("No record of applied mapping versions: %s", error)
+        return None
+
+
+def save_applied_versions(s3client, bucket_name, versions, full_run_at=None,
+                          permission_set_arns=None):
+    """
+    Record the mapping versions a run applied, the permission set ARNs by
+    name it applied them to and when the last full reconciliation ran, now
+    if full_run_at is not given.
+    """
+    now = int(time.time())
+    s3client.put_object(
+        Bucket=bucket_name,
+        Key=APPLIED_MAPPINGS_KEY,
+        Body=json.dumps({
+            'Versions': versions,
+            'PermissionSets': permission_set_arns or {},
+            'FullRunAt': full_run_at or now,
+            'AppliedAt': now
+        }).encode('utf-8'),
+        ContentType='application/json'
+    )
+
+
+def full_run_due(applied, full_interval_seconds):
+    """Return True if no full reconciliation ran within the interval"""
+    return applied is None or time.time() - applied.get('FullRunAt', 0) > full_interval_seconds
+
+
+def changed_permission_sets(applied, current_aws_permission_sets):
+    """
+    Return the names of the permission sets created or recreated since the
+    applied versions: those whose ARN is not the recorded one.
+    """
+    applied_arns = applied.get('PermissionSets', {})
+    return sorted(name for name, perm_set in current_aws_permission_sets.items()
+                  if applied_arns.get(name) != perm_set['Arn'])
+
+
+def mapping_entries(global_file_contents, target_file_contents):
+    """Flatten the mapping files into a set of (group name, permission set name, target) entries"""
+    entries = set()
+    for mapping in global_file_contents:
+        if str(mapping['TargetAccountid']).upper() == GLOBAL_TARGET.upper():
+            for perm_set_name in mapping['PermissionSetName']:
+                entries.add((mapping['GlobalGroupName'], perm_set_name, GLOBAL_TARGET))
+    for mapping in target_file_contents:
+        for perm_set_name in mapping['PermissionSetName']:
+            for target_account_id in mapping['TargetAccountid']:
+                entries.add((mapping['TargetGroupName'], perm_set_name, str(target_account_id)))
+    return entries
+
+
+def diff_entries(previous_entries, entries):
+    """Return the added and the removed entries, each sorted"""
+    return sorted(entries - previous_entries), sorted(previous_entries - entries)
@@ -0,0 +1,222 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+# pylint: disable=C0301
+# pylint: disable=W1202,W0703
+# pylint: disable=E0401
+###########################################################################
+# Organization structure index for the OU and account tag selectors of   #
+# target mappings. The OU tree and the account tags are listed with      #
+# concurrent Organizations paging, cached in S3 between runs, and every  #
+# selector is expanded to an account set once per invocation. A selector #
+# that cannot be expanded fails the run instead of selecting no account, #
+# which would let the drift pass delete the assignments it stands for.   #
+###########################################################################
+import json
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+ORG_INDEX_KEY = 'automation-state/org-index.json'
+# Organizations allows only a few calls per second per account.
+MAX_WORKERS = 4
+MAX_ATTEMPTS = 6
+# Target mapping keys that select accounts by organizational unit and by account tag.
+OU_SELECTOR = 'TargetOrganizationalUnitIds'
+TAG_SELECTOR = 'TargetAccountTags'
+# Coalesced event entity of Organizations events, which may move or retag accounts.
+ORGANIZATIONS_SOURCE_ENTITY = 'Source:organizations.amazonaws.com'
+
+
+class UnresolvedSelector(ValueError):
+    """Raised when an OU or tag selector cannot be expanded to accounts with confidence"""
+
+
+def _paginate(method, result_key, **params):
+    """Collect every page of an Organizations list call, backing off when throttled"""
+    items = []
+    while True:
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                response = method(**params)
+                break
+            except ClientError as error:
+                if (error.response['Error']['Code'] != 'TooManyRequestsException' or
+                        attempt == MAX_ATTEMPTS - 1):
+                    raise
+                time.sleep(min(0.5 * 2 ** attempt, 8))
+        items += response[result_key]
+        if not response.get('NextToken'):
+            return items
+        params['NextToken'] = response['NextToken']
+
+
+def _list_children(orgs_client, parent_id):
+    """Return the child OU ids and the account ids directly under one parent"""
+    units = _paginate(orgs_client.list_organizational_units_for_parent,
+                      'OrganizationalUnits', ParentId=parent_id)
+    accounts = _paginate(orgs_client.list_accounts_for_parent, 'Accounts', ParentId=parent_id)
+    return [unit['Id'] for unit in units], [account['Id'] for account in accounts]
+
+
+def _list_account_tags(orgs_client, account_id):
+    """Return the tags of one account as a map"""
+    tags = _paginate(orgs_client.list_tags_for_resource, 'Tags', ResourceId=account_id)
+    return {tag['Key']: tag['Value'] for tag in tags}
+
+
+def build_org_index(orgs_client, include_tags):
+    """
+    List the OU tree level by level, the parents of each level concurrently,
+    and optionally the tags of every account.
+    """
+    roots = [root['Id'] for root in _paginate(orgs_client.list_roots, 'Roots')]
+    children = {}
+    accounts = {}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        level = roots
+        while level:
+            listed = list(executor.map(lambda parent: _list_children(orgs_client, parent), level))
+            next_level = []
+            for parent_id, (unit_ids, account_ids) in zip(level, listed):
+                children[parent_id] = unit_ids
+                accounts[parent_id] = account_ids
+                next_level += unit_ids
+            level = next_level
+        tags = None
+        if include_tags:
+            account_ids = sorted({account_id for ids in accounts.values() for account_id in ids})
+            tags = dict(zip(account_ids, executor.map(
+                lambda account_id: _list_account_tags(orgs_client, account_id), account_ids)))
+    logger.info("Indexed %s organizational units and %s accounts",
+                len(children) - len(roots), sum(len(ids) for ids in accounts.values()))
+    return {
+        'BuiltAt': int(time.time()),
+        'Roots': roots,
+        'Children': children,
+        'Accounts': accounts,
+        'Tags': tags
+    }
+
+
+def load_cached_org_index(s3client, bucket_name, max_age_seconds, include_tags):
+    """Return the cached index if it is recent enough and holds the tags when needed, otherwise None"""
+    try:
+        response = s3client.get_object(Bucket=bucket_name, Key=ORG_INDEX_KEY)
+        index = json.loads(response['Body'].read())
+    except (ClientError, ValueError) as error:
+        logger.info("No usable organization index cache: %s", error)
+        return None
+    if time.time() - index.get('BuiltAt', 0) > max_age_seconds:
+        return None
+    if include_tags and index.get('Tags') is None:
+        return None
+    # Not persisted: tells the resolver the index may predate recent changes.
+    index['FromCache'] = True
+    return index
+
+
+def get_org_index(orgs_client, s3client, bucket_name, max_age_seconds, include_tags, refresh=False):
+    """
+    Return the organization index. Reuses the S3 cache when it is younger
+    than max_age_seconds unless refresh is set.
+    """
+    if not refresh:
+        cached = load_cached_org_index(s3client, bucket_name, max_age_seconds, include_tags)
+        if cached is not None:
+            logger.info("Using the organization index cached at %s", cached['BuiltAt'])
+            return cached
+    index = build_org_index(orgs_client, include_tags)
+    try:
+        s3client.put_object(
+            Bucket=bucket_name,
+            Key=ORG_INDEX_KEY,
+            Body=json.dumps(index).encode('utf-8'),
+            ContentType='application/json'
+        )
+    except ClientError as error:
+        logger.warning("Cannot cache the organization index: %s", error)
+    return index
+
+
+def uses_selectors(mapping_contents):
+    """Return the selector keys used by any of the target mappings"""
+    return {key for mapping in mapping_contents for key in (OU_SELECTOR, TAG_SELECTOR)
+            if mapping.get(key)}
+
+
+def organization_changed(entities):
+    """Return True if the triggering events may have changed the OU tree or account tags"""
+    return ORGANIZATIONS_SOURCE_ENTITY in entities
+
+
+class TargetResolver:
+    """Expand OU and tag selectors to account ids, each selector only once"""
+
+    def __init__(self, org_index, eligible_account_ids):
+        self.index = org_index
+        self.eligible = set(eligible_account_ids)
+        self.expanded = {}
+        self.from_cache = org_index.get('FromCache', False)
+
+    def _ou_accounts(self, ou_id):
+        account_ids = set()
+        pending = [ou_id]
+        while pending:
+            parent_id = pending.pop()
+            account_ids.update(self.index['Accounts'].get(parent_id, []))
+            pending += self.index['Children'].get(parent_id, [])
+        return account_ids
+
+    def _tag_accounts(self, key, value):
+        return {account_id for account_id, tags in self.index['Tags'].items()
+                if key in tags and (value is None or tags[key] == value)}
+
+    def ou_accounts(self, ou_id):
+        """Eligible accounts in an organizational unit or any of its descendants"""
+        selector = ('OU', ou_id)
+        if selector not in self.expanded:
+            if ou_id not in self.index['Children']:
+                raise UnresolvedSelector(f"Organizational unit {ou_id} does not exist.")
+            self.expanded[selector] = self._ou_accounts(ou_id) & self.eligible
+        return self.expanded[selector]
+
+    def tag_accounts(self, tag):
+        """Eligible accounts carrying a tag key, with the given value if the selector has one"""
+        selector = ('Tag', tag['Key'], tag.get('Value'))
+        if selector not in self.expanded:
+            if self.index.get('Tags') is None:
+                raise UnresolvedSelector("The organization index holds no account tags.")
+            account_ids = self._tag_accounts(tag['Key'], tag.get('Value')) & self.eligible
+            if not account_ids:
+                if self.from_cache:
+                    raise UnresolvedSelector(f"Tag selector {tag} matches no account in the cached organization index.")
+                logger.warning("Tag selector %s matches no account.", tag)
+            self.expanded[selector] = account_ids
+        return self.expanded[selector]
+
+    def resolve(self, mapping):
+        """Return the mapping with its selectors replaced by the sorted account ids they select"""
+        account_ids = {str(account_id) for account_id in mapping.get('TargetAccountid', [])}
+        for ou_id in mapping.get(OU_SELECTOR, []):
+            account_ids |= self.ou_accounts(ou_id)
+        for tag in mapping.get(TAG_SELECTOR, []):
+            account_ids |= self.tag_accounts(tag)
+        resolved = {key: value for key, value in mapping.items()
+                    if key not in (OU_SELECTOR, TAG_SELECTOR)}
+        resolved['TargetAccountid'] = sorted(account_ids)
+        return resolved
+
+
+def expand_target_mappings(mapping_contents, org_index, acct_list):
+    """
+    Resolve the selectors of every target mapping against the active accounts
+    of acct_list. Raises UnresolvedSelector if an OU does not exist or, with a
+    cached index, a tag selector matches no account.
+    """
+    resolver = TargetResolver(org_index, [str(account['Id']) for account in acct_list
+                                          if account['Status'] != "SUSPENDED"])
+    expanded = [resolver.resolve(mapping) for mapping in mapping_contents]
+    logger.info("Expanded %s organizational unit and tag selectors", len(resolver.expanded))
+    return expanded
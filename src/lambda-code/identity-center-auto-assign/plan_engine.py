@@ -0,0 +1,223 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+# pylint: disable=C0301
+# pylint: disable=W1202,W0703
+# pylint: disable=E0401
+###########################################################################
+# Plan-only assignment engine for shadow mode. It reads the current      #
+# assignments concurrently, only where each permission set is            #
+# provisioned, and plans the creates and deletes as the difference to    #
+# the mapping files, without calling any write API. A shadow run times   #
+# and counts it alongside the operations the current code path submits   #
+# in the same invocation and reports the difference of both plans.      #
+###########################################################################
+import time
+import json
+import gzip
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+SHADOW_PREFIX = 'automation-state/shadow/'
+METRIC_NAMESPACE = 'IdentityCenterAutomation'
+# Differences listed in the log; the S3 report holds all of them.
+LOGGED_DIFFERENCES = 20
+
+
+class ApiCallCounter:
+    """Counts the API calls made through the attached clients"""
+
+    def __init__(self, *clients):
+        self.lock = threading.Lock()
+        self.calls = 0
+        for client in clients:
+            client.meta.events.register('before-call', self._count)
+
+    def _count(self, **kwargs):
+        with self.lock:
+            self.calls += 1
+
+
+def expected_assignments(acct_list, global_file_contents, target_file_contents,
+                         perm_set_arns, group_id_of):
+    """The (account id, permission set ARN, group id) assignments the mapping files define"""
+    expected = set()
+    active_account_ids = [str(account['Id']) for account in acct_list
+                          if account['Status'] != "SUSPENDED"]
+    for mapping in global_file_contents:
+        group_id = group_id_of(mapping['GlobalGroupName'])
+        if not group_id or str(mapping['TargetAccountid']).upper() != "GLOBAL":
+            continue
+        for perm_set_name in mapping['PermissionSetName']:
+            expected.update((account_id, perm_set_arns[perm_set_name], group_id)
+                            for account_id in active_account_ids)
+    for mapping in target_file_contents:
+        group_id = group_id_of(mapping['TargetGroupName'])
+        if not group_id:
+            continue
+        for perm_set_name in mapping['PermissionSetName']:
+            expected.update((str(account_id), perm_set_arns[perm_set_name], group_id)
+                            for account_id in mapping['TargetAccountid'])
+    return expected
+
+
+def _provisioned_accounts(ic_admin, instance_arn, perm_set_arn):
+    account_ids = set()
+    params = {'InstanceArn': instance_arn, 'PermissionSetArn': perm_set_arn}
+    while True:
+        response = ic_admin.list_accounts_for_provisioned_permission_set(**params)
+        account_ids.update(response['AccountIds'])
+        if 'NextToken' not in response:
+            return account_ids
+        params['NextToken'] = response['NextToken']
+
+
+def _account_assignments(ic_admin, instance_arn, account_id, perm_set_arn):
+    assignments = []
+    params = {'InstanceArn': instance_arn, 'AccountId': account_id,
+              'PermissionSetArn': perm_set_arn, 'MaxResults': 100}
+    while True:
+        response = ic_admin.list_account_assignments(**params)
+        assignments += [(assignment['AccountId'], assignment['PermissionSetArn'],
+                         assignment['PrincipalType'], assignment['PrincipalId'])
+                        for assignment in response['AccountAssignments']]
+        if 'NextToken' not in response:
+            return assignments
+        params['NextToken'] = response['NextToken']
+
+
+def current_assignments(ic_admin, instance_arn, acct_list, perm_set_arns, workers):
+    """
+    The current (account id, permission set ARN, principal type, principal id)
+    assignments of the permission sets in the active accounts, listed
+    concurrently and only where each permission set is provisioned.
+    """
+    active_account_ids = {str(account['Id']) for account in acct_list
+                          if account['Status'] != "SUSPENDED"}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        provisioned = executor.map(
+            lambda arn: _provisioned_accounts(ic_admin, instance_arn, arn), perm_set_arns)
+        pairs = [(account_id, arn) for arn, account_ids in zip(perm_set_arns, provisioned)
+                 for account_id in sorted(account_ids & active_account_ids)]
+        listed = executor.map(
+            lambda pair: _account_assignments(ic_admin, instance_arn, *pair), pairs)
+        return {assignment for assignments in listed for assignment in assignments}
+
+
+def plan_assignments(expected, current, enumerated_arns):
+    """
+    Plan the operations that make the enumerated permission sets match the
+    mapping files: create what is missing, delete USER assignments and
+    GROUP assignments the mapping files do not define.
+    """
+    current_groups = {(account_id, arn, principal_id)
+                      for account_id, arn, principal_type, principal_id in current
+                      if principal_type == 'GROUP'}
+    deletes = {(account_id, arn, principal_type, principal_id)
+               for account_id, arn, principal_type, principal_id in current
+               if arn in enumerated_arns and
+               (principal_type == 'USER' or (account_id, arn, principal_id) not in expected)}
+    creates = {(account_id, arn, 'GROUP', principal_id)
+               for account_id, arn, principal_id in expected - current_groups}
+    return {'Create': creates, 'Delete': deletes}
+
+
+class ShadowRun:
+    """
+    The shadow plan of one reconciliation and the operations the current
+    code path submits after it, with the API calls and wall time of each.
+    """
+
+    def __init__(self, counter):
+        self.counter = counter
+        self.current_state = set()
+        self.shadow_plan = None
+        self.submitted = {'Create': set(), 'Delete': set()}
+        self.stats = {}
+        self.current_started = (0, 0)
+
+    def plan(self, compute):
+        """Compute the shadow plan with compute(), which returns the plan and the state it read"""
+        calls, started = self.counter.calls, time.time()
+        self.shadow_plan, self.current_state = compute()
+        self.stats['Shadow'] = {'ApiCalls': self.counter.calls - calls,
+                                'Seconds': round(time.time() - started, 3)}
+        self.current_started = (self.counter.calls, time.time())
+
+    def record(self, operation, params):
+        """Record an operation the current code path submitted"""
+        kind = 'Create' if operation == 'CreateAccountAssignment' else 'Delete'
+        self.submitted[kind].add((str(params['TargetId']), params['PermissionSetArn'],
+                                  params['PrincipalType'], params['PrincipalId']))
+
+    def finish(self):
+        """
+        Compare both plans and return the report. Creates of the current code
+        path for assignments that already existed are no-ops and do not count
+        as differences.
+        """
+        calls, started = self.current_started
+        self.stats['Current'] = {'ApiCalls': self.counter.calls - calls,
+                                 'Seconds': round(time.time() - started, 3)}
+        effective = {
+            'Create': self.submitted['Create'] - self.current_state,
+            'Delete': self.submitted['Delete']
+        }
+        differences = {
+            'OnlyCurrent': sorted(op for kind in effective for op in effective[kind] - self.shadow_plan[kind]),
+            'OnlyShadow': sorted(op for kind in effective for op in self.shadow_plan[kind] - effective[kind])
+        }
+        for name in ('Current', 'Shadow'):
+            plan = effective if name == 'Current' else self.shadow_plan
+            self.stats[name].update(Creates=len(plan['Create']), Deletes=len(plan['Delete']))
+        self.stats['Current']['NoOpCreates'] = len(self.submitted['Create']) - len(effective['Create'])
+        return {
+            'Stats': self.stats,
+            'Differences': differences,
+            'DifferenceCount': len(differences['OnlyCurrent']) + len(differences['OnlyShadow']),
+            'ShadowPlan': {kind: sorted(ops) for kind, ops in self.shadow_plan.items()},
+            'CurrentPlan': {kind: sorted(ops) for kind, ops in self.submitted.items()}
+        }
+
+
+def publish_shadow_report(s3client, bucket_name, run_id, report, function_name):
+    """Upload the report and emit its metrics in CloudWatch embedded metric format"""
+    stats = report['Stats']
+    logger.info("Shadow plan: %s differences, current %s, shadow %s",
+                report['DifferenceCount'], stats['Current'], stats['Shadow'])
+    for side in ('OnlyCurrent', 'OnlyShadow'):
+        for operation in report['Differences'][side][:LOGGED_DIFFERENCES]:
+            logger.warning("Shadow plan difference, %s: %s", side, operation)
+    speedup = stats['Current']['Seconds'] / stats['Shadow']['Seconds'] if stats['Shadow']['Seconds'] else 0
+    print(json.dumps({
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRIC_NAMESPACE,
+                'Dimensions': [['Function']],
+                'Metrics': [
+                    {'Name': 'ShadowPlanDifferences', 'Unit': 'Count'},
+                    {'Name': 'ShadowPlanSpeedup', 'Unit': 'None'},
+                    {'Name': 'ShadowPlanApiCalls', 'Unit': 'Count'},
+                    {'Name': 'CurrentPlanApiCalls', 'Unit': 'Count'}
+                ]
+            }]
+        },
+        'Function': function_name,
+        'ShadowPlanDifferences': report['DifferenceCount'],
+        'ShadowPlanSpeedup': round(speedup, 2),
+        'ShadowPlanApiCalls': stats['Shadow']['ApiCalls'],
+        'CurrentPlanApiCalls': stats['Current']['ApiCalls']
+    }))
+    try:
+        s3client.put_object(
+            Bucket=bucket_name,
+            Key=f"{SHADOW_PREFIX}{run_id}.json.gz",
+            Body=gzip.compress(json.dumps(report).encode('utf-8')),
+            ContentType='application/json',
+            ContentEncoding='gzip'
+        )
+    except ClientError as error:
+        logger.warning("Cannot upload the shadow plan report: %s", error)
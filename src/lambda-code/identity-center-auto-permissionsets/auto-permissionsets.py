@@ -7,17 +7,41 @@
 # A workaround of upgrade the boto3 version in the lambda function #
 ####################################################################
 import cfnresponse
-from time import sleep
+from time import sleep, time
 import json
 import os
 import logging
 import sys
-from pip._internal import main
-main(['install', '-I', '-q', 'boto3', '--target', '/tmp/',
-     '--no-cache-dir', '--disable-pip-version-check'])
-sys.path.insert(0, '/tmp/')
+from concurrent.futures import ThreadPoolExecutor
+if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ:
+    # Only inside Lambda; the standalone runner brings its own boto3.
+    from pip._internal import main
+    main(['install', '-I', '-q', 'boto3', '--target', '/tmp/',
+         '--no-cache-dir', '--disable-pip-version-check'])
+    sys.path.insert(0, '/tmp/')
 import boto3
 from botocore.exceptions import ClientError
+from checkpoint import (DeadlineApproaching, deadline_reached, new_cursor,
+                        advance_cursor, save_checkpoint, load_checkpoint,
+                        delete_checkpoint, continue_in_pipeline,
+                        continue_by_self_invocation)
+from work_queue import (OperationQueue, is_operation_batch, process_operation_batch,
+                        THROTTLING_ERRORS)
+from operation_ledger import OperationLedger
+from event_coalescing import (coalesce_event, event_entities, flush_window, flushed_window_id,
+                              is_window_flush)
+from lease_lock import LeaseLock, serve_rerun, report_waiting_jobs
+from management_exclusion import get_management_permission_sets
+from handoff_manifest import HANDOFF_MANIFEST_KEY, build_manifest, write_manifest, read_manifest
+from definition_objects import (definition_keys, read_definition, previous_definition,
+                                defined_elsewhere)
+from group_directory import DIRECTORY_EVENTS, apply_directory_event
+from change_report import ChangeReport, report_part, run_report_prefix, bounded
+from profiling import profiled
+from ready_signals import ReadySignals
+from api_cassette import ApiRecorder, default_session, recorded
+from permission_set_state import (fetch_permission_set_state, inline_policy_differs,
+                                  settings_differ, diff_tags)
 
 
 logger = logging.getLogger()
@@ -27,55 +51,189 @@ logger.info("Logging initialized")
 
 
 runtime_region = os.environ['Lambda_Region']
+# Every API call of an invocation is recorded to a cassette in S3 when set to true.
+# The hooks must be installed before the clients are created.
+api_recorder = None
+if os.environ.get('RecordApiTraffic', 'false').lower() == 'true':
+    api_recorder = ApiRecorder('auto-permissionsets', os.environ.get('ApiCassetteSalt'))
+    api_recorder.install(default_session())
 ic_bucket_name = os.environ.get('IC_S3_BucketName')
 pipeline = boto3.client('codepipeline', region_name=runtime_region)
 s3 = boto3.resource('s3')
+s3client = boto3.client('s3', region_name=runtime_region)
+lambda_client = boto3.client('lambda', region_name=runtime_region)
 sns_client = boto3.client('sns', region_name=runtime_region)
 sns_topic_name = os.environ.get('SNS_Topic_Name')
+orgs_client = boto3.client('organizations', region_name=runtime_region)
 ic_admin = boto3.client('sso-admin', region_name=runtime_region)
 ic_instance_arn = os.environ.get('IC_InstanceArn')
 default_session_duration = os.environ.get('Session_Duration')
 management_account_id = os.environ.get('Org_Management_Account')
 delegated = os.environ.get('AdminDelegated')
 dynamodb = boto3.client('dynamodb', region_name=runtime_region)
+skipped_perm_sets_table_name = os.environ.get(
+    'SkippedPermissionSetsTableName') or 'ic-SkippedPermissionSetsTable'
+sqs_client = boto3.client('sqs', region_name=runtime_region)
+event_coalescing_table_name = os.environ.get('EventCoalescingTableName')
+event_coalescing_window_seconds = int(os.environ.get('EventCoalescingWindowSeconds', '30'))
+# Delayed messages on this queue flush the event windows.
+event_window_queue_url = os.environ.get('EventWindowQueueUrl')
+run_lock_table_name = os.environ.get('RunLockTableName')
+group_directory_table_name = os.environ.get('GroupDirectoryTableName')
+# Invocations run under cProfile and tracemalloc and report their hot spots to S3 when set to true.
+profiling_enabled = os.environ.get('ProfileInvocations', 'false').lower() == 'true'
+profile_top_n = int(os.environ.get('ProfileTopN') or 25)
+# Pipeline runs start the assignment function right away and signal each permission set ready when set to true.
+pipelined_assignments = os.environ.get('PipelinedAssignments', 'false').lower() == 'true'
+# Lease kept for the continuation invocation of a run that hands off at the deadline.
+HANDOFF_LEASE_SECONDS = 900
+# Lock held by the current run; writes stop if another run has fenced it off.
+active_lock = None
+operation_queue_url = os.environ.get('OperationQueueUrl')
+# Write operations are queued for the SQS consumer when a queue is configured.
+# Operations of one permission set share a FIFO group so they apply in order.
+if operation_queue_url:
+    operation_queue = OperationQueue(sqs_client, operation_queue_url, 'auto-permissionsets')
+else:
+    operation_queue = None
+OPERATION_EXECUTORS = {
+    'AttachManagedPolicyToPermissionSet': ic_admin.attach_managed_policy_to_permission_set,
+    'DetachManagedPolicyFromPermissionSet': ic_admin.detach_managed_policy_from_permission_set,
+    'AttachCustomerManagedPolicyReferenceToPermissionSet': ic_admin.attach_customer_managed_policy_reference_to_permission_set,
+    'DetachCustomerManagedPolicyReferenceFromPermissionSet': ic_admin.detach_customer_managed_policy_reference_from_permission_set,
+    'PutInlinePolicyToPermissionSet': ic_admin.put_inline_policy_to_permission_set,
+    'DeleteInlinePolicyFromPermissionSet': ic_admin.delete_inline_policy_from_permission_set,
+    'ProvisionPermissionSet': ic_admin.provision_permission_set
+}
+failed_operations_table_name = os.environ.get('FailedOperationsTableName')
+# Operations that fail inline are recorded here and replayed by the next run.
+if failed_operations_table_name:
+    operation_ledger = OperationLedger(dynamodb, failed_operations_table_name, 'auto-permissionsets')
+else:
+    operation_ledger = None
+# Permission sets with queued policy changes, which need a queued reprovision.
+queued_policy_changes = set()
+# ARNs of the permission sets this run created, updated or deleted, for the handoff manifest.
+perm_set_changes = {'Created': set(), 'Updated': set(), 'Deleted': set()}
+# Change report of the current invocation.
+change_report = None
+# Threads that read the facets of a permission set concurrently.
+state_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('StateFetchWorkers', '5')))
+# Set by the standalone runner to run the assignment function in-process instead of through SNS.
+assignment_trigger = None
+# Ready signals of the current pipelined sync.
+ready_signals = None
+# Synchronization phases in execution order, used by the resume cursor.
+PERMISSION_SET_PHASES = ['sync', 'delete']
+
+def record_change(kind, **details):
+    """Add an entry to the change report of the current invocation"""
+    if change_report is not None:
+        change_report.record(kind, **details)
+
+
+def submit_operation(operation, **params):
+    """Queue a permission set operation for the consumer, or run it now without a queue"""
+    if active_lock is not None:
+        active_lock.check()
+    record_change(operation, **{key: value for key, value in params.items()
+                                if key != 'InstanceArn'})
+    if operation != 'ProvisionPermissionSet':
+        perm_set_changes['Updated'].add(params['PermissionSetArn'])
+    if operation_queue is not None:
+        operation_queue.submit(operation, params, group=params['PermissionSetArn'].split('/')[-1])
+        if operation != 'ProvisionPermissionSet':
+            queued_policy_changes.add(params['PermissionSetArn'])
+        return {'Queued': operation}
+    try:
+        return OPERATION_EXECUTORS[operation](**params)
+    except ClientError as error:
+        if operation_ledger is None:
+            raise
+        operation_ledger.record(operation, params, error)
+        if error.response['Error']['Code'] not in THROTTLING_ERRORS:
+            raise
+        # The next run replays it from the ledger; carry on with the other operations.
+        logger.warning("%s on %s deferred to the next run: %s",
+                       operation, params['PermissionSetArn'], error)
+        sleep(2)
+        return {'Deferred': operation}
+
+
+def replay_failed_operations():
+    """Apply the operations that failed in earlier runs, then reprovision what they changed"""
+    changed_perm_set_arns = set()
+
+    def on_applied(operation, params, _response):
+        record_change('ReplayedOperation', Operation=operation,
+                      **{key: value for key, value in params.items() if key != 'InstanceArn'})
+        if operation != 'ProvisionPermissionSet':
+            changed_perm_set_arns.add(params['PermissionSetArn'])
 
-def sync_table_for_skipped_perm_sets(skipped_perm_set):
-    """Sync DynamoDB table with the list of skipped permission sets if Admin is delegated"""
     try:
+        operation_ledger.replay(OPERATION_EXECUTORS, on_applied)
+        for perm_set_arn in sorted(changed_perm_set_arns):
+            perm_set_changes['Updated'].add(perm_set_arn)
+            submit_operation('ProvisionPermissionSet',
+                             InstanceArn=ic_instance_arn,
+                             PermissionSetArn=perm_set_arn,
+                             TargetType='ALL_PROVISIONED_ACCOUNTS')
+    except ClientError as error:
+        logger.warning("Cannot replay the operation ledger: %s", error)
+
+
+def scan_skipped_perm_sets_table():
+    """Read every item of the skipped permission sets table, following pagination"""
+    items = {}
+    response = dynamodb.scan(TableName=skipped_perm_sets_table_name)
+    while True:
+        for item in response['Items']:
+            items[item['perm_set_arn']['S']] = item.get('perm_set_name', {}).get('S')
+        if 'LastEvaluatedKey' not in response:
+            return items
         response = dynamodb.scan(
-            TableName='ic-SkippedPermissionSetsTable')
-        items = response['Items']
-        print(f"Items in DynamoDB table: {items}")
-        for item in items:
-            # If the permission set is not in the current skipped_perm_set, delete it from the table
-            if item['perm_set_arn']['S'] not in skipped_perm_set:
-                dynamodb.delete_item(
-                    TableName='ic-SkippedPermissionSetsTable',
-                    Key={'perm_set_arn': item['perm_set_arn']}
-                )
-                print(f"Drift detected in DynamoDB table. Deleted item: {item} from table.")
+            TableName=skipped_perm_sets_table_name,
+            ExclusiveStartKey=response['LastEvaluatedKey'])
 
-            sleep(0.1)
 
-        # Update the table with all permission sets in the skipped_perm_set
-        batch = dynamodb.batch_write_item(RequestItems={
-            'ic-SkippedPermissionSetsTable': [
-                {
-                    'PutRequest': {
-                        'Item': {
-                            'perm_set_arn': {'S': perm_set_arn},
-                            'perm_set_name': {'S': perm_set_name}
-                        }
-                    }
-                } for perm_set_arn, perm_set_name in skipped_perm_set.items()
-            ]
-        })
-        #Get all skipped permission sets that were unprocessed
-        unprocessed_items = batch.get('UnprocessedItems')
-        if unprocessed_items:
-            logger.error("There were unprocessed skipped permission sets while writing to DynamoDB table: %s" % unprocessed_items)
-        else:
-            logger.info("All skipped permission sets written successfully to the table")
+def write_skipped_perm_sets_chunk(write_requests):
+    """Write up to 25 requests, retrying unprocessed items with backoff until all are written"""
+    pending = {skipped_perm_sets_table_name: write_requests}
+    attempt = 0
+    while pending:
+        response = dynamodb.batch_write_item(RequestItems=pending)
+        pending = response.get('UnprocessedItems') or {}
+        if pending:
+            attempt += 1
+            logger.warning("%s skipped permission set writes unprocessed, retrying (attempt %s)",
+                           len(pending[skipped_perm_sets_table_name]), attempt)
+            sleep(min(0.1 * 2 ** attempt, 5))
+    return len(write_requests)
+
+
+def sync_table_for_skipped_perm_sets(skipped_perm_set):
+    """Sync DynamoDB table with the list of skipped permission sets if Admin is delegated"""
+    try:
+        items = scan_skipped_perm_sets_table()
+        # Only write what differs between the table and the current skipped permission sets.
+        write_requests = [
+            {'DeleteRequest': {'Key': {'perm_set_arn': {'S': perm_set_arn}}}}
+            for perm_set_arn in items if perm_set_arn not in skipped_perm_set]
+        write_requests += [
+            {'PutRequest': {'Item': {
+                'perm_set_arn': {'S': perm_set_arn},
+                'perm_set_name': {'S': perm_set_name}
+            }}}
+            for perm_set_arn, perm_set_name in skipped_perm_set.items()
+            if items.get(perm_set_arn) != perm_set_name]
+        if not write_requests:
+            logger.info("Skipped permission sets table is up to date (%s items)", len(items))
+            return
+        chunks = [write_requests[i:i + 25] for i in range(0, len(write_requests), 25)]
+        with ThreadPoolExecutor(max_workers=min(len(chunks), 8)) as executor:
+            written = sum(executor.map(write_skipped_perm_sets_chunk, chunks))
+        logger.info("Synchronized skipped permission sets table: %s writes in %s batches",
+                    written, len(chunks))
     except Exception as error:
         logger.error("Error syncing with DynamoDB table: %s", error)
 
@@ -150,7 +308,9 @@ def get_all_permission_sets(pipeline_id):
         )
     if skipped_perm_set:
         try:
-            print(f"Skipped Permission Set Name and ARN: {skipped_perm_set}")
+            for perm_set_arn, perm_set_name in skipped_perm_set.items():
+                record_change('SkippedPermissionSet', PermissionSetArn=perm_set_arn,
+                              Name=perm_set_name)
             sync_table_for_skipped_perm_sets(skipped_perm_set)
         except Exception as error:
             logger.error(
@@ -176,6 +336,11 @@ def get_all_permission_sets_if_delegate(pipeline_id):
             )
             all_perm_sets_arns += response['PermissionSets']
 
+        # This function runs first in the pipeline, so it refreshes the cache
+        # that auto-assignment.py reuses.
+        management_perm_sets = get_management_permission_sets(
+            ic_admin, s3client, ic_bucket_name, ic_instance_arn,
+            management_account_id, 0, refresh=True)
         skipped_perm_set = {}
         for perm_set_arn in all_perm_sets_arns:
             describe_perm_set = ic_admin.describe_permission_set(
@@ -190,23 +355,7 @@ def get_all_permission_sets_if_delegate(pipeline_id):
                 logger.error("Failed to get description for permission set %s. Error: %s", perm_set_arn, error)
             perm_set_name = describe_perm_set['PermissionSet']['Name']
             perm_set_arn = describe_perm_set['PermissionSet']['PermissionSetArn']
-            list_accounts_for_provisioned_perm_set = ic_admin.list_accounts_for_provisioned_permission_set(
-                InstanceArn=ic_instance_arn,
-                PermissionSetArn=perm_set_arn,
-                MaxResults=100,
-            )
-            accounts_for_perm_set = list_accounts_for_provisioned_perm_set['AccountIds']
-            sleep(0.1)  # Aviod hitting API limit.
-            while 'NextToken' in list_accounts_for_provisioned_perm_set:
-                list_accounts_for_provisioned_perm_set = ic_admin.list_accounts_for_provisioned_permission_set(
-                    PermissionSetArn=perm_set_arn,
-                    MaxResults=100,
-                    NextToken=list_accounts_for_provisioned_perm_set['NextToken']
-                )
-                sleep(0.1)  # Aviod hitting API limit.
-                accounts_for_perm_set += list_accounts_for_provisioned_perm_set['AccountIds']
-            logger.info("Accounts for permission set %s is %s", perm_set_arn, accounts_for_perm_set)
-            if management_account_id in accounts_for_perm_set:
+            if perm_set_arn in management_perm_sets:
                 skipped_perm_set.update({perm_set_arn: perm_set_name})
                 continue
             permission_set_name_and_arn[perm_set_name] = {
@@ -228,7 +377,9 @@ def get_all_permission_sets_if_delegate(pipeline_id):
         )
     if skipped_perm_set:
         try:
-            print(f"Skipped Permission Set Name and ARN: {skipped_perm_set}")
+            for perm_set_arn, perm_set_name in skipped_perm_set.items():
+                record_change('SkippedPermissionSet', PermissionSetArn=perm_set_arn,
+                              Name=perm_set_name)
             sync_table_for_skipped_perm_sets(skipped_perm_set)
         except Exception as error:
             logger.error(
@@ -247,7 +398,7 @@ def get_all_json_files(bucket_name, pipeline_id):
         for s3_object in my_bucket.objects.filter(Prefix="permission-sets/"):
             if ".json" in s3_object.key:
                 file_name = s3_object.key
-                logger.info("processing file: %s", file_name)
+                logger.debug("processing file: %s", file_name)
                 s3.Bucket(bucket_name).download_file(
                     file_name, "/tmp/each_permission_set.json")
                 temp_file = open("/tmp/each_permission_set.json")
@@ -266,7 +417,8 @@ def get_all_json_files(bucket_name, pipeline_id):
 
 
 def create_permission_set(name, desc, tags, session_duration, pipeline_id):
-    """Create a permission set in AWS IAM Identity Center"""
+    """Create a permission set in AWS IAM Identity Center. Returns None if it was not created."""
+    response = None
     try:
         response = ic_admin.create_permission_set(
             Name=name,
@@ -297,13 +449,12 @@ def add_managed_policy_to_perm_set(perm_set_arn, managed_policy_arn,
                                    pipeline_id):
     """Attach a managed policy to a permission set"""
     try:
-        attach_managed_policy = ic_admin.attach_managed_policy_to_permission_set(
+        attach_managed_policy = submit_operation(
+            'AttachManagedPolicyToPermissionSet',
             InstanceArn=ic_instance_arn,
             PermissionSetArn=perm_set_arn,
             ManagedPolicyArn=managed_policy_arn
         )
-        logger.info('Managed Policy %s added to %s',
-                    managed_policy_arn, perm_set_arn)
         sleep(0.1)  # Aviod hitting API limit.
 
     except ic_admin.exceptions.ThrottlingException as error:
@@ -324,13 +475,12 @@ def add_managed_policy_to_perm_set(perm_set_arn, managed_policy_arn,
 def remove_managed_policy_from_perm_set(perm_set_arn, managed_policy_arn, pipeline_id):
     """Remove a managed policy from a permission set"""
     try:
-        remove_managed_policy = ic_admin.detach_managed_policy_from_permission_set(
+        remove_managed_policy = submit_operation(
+            'DetachManagedPolicyFromPermissionSet',
             InstanceArn=ic_instance_arn,
             PermissionSetArn=perm_set_arn,
             ManagedPolicyArn=managed_policy_arn
         )
-        logger.info('Managed Policy %s removed \
-                    from %s', managed_policy_arn, perm_set_arn)
         sleep(0.1)  # Avoid hitting API limit.
     except ic_admin.exceptions.ThrottlingException as error:
         logger.warning("%s.Hit API limits. Sleep 2s...", error)
@@ -351,7 +501,8 @@ def add_cx_managed_policy_to_perm_set(perm_set_arn, policy_name,
                                       policy_path, pipeline_id):
     """Attach a customer managed policy to a permission set"""
     try:
-        attach_cx_managed_policy = ic_admin.attach_customer_managed_policy_reference_to_permission_set(
+        attach_cx_managed_policy = submit_operation(
+            'AttachCustomerManagedPolicyReferenceToPermissionSet',
             InstanceArn=ic_instance_arn,
             PermissionSetArn=perm_set_arn,
             CustomerManagedPolicyReference={
@@ -359,8 +510,6 @@ def add_cx_managed_policy_to_perm_set(perm_set_arn, policy_name,
                 'Path': policy_path
             }
         )
-        logger.info('Customer Managed Policy %s added to %s', policy_path,
-                    perm_set_arn)
         sleep(0.1)  # Aviod hitting API limit.
 
     except ic_admin.exceptions.ThrottlingException as error:
@@ -382,7 +531,8 @@ def remove_cx_managed_policy_from_perm_set(perm_set_arn, policy_name, policy_pat
                                            pipeline_id):
     """Remove a customer managed policy from a permission set"""
     try:
-        remove_cx_managed_policy = ic_admin.detach_customer_managed_policy_reference_from_permission_set(
+        remove_cx_managed_policy = submit_operation(
+            'DetachCustomerManagedPolicyReferenceFromPermissionSet',
             InstanceArn=ic_instance_arn,
             PermissionSetArn=perm_set_arn,
             CustomerManagedPolicyReference={
@@ -390,8 +540,6 @@ def remove_cx_managed_policy_from_perm_set(perm_set_arn, policy_name, policy_pat
                 'Path': policy_path
             }
         )
-        logger.info('Managed Policy %s removed \
-                    from %s', policy_name, perm_set_arn)
         sleep(0.1)  # Avoid hitting API limit.
     except ic_admin.exceptions.ThrottlingException as error:
         logger.warning("%s.Hit API limits. Sleep 2s...", error)
@@ -408,30 +556,19 @@ def remove_cx_managed_policy_from_perm_set(perm_set_arn, policy_name, policy_pat
     return remove_cx_managed_policy
 
 
-def sync_managed_policies(local_managed_policies, perm_set_arn, pipeline_id):
+def sync_managed_policies(local_managed_policies, perm_set_state, pipeline_id):
     """
     Synchronize Managed Polcieis as defined in the JSON file with AWS
     Declare arrays for keeping track on Managed policies locally and on AWS
     """
-    aws_managed_attached_names = []
-    aws_managed_attached_dict = {}
+    perm_set_arn = perm_set_state.arn
+    # Managed polcies attached to the permission set.
+    aws_managed_attached_dict = dict(perm_set_state.managed_policies)
+    aws_managed_attached_names = list(aws_managed_attached_dict)
     local_policy_names = []
     local_policy_dict = {}
 
-    # Get all the managed polcies attached to the permission set.
     try:
-        list_managed_policies = ic_admin.list_managed_policies_in_permission_set(
-            InstanceArn=ic_instance_arn,
-            PermissionSetArn=perm_set_arn
-        )
-        sleep(0.1)  # Aviod hitting API limit.
-
-        # Populate arrays for Managed Policy tracking.
-        for aws_managed_policy in list_managed_policies['AttachedManagedPolicies']:
-            aws_managed_attached_names.append(aws_managed_policy['Name'])
-            aws_managed_attached_dict[aws_managed_policy['Name']
-                                      ] = aws_managed_policy['Arn']
-
         for local_managed_policy in local_managed_policies:
             local_policy_names.append(local_managed_policy['Name'])
             local_policy_dict[local_managed_policy['Name']
@@ -463,30 +600,19 @@ def sync_managed_policies(local_managed_policies, perm_set_arn, pipeline_id):
         )
 
 
-def sync_customer_policies(local_customer_policies, perm_set_arn, pipeline_id):
+def sync_customer_policies(local_customer_policies, perm_set_state, pipeline_id):
     """
     Synchronize customer managed polcies as defined in the JSON file with AWS
     Declare arrays for keeping track on custom policies locally and on AWS
     """
-    customer_managed_attached_names = []
-    customer_managed_attached_dict = {}
+    perm_set_arn = perm_set_state.arn
+    # Customer managed polcies attached to the permission set.
+    customer_managed_attached_dict = dict(perm_set_state.customer_policies)
+    customer_managed_attached_names = list(customer_managed_attached_dict)
     local_policy_names = []
     local_policy_dict = {}
 
-    # Get all the customer managed polcies attached to the permission set.
     try:
-        list_cx_managed_policies = ic_admin.list_customer_managed_policy_references_in_permission_set(
-            InstanceArn=ic_instance_arn,
-            PermissionSetArn=perm_set_arn
-        )
-        sleep(0.1)  # Aviod hitting API limit.
-
-        # Populate arrays for Customer Managed Policy tracking.
-        for cx_managed_policy in list_cx_managed_policies['CustomerManagedPolicyReferences']:
-            customer_managed_attached_names.append(cx_managed_policy['Name'])
-            customer_managed_attached_dict[cx_managed_policy['Name']
-                                           ] = cx_managed_policy['Path']
-
         for local_managed_policy in local_customer_policies:
             local_policy_names.append(local_managed_policy['Name'])
             local_policy_dict[local_managed_policy['Name']
@@ -518,20 +644,16 @@ def sync_customer_policies(local_customer_policies, perm_set_arn, pipeline_id):
         )
 
 
-def remove_inline_policies(perm_set_arn, pipeline_id):
+def remove_inline_policies(perm_set_state, pipeline_id):
     """Remove Inline policies from permission set if they exist"""
+    perm_set_arn = perm_set_state.arn
     try:
-        list_existing_inline = ic_admin.get_inline_policy_for_permission_set(
-            InstanceArn=ic_instance_arn,
-            PermissionSetArn=perm_set_arn
-        )
-
-        if list_existing_inline['InlinePolicy']:
-            ic_admin.delete_inline_policy_from_permission_set(
+        if perm_set_state.inline_policy:
+            submit_operation(
+                'DeleteInlinePolicyFromPermissionSet',
                 InstanceArn=ic_instance_arn,
                 PermissionSetArn=perm_set_arn
             )
-            logger.info('Removed inline policiy for %s', perm_set_arn)
             sleep(0.1)  # Aviod hitting API limit.
     except ic_admin.exceptions.ThrottlingException as error:
         logger.warning(
@@ -549,12 +671,15 @@ def remove_inline_policies(perm_set_arn, pipeline_id):
         )
 
 
-def sync_inline_policies(local_inline_policy, perm_set_arn, pipeline_id):
+def sync_inline_policies(local_inline_policy, perm_set_state, pipeline_id):
     """Synchronize Inline Policies as define in the JSON file with AWS"""
-    if local_inline_policy:
+    perm_set_arn = perm_set_state.arn
+    if local_inline_policy and not inline_policy_differs(local_inline_policy, perm_set_state):
+        logger.debug('Inline policy of %s is up to date', perm_set_arn)
+    elif local_inline_policy:
         try:
-            logger.info('Synchronizing inline policy with %s', perm_set_arn)
-            ic_admin.put_inline_policy_to_permission_set(
+            submit_operation(
+                'PutInlinePolicyToPermissionSet',
                 InstanceArn=ic_instance_arn,
                 PermissionSetArn=perm_set_arn,
                 InlinePolicy=json.dumps(local_inline_policy)
@@ -574,7 +699,7 @@ def sync_inline_policies(local_inline_policy, perm_set_arn, pipeline_id):
                 failureDetails={'message': str(error), 'type': 'JobFailed'}
             )
     else:
-        remove_inline_policies(perm_set_arn, pipeline_id)
+        remove_inline_policies(perm_set_state, pipeline_id)
 
 
 def delete_permission_set(perm_set_arn, perm_set_name, pipeline_id):
@@ -584,7 +709,7 @@ def delete_permission_set(perm_set_arn, perm_set_name, pipeline_id):
             InstanceArn=ic_instance_arn,
             PermissionSetArn=perm_set_arn
         )
-        logger.info('%s Permission set deleted', perm_set_name)
+        record_change('DeletePermissionSet', PermissionSetArn=perm_set_arn, Name=perm_set_name)
         sleep(0.1)  # Aviod hitting API limit.
     except ic_admin.exceptions.ThrottlingException as error:
         logger.warning(
@@ -601,17 +726,20 @@ def delete_permission_set(perm_set_arn, perm_set_name, pipeline_id):
         )
 
 
-def sync_description(perm_set_arn, local_desc, aws_desc, session_duration):
-    """Synchronize the description between the JSON file and AWS service"""
-    if not local_desc == aws_desc:
+def sync_description(perm_set_state, local_desc, session_duration):
+    """Synchronize the description and session duration between the JSON file and AWS service"""
+    perm_set_arn = perm_set_state.arn
+    if settings_differ(local_desc, session_duration, perm_set_state):
         try:
-            logger.info('Updating description for %s', perm_set_arn)
             ic_admin.update_permission_set(
                 InstanceArn=ic_instance_arn,
                 PermissionSetArn=perm_set_arn,
                 SessionDuration=session_duration,
                 Description=local_desc
             )
+            record_change('UpdatePermissionSet', PermissionSetArn=perm_set_arn,
+                          Description=local_desc, SessionDuration=session_duration)
+            perm_set_changes['Updated'].add(perm_set_arn)
             sleep(0.1)  # Aviod hitting API limit.
         except ClientError as error:
             logger.warning("%s", error)
@@ -625,77 +753,47 @@ def tag_permission_set(local_name, local_tags, perm_set_arn):
             ResourceArn=perm_set_arn,
             Tags=local_tags
         )
-        logger.info('Tags added to or updated for %s', local_name)
+        perm_set_changes['Updated'].add(perm_set_arn)
+        record_change('TagResource', PermissionSetArn=perm_set_arn, Name=local_name, Tags=local_tags)
     except ClientError as error:
         logger.error("%s", error)
 
 
-def remove_tag(key, perm_set_arn, local_name):
+def remove_tags(keys, perm_set_arn, local_name):
     """Remove tags from a permission set"""
     try:
         ic_admin.untag_resource(
             InstanceArn=ic_instance_arn,
             ResourceArn=perm_set_arn,
-            TagKeys=[
-                key,
-            ]
+            TagKeys=keys
         )
-        logger.info('Tag removed from %s', local_name)
+        perm_set_changes['Updated'].add(perm_set_arn)
+        record_change('UntagResource', PermissionSetArn=perm_set_arn, Name=local_name, TagKeys=keys)
     except ClientError as error:
         logger.error("%s.", error)
 
 
-def sync_tags(local_name, local_tags, perm_set_arn):
-    """Synchronize the tags between the JSON and AWS"""
-    try:
-        list_tags = ic_admin.list_tags_for_resource(
-            InstanceArn=ic_instance_arn,
-            ResourceArn=perm_set_arn
-        )
-        aws_tags = list_tags['Tags']
-        aws_tag_keys = []
-        aws_tag_dict = {}
-        local_tag_keys = []
-        local_tag_dict = {}
-
-        for tag in aws_tags:
-            aws_tag_keys.append(tag['Key'])
-            aws_tag_dict[tag['Key']] = tag['Value']
-
-        for tag in local_tags:
-            local_tag_keys.append(tag['Key'])
-            local_tag_dict[tag['Key']] = tag['Value']
-
-        if not aws_tags == local_tags:
-            for key in local_tag_keys:
-                if key not in aws_tag_keys or local_tag_dict[key] != aws_tag_dict[key]:
-                    tag_permission_set(local_name, local_tags, perm_set_arn)
+def sync_tags(local_name, local_tags, perm_set_state):
+    """Synchronize the tags between the JSON and AWS with at most one tag and one untag call"""
+    changed_tags, removed_keys = diff_tags(local_tags, perm_set_state)
+    if changed_tags:
+        tag_permission_set(local_name, changed_tags, perm_set_state.arn)
+    if removed_keys:
+        remove_tags(removed_keys, perm_set_state.arn, local_name)
 
-            for key in aws_tag_keys:
-                if key not in local_tag_keys:
-                    remove_tag(key, perm_set_arn, local_name)
-
-    except ic_admin.exceptions.ThrottlingException as error:
-        logger.warning("%s.Hit ListTags API limits. Sleep 3s...", error)
-        sleep(3)
-    except ClientError as error:
-        logger.error("%s", error)
 
-
-def get_accounts_by_perm_set(perm_set_arn):
-    """List all the accounts for a given permission set"""
+def get_accounts_by_perm_set(perm_set_arn, provisioning_status=None):
+    """List all the accounts for a given permission set, or those with the given provisioning status"""
+    params = {'InstanceArn': ic_instance_arn, 'PermissionSetArn': perm_set_arn}
+    if provisioning_status:
+        params['ProvisioningStatus'] = provisioning_status
+    acct_list = []
     try:
-        response = ic_admin.list_accounts_for_provisioned_permission_set(
-            InstanceArn=ic_instance_arn,
-            PermissionSetArn=perm_set_arn
-        )
+        response = ic_admin.list_accounts_for_provisioned_permission_set(**params)
         acct_list = response['AccountIds']
         while 'NextToken' in response:
             response = ic_admin.list_accounts_for_provisioned_permission_set(
-                NextToken=response['NextToken'],
-                InstanceArn=ic_instance_arn,
-                PermissionSetArn=perm_set_arn
-            )
+                NextToken=response['NextToken'], **params)
             acct_list += response['AccountIds']
         logger.debug(acct_list)
     except ic_admin.exceptions.ThrottlingException as error:
@@ -737,8 +835,10 @@ def deprovision_permission_set_from_accounts(perm_set_arn,
 
                 # Remove all of the identified assignments for permission set
                 for assignment in acct_assignments:
-                    logger.info("Deleting assignment for account: %s, principal-type: %s, \
-                                 principal-id: %s", account, assignment['PrincipalType'], assignment['PrincipalId'])
+                    record_change('DeleteAccountAssignment', AccountId=account,
+                                  PermissionSetArn=perm_set_arn,
+                                  PrincipalType=assignment['PrincipalType'],
+                                  PrincipalId=assignment['PrincipalId'])
                     delete_assignment = ic_admin.delete_account_assignment(
                         InstanceArn=ic_instance_arn,
                         TargetId=account,
@@ -770,47 +870,33 @@ def deprovision_permission_set_from_accounts(perm_set_arn,
 
 def reprovision_permission_sets(perm_set_name, perm_set_arn, pipeline_id):
     """Find and re-provision the drifted permission sets"""
-    account_ids = get_accounts_by_perm_set(perm_set_arn)
-    outdated_accounts = []
-
-    # Look through the accounts to see if the permission set is
-    #   not current and populate an array if any outdated one is found.
-    for account in account_ids:
-        try:
-            outdated_perm_sets = ic_admin.list_permission_sets_provisioned_to_account(
-                InstanceArn=ic_instance_arn,
-                AccountId=account,
-                ProvisioningStatus='LATEST_PERMISSION_SET_NOT_PROVISIONED'
-            )
-            sleep(0.1)  # Aviod hitting API limit.
-            if outdated_perm_sets['PermissionSets']:
-                outdated_accounts.append(outdated_perm_sets['PermissionSets'])
-        except ic_admin.exceptions.ThrottlingException as error:
-            logger.warning("%s.Hit API limits. Sleep 5s...", error)
-            sleep(5)
-        except ic_admin.exceptions.ConflictException as error:
-            logger.info("%sThe same IAM Identity Center process has been started \
-                        in another invocation, skipping...", error)
-            sleep(2)
-        except ClientError as error:
-            logger.error("%s", error)
-            pipeline.put_job_failure_result(
-                jobId=pipeline_id,
-                failureDetails={'message': str(error), 'type': 'JobFailed'}
-            )
+    if perm_set_arn in queued_policy_changes:
+        # The queued changes leave the set outdated once they are applied.
+        submit_operation('ProvisionPermissionSet',
+                         InstanceArn=ic_instance_arn,
+                         PermissionSetArn=perm_set_arn,
+                         TargetType='ALL_PROVISIONED_ACCOUNTS')
+        return
+    # One call lists the accounts this permission set is outdated in, whether
+    # this run changed the set or an earlier provisioning failed. One outdated
+    # account is enough, the set is reprovisioned to all of them.
+    outdated_accounts = get_accounts_by_perm_set(
+        perm_set_arn, 'LATEST_PERMISSION_SET_NOT_PROVISIONED')
 
     # If any accounts were found to be out of date - reprovision the permission set to all accounts.
     # This can be done on an account by account level, but we'd have to monitor the status of every provision.
     if outdated_accounts:
         try:
-            logger.info("Reprovisioning %s for the following \
-                        accounts: %s", perm_set_name, account_ids)
-            ic_admin.provision_permission_set(
+            logger.info("Reprovisioning %s, outdated in %s accounts", perm_set_name, len(outdated_accounts))
+            provision = submit_operation(
+                'ProvisionPermissionSet',
                 InstanceArn=ic_instance_arn,
                 PermissionSetArn=perm_set_arn,
                 TargetType='ALL_PROVISIONED_ACCOUNTS'
             )
             sleep(0.1)  # Aviod hitting API limit.
+            if 'Queued' in provision or 'Deferred' in provision:
+                return
 
             # Find any IN_PROGRESS provisioning operations.
             get_provisionsing_status = ic_admin.list_permission_set_provisioning_status(
@@ -846,68 +932,99 @@ def reprovision_permission_sets(perm_set_name, perm_set_arn, pipeline_id):
                 failureDetails={'message': str(error), 'type': 'JobFailed'}
             )
 
-def sync_json_with_aws(local_files, aws_permission_sets, pipeline_id):
-    """Synchronize the repository's json files with the AWS Permission Sets"""
-    local_permission_set_names = []
+def sync_permission_set(local_permission_set, aws_permission_sets, pipeline_id):
+    """
+    Create or update one permission set from its definition and reprovision
+    it if it drifted. Returns False if the permission set could not be created.
+    """
+    local_session_duration = default_session_duration
     local_customer_policies = []
+    local_name = local_permission_set['Name']
+    local_desc = local_permission_set['Description']
+    local_tags = local_permission_set['Tags']
+    local_managed_policies = local_permission_set['ManagedPolicies']
+    local_inline_policy = local_permission_set['InlinePolicies']
+
+    # Customer managed policy is optional
+    if "CustomerPolicies" in local_permission_set.keys():
+        local_customer_policies = local_permission_set['CustomerPolicies']
+    # Session Duration is optional
+    if "Session_Duration" in local_permission_set.keys():
+        local_session_duration = local_permission_set["Session_Duration"]
+
+    # If Permission Set does not exist in AWS - add it.
+    if local_name in aws_permission_sets:
+        logger.debug(
+            '%s exists in IAM Identity Center - checking policy and configuration', local_name)
+    else:
+        created_perm_set = create_permission_set(
+            local_name, local_desc, local_tags, local_session_duration, pipeline_id)
+        if created_perm_set is None:
+            logger.warning("%s was not created; the next run retries it", local_name)
+            return False
+        created_perm_set_name = created_perm_set['PermissionSet']['Name']
+        created_perm_set_arn = created_perm_set['PermissionSet']['PermissionSetArn']
+        created_perm_set_desc = created_perm_set['PermissionSet']['Description']
+        record_change('CreatePermissionSet', PermissionSetArn=created_perm_set_arn,
+                      Name=created_perm_set_name)
+        aws_permission_sets[created_perm_set_name] = {
+            'Arn': created_perm_set_arn,
+            'Description': created_perm_set_desc
+        }
+        perm_set_changes['Created'].add(created_perm_set_arn)
+
+    # Read the current state once and diff every facet against it.
+    perm_set_state = fetch_permission_set_state(
+        ic_admin, ic_instance_arn, aws_permission_sets[local_name]['Arn'],
+        state_executor)
+    # Synchronize managed and inline policies for all local permission sets with AWS.
+    sync_managed_policies(
+        local_managed_policies, perm_set_state, pipeline_id)
+    sync_customer_policies(
+        local_customer_policies, perm_set_state, pipeline_id)
+    sync_inline_policies(
+        local_inline_policy, perm_set_state, pipeline_id)
+    sync_description(perm_set_state, local_desc, local_session_duration)
+    sync_tags(local_name, local_tags, perm_set_state)
+    reprovision_permission_sets(
+            local_name, aws_permission_sets[local_name]['Arn'], pipeline_id)
+    return True
+
+
+def remove_permission_set(perm_set_arn, perm_set_name, pipeline_id):
+    """Deprovision a permission set that has no definition any more and delete it"""
+    deprovision_permission_set_from_accounts(perm_set_arn, perm_set_name, pipeline_id)
+    delete_permission_set(perm_set_arn, perm_set_name, pipeline_id)
+    perm_set_changes['Deleted'].add(perm_set_arn)
+
+
+def sync_json_with_aws(local_files, aws_permission_sets, pipeline_id,
+                       context=None, cursor=None):
+    """Synchronize the repository's json files with the AWS Permission Sets"""
+    phase = cursor['Phase'] if cursor else PERMISSION_SET_PHASES[0]
+    start = cursor['Position'] if cursor and phase == 'sync' else 0
+    local_file_names = sorted(local_files)
+    local_permission_set_names = [local_files[local_file]['Name']
+                                  for local_file in local_file_names]
     try:
-        for local_file in local_files:
-            local_session_duration = default_session_duration
-            local_permission_set = local_files[local_file]
-            local_name = local_permission_set['Name']
-            local_desc = local_permission_set['Description']
-            local_tags = local_permission_set['Tags']
-            local_managed_policies = local_permission_set['ManagedPolicies']
-            local_inline_policy = local_permission_set['InlinePolicies']
-            local_permission_set_names.append(local_name)
-
-            # Customer managed policy is optional
-            if "CustomerPolicies" in local_permission_set.keys():
-                local_customer_policies = local_permission_set['CustomerPolicies']
-            # Session Duration is optional
-            if "Session_Duration" in local_permission_set.keys():
-                local_session_duration = local_permission_set["Session_Duration"]
-
-            # If Permission Set does not exist in AWS - add it.
-            if local_name in aws_permission_sets:
-                logger.info(
-                    '%s exists in IAM Identity Center - checking policy and configuration', local_name)
-            else:
-                logger.info(
-                    'ADD OPERATION: %s does not exist in IAM Identity Center - adding...', local_name)
-                created_perm_set = create_permission_set(
-                    local_name, local_desc, local_tags, local_session_duration, pipeline_id)
-                created_perm_set_name = created_perm_set['PermissionSet']['Name']
-                created_perm_set_arn = created_perm_set['PermissionSet']['PermissionSetArn']
-                created_perm_set_desc = created_perm_set['PermissionSet']['Description']
-                aws_permission_sets[created_perm_set_name] = {
-                    'Arn': created_perm_set_arn,
-                    'Description': created_perm_set_desc
-                }
-
-            # Synchronize managed and inline policies for all local permission sets with AWS.
-            sync_managed_policies(
-                local_managed_policies, aws_permission_sets[local_name]['Arn'], pipeline_id)
-            sync_customer_policies(
-                local_customer_policies, aws_permission_sets[local_name]['Arn'], pipeline_id)
-            sync_inline_policies(
-                local_inline_policy, aws_permission_sets[local_name]['Arn'], pipeline_id)
-            sync_description(aws_permission_sets[local_name]['Arn'], local_desc,
-                             aws_permission_sets[local_name]['Description'], local_session_duration)
-            sync_tags(local_name, local_tags,
-                      aws_permission_sets[local_name]['Arn'])
-            reprovision_permission_sets(
-                    local_name, aws_permission_sets[local_name]['Arn'], pipeline_id)
-
-        # If a permission set exists in AWS but not on the local - delete it
+        if phase == 'sync':
+            for position in range(start, len(local_file_names)):
+                if deadline_reached(context):
+                    raise DeadlineApproaching('sync', position)
+                sync_permission_set(local_files[local_file_names[position]],
+                                    aws_permission_sets, pipeline_id)
+                signal_ready(local_files[local_file_names[position]]['Name'], aws_permission_sets)
+
+        # If a permission set exists in AWS but not on the local - delete it.
+        # Deleted sets drop out of the listing, so a resumed run restarts at 0.
         for aws_perm_set in aws_permission_sets:
             if not aws_perm_set in local_permission_set_names:
-                logger.info(
-                    'DELETE OPERATION: %s does not exist locally - deleting...', aws_perm_set)
-                deprovision_permission_set_from_accounts(
-                        aws_permission_sets[aws_perm_set]['Arn'], aws_perm_set, pipeline_id)
-                delete_permission_set(
+                if deadline_reached(context):
+                    raise DeadlineApproaching('delete', 0)
+                remove_permission_set(
                     aws_permission_sets[aws_perm_set]['Arn'], aws_perm_set, pipeline_id)
+    except DeadlineApproaching:
+        raise
     except Exception as error:
         logger.error("Sync AWS permission sets failed due to %s", error)
         pipeline.put_job_failure_result(
@@ -918,15 +1035,76 @@ def sync_json_with_aws(local_files, aws_permission_sets, pipeline_id):
     return "Synchronized AWS Permission Sets with new updated defination."
 
 
-def invoke_auto_assignment(topic_name, accountid, pipeline_id):
-    """Use SNS topic to invoke auto assignment Lambda function"""
+def get_org_accounts():
+    """Get all accounts of the current AWS Organizations"""
+    response = orgs_client.list_accounts()
+    org_accts = response['Accounts']
+    while 'NextToken' in response:
+        response = orgs_client.list_accounts(
+            NextToken=response['NextToken']
+        )
+        org_accts += response['Accounts']
+    return org_accts
+
+
+def signal_ready(perm_set_name, aws_permission_sets):
+    """Let the assignment function create the assignments of a synced permission set"""
+    if ready_signals is None:
+        return
+    try:
+        ready_signals.signal_ready(perm_set_name, aws_permission_sets[perm_set_name]['Arn'])
+    except ClientError as error:
+        # The final assignment pass creates them instead.
+        logger.warning("Cannot signal %s ready: %s", perm_set_name, error)
+
 
+def start_pipelined_assignments(cursor, pipeline_id, context):
+    """
+    Start the assignment function on the ready signals of this run. It only
+    creates assignments; the pass that follows the sync still reconciles in full.
+    """
+    global ready_signals
+    ready_signals = None
+    if not pipelined_assignments or not pipeline_id:
+        return
+    ready_signals = ReadySignals(s3client, ic_bucket_name, cursor['RunId'])
+    if cursor.get('ReadySignals'):
+        # Started by the first invocation of this run.
+        return
+    cursor['ReadySignals'] = cursor['RunId']
+    accountid = context.invoked_function_arn.split(':')[4]
+    invoke_auto_assignment(sns_topic_name, accountid, 'AWS API Call via CloudTrail', json.dumps({
+        'ConsumeReadySignals': cursor['RunId'],
+        'ForPipelineId': pipeline_id,
+        'Since': int(time())
+    }))
+
+
+def write_handoff_manifest(cursor, aws_permission_sets):
+    """Write the handoff manifest for the assignment function and return its reference"""
+    try:
+        catalog = {name: perm_set['Arn'] for name, perm_set in aws_permission_sets.items()
+                   if perm_set['Arn'] not in perm_set_changes['Deleted']}
+        manifest = build_manifest(cursor['RunId'], catalog, get_org_accounts(),
+                                  perm_set_changes)
+        return write_manifest(s3client, ic_bucket_name, manifest)
+    except Exception as error:
+        # The assignment function enumerates everything itself without a manifest.
+        logger.warning("Cannot write the handoff manifest: %s", error)
+        return None
+
+
+def invoke_auto_assignment(topic_name, accountid, pipeline_id, message=None):
+    """Use SNS topic to invoke auto assignment Lambda function"""
+    if assignment_trigger is not None:
+        assignment_trigger(message or pipeline_id)
+        return
     try:
         topic_arn = 'arn:aws:sns:'+runtime_region + \
             ':'+str(accountid)+':'+topic_name
         response = sns_client.publish(
             TopicArn=topic_arn,
-            Message=pipeline_id
+            Message=message or pipeline_id
         )
         logger.info("%s", response)
     except Exception as error:
@@ -940,6 +1118,204 @@ def invoke_auto_assignment(topic_name, accountid, pipeline_id):
             )
 
 
+def finish_change_report():
+    """Upload the change report of this invocation; a failed upload does not fail the run"""
+    global change_report
+    report, change_report = change_report, None
+    if report is None:
+        return
+    try:
+        report.upload(s3client, ic_bucket_name)
+    except Exception as error:
+        logger.warning("Cannot upload the change report: %s", error)
+        report.discard()
+
+
+def reset_run_state():
+    """Forget the changes, queued operations and ready signals of an earlier run in this warm container"""
+    global ready_signals
+    queued_policy_changes.clear()
+    for arns in perm_set_changes.values():
+        arns.clear()
+    ready_signals = None
+    if operation_queue is not None:
+        operation_queue.start_run()
+
+
+def run_permission_set_sync(cursor, pipeline_id, context):
+    """Synchronize permission sets from the cursor phase and invoke the assignment function"""
+    global change_report
+    reset_run_state()
+    change_report = ChangeReport('auto-permissionsets', cursor['RunId'], report_part(cursor))
+    try:
+        if operation_ledger is not None and cursor['Invocation'] == 1:
+            replay_failed_operations()
+        keys = definition_keys(cursor.get('Entities', []))
+        if keys and cursor['Invocation'] == 1:
+            # S3 events named the definitions that changed; leave the others alone.
+            handed_over = sync_definitions_and_hand_over(cursor, keys, context)
+            if handed_over is not None:
+                return handed_over
+        return sync_and_hand_over(cursor, pipeline_id, context)
+    finally:
+        logger.info("Permission set changes in this invocation: %s", change_report.summary())
+        finish_change_report()
+
+
+def sync_and_hand_over(cursor, pipeline_id, context):
+    """Synchronize permission sets and invoke the assignment function. Returns False on hand-off."""
+    if delegated == "true":
+        aws_permission_sets = get_all_permission_sets_if_delegate(pipeline_id)
+    else:
+        aws_permission_sets = get_all_permission_sets(pipeline_id)
+    logger.info("The existing aws_permission_sets are : %s",
+                bounded(sorted(aws_permission_sets)))
+    # Get the permission set's baseline by loading S3 bucket files
+    json_files = get_all_json_files(ic_bucket_name, pipeline_id)
+    for kind, arns in perm_set_changes.items():
+        # Changes of earlier invocations of this run, on top of those replayed from the ledger.
+        arns.update(cursor.get('Changes', {}).get(kind, []))
+    start_pipelined_assignments(cursor, pipeline_id, context)
+    try:
+        sync_json_with_aws(json_files, aws_permission_sets, pipeline_id,
+                           context, cursor)
+    except DeadlineApproaching as deadline:
+        logger.warning("%s. Saving progress and continuing in a new invocation.", deadline)
+        if operation_queue is not None:
+            operation_queue.flush()
+        cursor['Changes'] = {kind: sorted(arns) for kind, arns in perm_set_changes.items()}
+        key = save_checkpoint(s3client, ic_bucket_name,
+                              advance_cursor(cursor, deadline))
+        if pipeline_id:
+            continue_in_pipeline(pipeline, pipeline_id, key)
+        else:
+            continue_by_self_invocation(lambda_client, context.function_name, key)
+        return False
+    if operation_queue is not None:
+        logger.info("Queued %s permission set operations", operation_queue.flush())
+    delete_checkpoint(s3client, ic_bucket_name, cursor)
+    # Invoke Next automation lambda function
+    logger.info("Published sns topic to invoke auto assignment function. \
+                Check the auto assignment lambda funcion log for further execution details.")
+    accountid = context.invoked_function_arn.split(':')[4]
+    message = {
+        'Manifest': write_handoff_manifest(cursor, aws_permission_sets),
+        'ChangeReport': run_report_prefix('auto-permissionsets', cursor['RunId'])
+    }
+    if ready_signals is not None:
+        # The final pass skips the creates the assignment function already made.
+        message['ReadySignals'] = cursor['RunId']
+        try:
+            ready_signals.signal_complete()
+        except ClientError as error:
+            logger.warning("Cannot signal the sync complete: %s", error)
+    if pipeline_id:
+        message['PipelineId'] = pipeline_id
+        # The assignment function reports its result to these jobs as well.
+        message['WaitingPipelineIds'] = cursor.get('WaitingPipelineIds', [])
+        invoke_auto_assignment(sns_topic_name, accountid, pipeline_id, json.dumps(message))
+    else:
+        message['Entities'] = cursor.get('Entities', [])
+        invoke_auto_assignment(sns_topic_name, accountid, 'AWS API Call via CloudTrail',
+                               json.dumps(message))
+    return True
+
+
+def sync_definitions_and_hand_over(cursor, keys, context):
+    """
+    Sync only the permission sets whose definition objects were created or
+    removed and hand their ARNs to the assignment function. Returns None if
+    the run has to fall back to a full sync.
+    """
+    previous = read_manifest(s3client, ic_bucket_name, {'Key': HANDOFF_MANIFEST_KEY})
+    if previous is None:
+        logger.info("No handoff manifest to resolve permission set names from, syncing in full.")
+        return None
+    aws_permission_sets = {name: {'Arn': arn} for name, arn in previous['PermissionSets'].items()}
+    try:
+        for key in keys:
+            definition = read_definition(s3client, ic_bucket_name, key)
+            former = previous_definition(s3client, ic_bucket_name, key, definition is not None)
+            if definition is not None:
+                logger.info("Syncing %s from %s", definition['Name'], key)
+                if not sync_permission_set(definition, aws_permission_sets, ''):
+                    # A stale manifest may not list a permission set that exists by now.
+                    logger.warning("Cannot create %s on its own, syncing in full.", definition['Name'])
+                    return None
+            if (former is None or former['Name'] not in aws_permission_sets or
+                    (definition is not None and former['Name'] == definition['Name'])):
+                continue
+            # The object was removed or renames its permission set.
+            if defined_elsewhere(s3client, ic_bucket_name, former['Name'], key):
+                logger.info("%s is still defined by another object", former['Name'])
+                continue
+            remove_permission_set(aws_permission_sets[former['Name']]['Arn'], former['Name'], '')
+            del aws_permission_sets[former['Name']]
+    except (ClientError, KeyError, ValueError) as error:
+        logger.warning("Cannot sync the changed definitions on their own, syncing in full: %s", error)
+        return None
+    if operation_queue is not None:
+        logger.info("Queued %s permission set operations", operation_queue.flush())
+    changed_arns = sorted(set().union(*perm_set_changes.values()))
+    if not changed_arns:
+        logger.info("The changed definitions match IAM Identity Center; no assignment run is needed.")
+        return True
+    try:
+        manifest = build_manifest(cursor['RunId'],
+                                  {name: perm_set['Arn'] for name, perm_set in aws_permission_sets.items()},
+                                  previous['Accounts'], perm_set_changes)
+        reference = write_manifest(s3client, ic_bucket_name, manifest)
+    except ClientError as error:
+        logger.warning("Cannot write the handoff manifest: %s", error)
+        reference = None
+    accountid = context.invoked_function_arn.split(':')[4]
+    invoke_auto_assignment(sns_topic_name, accountid, 'AWS API Call via CloudTrail', json.dumps({
+        'Manifest': reference,
+        'ChangeReport': run_report_prefix('auto-permissionsets', cursor['RunId']),
+        'Entities': cursor.get('Entities', []) + [f"PermissionSet:{arn}" for arn in changed_arns]
+    }))
+    return True
+
+
+def run_single_flight(cursor, pipeline_id, context):
+    """
+    Run the permission set sync under the single-flight lock. A run that finds
+    the lock held leaves a rerun request instead, and the holder serves it
+    with one more pass before releasing.
+    """
+    global active_lock
+    if not run_lock_table_name:
+        run_permission_set_sync(cursor, pipeline_id, context)
+        return
+    lock = LeaseLock(dynamodb, run_lock_table_name, 'auto-permissionsets', cursor['RunId'])
+    if not lock.acquire_or_request_rerun(pipeline_id):
+        return
+    active_lock = lock
+    try:
+        while True:
+            if not run_permission_set_sync(cursor, pipeline_id, context):
+                lock.suspend(HANDOFF_LEASE_SECONDS)
+                return
+            rerun = lock.release()
+            if rerun is None:
+                return
+            # The rerun pass serves requests that may each have scoped a different
+            # change, so it runs in full instead of merging them: the new cursor has
+            # no Entities, so it syncs every definition and hands the full set over.
+            cursor = new_cursor('auto-permissionsets', '', PERMISSION_SET_PHASES[0])
+            cursor['PipelineId'] = pipeline_id = serve_rerun(rerun, cursor)
+            cursor['RunId'] = lock.owner
+    except BaseException as error:
+        # Let the lease lapse now; a pending rerun request stays for the next run.
+        lock.suspend(0)
+        report_waiting_jobs(pipeline, cursor, str(error))
+        raise
+    finally:
+        active_lock = None
+
+
+@recorded(api_recorder, s3client, ic_bucket_name)
+@profiled('auto-permissionsets', s3client, ic_bucket_name, profiling_enabled, profile_top_n)
 def lambda_handler(event, context):
     """Lambda_handler"""
     logger.info(event)
@@ -948,30 +1324,55 @@ def lambda_handler(event, context):
 
     pipeline_id = ""
 
+    if is_operation_batch(event):
+        return process_operation_batch(event, OPERATION_EXECUTORS)
+
     if 'RequestType' in event and event['RequestType'] == 'Delete':
         cfnresponse.send(event, context, cfnresponse.SUCCESS, {})
 
+    elif 'ResumeCheckpoint' in event:
+        try:
+            cursor = load_checkpoint(s3client, ic_bucket_name, event['ResumeCheckpoint'])
+            if cursor is None:
+                cursor = new_cursor('auto-permissionsets', pipeline_id, PERMISSION_SET_PHASES[0])
+            run_single_flight(cursor, cursor['PipelineId'], context)
+        except Exception as error:
+            logger.error("%s", error)
+
+    elif is_window_flush(event):
+        try:
+            entities = flush_window(dynamodb, event_coalescing_table_name, flushed_window_id(event))
+            if entities is None:
+                return
+            print("The automation process is now started. This event window was flushed from SQS")
+            cursor = new_cursor('auto-permissionsets', pipeline_id, PERMISSION_SET_PHASES[0])
+            cursor['Entities'] = entities
+            run_single_flight(cursor, pipeline_id, context)
+        except Exception as error:
+            logger.error("%s", error)
+
     elif 'CodePipeline.job' in event:
         try:
             pipeline_id = event['CodePipeline.job']['id']
             logger.info("The automation process is now started. %s",
                         str(pipeline_id))
-            if delegated == "true":
-                aws_permission_sets = get_all_permission_sets_if_delegate(pipeline_id)
-                logger.info("The existing aws_permission_sets are : %s",
-                        aws_permission_sets)
+            continuation_token = event['CodePipeline.job'].get(
+                'data', {}).get('continuationToken')
+            cursor = None
+            if continuation_token:
+                cursor = load_checkpoint(s3client, ic_bucket_name, continuation_token)
+            if cursor is not None and cursor['Function'] == 'auto-assignment':
+                # The assignment function ran out of time; forward the token to it.
+                accountid = context.invoked_function_arn.split(':')[4]
+                invoke_auto_assignment(sns_topic_name, accountid, pipeline_id, json.dumps({
+                    'PipelineId': pipeline_id,
+                    'ResumeCheckpoint': continuation_token
+                }))
             else:
-                aws_permission_sets = get_all_permission_sets(pipeline_id)
-                logger.info("The existing aws_permission_sets are : %s",
-                        aws_permission_sets)
-            # Get the permission set's baseline by loading S3 bucket files
-            json_files = get_all_json_files(ic_bucket_name, pipeline_id)
-            sync_json_with_aws(json_files, aws_permission_sets, pipeline_id)
-            # Invoke Next automation lambda function
-            logger.info("Published sns topic to invoke auto assignment function. \
-                        Check the auto assignment lambda funcion log for further execution details.")
-            accountid = context.invoked_function_arn.split(':')[4]
-            invoke_auto_assignment(sns_topic_name, accountid, pipeline_id)
+                if cursor is None:
+                    cursor = new_cursor('auto-permissionsets', pipeline_id, PERMISSION_SET_PHASES[0])
+                cursor['PipelineId'] = pipeline_id
+                run_single_flight(cursor, pipeline_id, context)
 
         except Exception as error:
             logger.error("%s", error)
@@ -980,30 +1381,30 @@ def lambda_handler(event, context):
                 failureDetails={'message': str(error), 'type': 'JobFailed'}
             )
 
-    elif event['detail-type'] == 'AWS API Call via CloudTrail':
-        sleep(10)
-        event_detail_type = event['detail-type']
+    elif event['detail-type'] in ('AWS API Call via CloudTrail', 'Object Created', 'Object Deleted'):
         try:
-            print("The automation process is now started. This event is triggered by EventBridge")
-            if delegated == "true":
-                aws_permission_sets = get_all_permission_sets_if_delegate(pipeline_id)
-                logger.info("The existing aws_permission_sets are : %s",
-                        aws_permission_sets)
+            if group_directory_table_name and event['detail'].get('eventName') in DIRECTORY_EVENTS:
+                # Patch the group directory before this event is coalesced with others.
+                try:
+                    apply_directory_event(dynamodb, group_directory_table_name, event)
+                except ClientError as error:
+                    logger.warning("Cannot update the group directory: %s", error)
+            if event_coalescing_table_name and event_window_queue_url:
+                # Only the flush of each window of events runs the reconciliation.
+                entities = coalesce_event(dynamodb, event_coalescing_table_name, sqs_client,
+                                          event_window_queue_url, event,
+                                          event_coalescing_window_seconds)
+                if entities is None:
+                    return
+            elif event['detail-type'] != 'AWS API Call via CloudTrail':
+                entities = sorted(event_entities(event))
             else:
-                aws_permission_sets = get_all_permission_sets(pipeline_id)
-                logger.info("The existing aws_permission_sets are : %s",
-                        aws_permission_sets)
-            # Get the permission set's baseline by loading S3 bucket files
-            json_files = get_all_json_files(ic_bucket_name, pipeline_id)
-            sync_json_with_aws(json_files, aws_permission_sets, pipeline_id)
-            # Invoke Next automation lambda function
-            print("Published sns topic to invoke auto assignment function.")
-            logger.info("Published sns topic to invoke auto assignment function. \
-                        Check the auto assignment lambda funcion log for further execution details.")
-            accountid = context.invoked_function_arn.split(':')[4]
-            print(f"Account ID: {accountid}")
-            print(f"SNS Topic Name: {sns_topic_name}")
-            invoke_auto_assignment(sns_topic_name, accountid, event_detail_type)
+                sleep(10)
+                entities = []
+            print("The automation process is now started. This event is triggered by EventBridge")
+            cursor = new_cursor('auto-permissionsets', pipeline_id, PERMISSION_SET_PHASES[0])
+            cursor['Entities'] = entities
+            run_single_flight(cursor, pipeline_id, context)
 
         except Exception as error:
             logger.error("%s", error)
@@ -0,0 +1,85 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+# pylint: disable=C0301
+# pylint: disable=W1202,W0703
+# pylint: disable=E0401
+###########################################################################
+# Permission set definition objects named by S3 events. An event run     #
+# syncs only the definitions whose objects were created or removed; the  #
+# previous object version tells which permission set a removed or        #
+# renamed definition used to describe.                                   #
+###########################################################################
+import json
+import logging
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+DEFINITION_PREFIX = 'permission-sets/'
+# Coalesced event names of the S3 object events EventBridge delivers.
+OBJECT_EVENTS = {'ObjectCreated', 'ObjectDeleted'}
+
+
+def definition_keys(entities):
+    """
+    Return the definition object keys of an event run, or None if any of
+    its events is not a definition object event and it must sync in full.
+    """
+    event_names = {entity.split(':', 1)[1] for entity in entities
+                   if entity.startswith('Event:')}
+    keys = sorted(entity.split(':', 1)[1] for entity in entities
+                  if entity.startswith('Object:'))
+    if not event_names or not event_names <= OBJECT_EVENTS:
+        return None
+    if not all(key.startswith(DEFINITION_PREFIX) and key.endswith('.json') for key in keys):
+        return None
+    return keys
+
+
+def read_definition(s3client, bucket_name, key):
+    """Return the current definition in an object, or None if the object was removed"""
+    try:
+        response = s3client.get_object(Bucket=bucket_name, Key=key)
+    except ClientError as error:
+        if error.response['Error']['Code'] in ('NoSuchKey', 'NotFound'):
+            return None
+        raise
+    return json.loads(response['Body'].read())
+
+
+def previous_definition(s3client, bucket_name, key, current_exists):
+    """
+    Return the definition the object held before its latest change, or None.
+    That is the newest version of a removed object, or the version before
+    the newest one of an object that still exists.
+    """
+    versions = []
+    params = {'Bucket': bucket_name, 'Prefix': key}
+    while True:
+        response = s3client.list_object_versions(**params)
+        versions += [version for version in response.get('Versions', []) if version['Key'] == key]
+        if not response.get('IsTruncated'):
+            break
+        params['KeyMarker'] = response['NextKeyMarker']
+        params['VersionIdMarker'] = response['NextVersionIdMarker']
+    versions.sort(key=lambda version: version['LastModified'], reverse=True)
+    versions = versions[1:] if current_exists else versions
+    for version in versions:
+        try:
+            response = s3client.get_object(Bucket=bucket_name, Key=key, VersionId=version['VersionId'])
+            return json.loads(response['Body'].read())
+        except (ClientError, ValueError) as error:
+            logger.warning("Cannot read version %s of %s: %s", version['VersionId'], key, error)
+    return None
+
+
+def defined_elsewhere(s3client, bucket_name, perm_set_name, key):
+    """Return True if a definition object other than key defines the permission set"""
+    paginator = s3client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=DEFINITION_PREFIX):
+        for s3_object in page.get('Contents', []):
+            if s3_object['Key'] == key or not s3_object['Key'].endswith('.json'):
+                continue
+            definition = read_definition(s3client, bucket_name, s3_object['Key'])
+            if definition is not None and definition.get('Name') == perm_set_name:
+                return True
+    return False
@@ -0,0 +1,184 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+# pylint: disable=C0301
+# pylint: disable=W1202,W0703
+# pylint: disable=E0401
+###########################################################################
+# Coalesce bursts of EventBridge triggers into one reconciliation.        #
+# Every event is recorded in the open window item. The invocation that   #
+# opened the window schedules its flush as a delayed SQS message and     #
+# exits, like the others. The flush closes the window and runs once with  #
+# the entities of every event recorded in the meantime, or as a full run  #
+# once the window holds more entities than fit in one item comfortably.   #
+###########################################################################
+import json
+import uuid
+import time
+import logging
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+OPEN_WINDOW_KEY = 'open-window'
+# An opener that has not closed its window this long after it elapsed has failed.
+STALE_WINDOW_GRACE_SECONDS = 120
+# Entities kept per window; beyond this the window runs a full reconciliation.
+# Well below the 400 KB DynamoDB item limit at about 100 bytes per entity.
+MAX_WINDOW_ENTITIES = 1000
+# requestParameters keys that identify the IAM Identity Center or Organizations entity an event touched.
+ENTITY_PARAMETERS = {
+    'permissionSetArn': 'PermissionSet',
+    'targetId': 'Account',
+    'accountId': 'Account',
+    'principalId': 'Principal',
+    'groupId': 'Group',
+    'target': 'Account'
+}
+
+
+def event_entities(event):
+    """Extract the affected entities of a CloudTrail event as 'Type:Id' strings"""
+    detail = event.get('detail', {})
+    # S3 object events name their type in detail-type, such as "Object Created".
+    event_name = detail.get('eventName') or event.get('detail-type', 'Unknown').replace(' ', '')
+    entities = {f"Event:{event_name}"}
+    if (detail.get('object') or {}).get('key'):
+        entities.add(f"Object:{detail['object']['key']}")
+    if detail.get('eventSource'):
+        entities.add(f"Source:{detail['eventSource']}")
+    parameters = detail.get('requestParameters') or {}
+    for key, entity_type in ENTITY_PARAMETERS.items():
+        value = parameters.get(key)
+        if isinstance(value, dict):
+            value = value.get('id') or value.get('Id')
+        if isinstance(value, str) and value:
+            entities.add(f"{entity_type}:{value}")
+    return entities
+
+
+def record_event(dynamodb_client, table_name, entities, window_seconds):
+    """
+    Add the entities to the open window, opening one if needed.
+    Returns the window id and whether it is due now: a new window is
+    returned not due, a stale one due. Returns None, False otherwise.
+    """
+    candidate_id = str(uuid.uuid4())
+    now = int(time.time())
+    values = {
+        ':window_id': {'S': candidate_id},
+        ':now': {'N': str(now)},
+        ':one': {'N': '1'}
+    }
+    opening = ('SET window_id = if_not_exists(window_id, :window_id), '
+               'opened_at = if_not_exists(opened_at, :now)')
+    try:
+        response = dynamodb_client.update_item(
+            TableName=table_name,
+            Key={'window_key': {'S': OPEN_WINDOW_KEY}},
+            UpdateExpression=opening + ' ADD event_count :one, entities :entities',
+            ConditionExpression='attribute_not_exists(full_run) AND '
+                                '(attribute_not_exists(entities) OR size(entities) < :cap)',
+            ExpressionAttributeValues=dict(values, **{
+                ':entities': {'SS': sorted(entities)},
+                ':cap': {'N': str(MAX_WINDOW_ENTITIES)}
+            }),
+            ReturnValues='ALL_NEW'
+        )
+    except ClientError as error:
+        if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        # The window is full: stop collecting entities and run in full instead.
+        response = dynamodb_client.update_item(
+            TableName=table_name,
+            Key={'window_key': {'S': OPEN_WINDOW_KEY}},
+            UpdateExpression=opening + ', full_run = :true ADD event_count :one REMOVE entities',
+            ExpressionAttributeValues=dict(values, **{':true': {'BOOL': True}}),
+            ReturnValues='ALL_NEW'
+        )
+    window_id = response['Attributes']['window_id']['S']
+    if window_id == candidate_id:
+        return window_id, False
+    if now - int(response['Attributes']['opened_at']['N']) > window_seconds + STALE_WINDOW_GRACE_SECONDS:
+        # The flush of this window never ran. Take its events over so they
+        # are not stuck behind a window nobody closes.
+        logger.warning("Event window %s is stale, taking it over", window_id)
+        return window_id, True
+    return None, False
+
+
+def close_window(dynamodb_client, table_name, window_id):
+    """
+    Close a window and return its event count and entities. The entities
+    are empty when the window overflowed and needs a full run.
+    """
+    try:
+        response = dynamodb_client.delete_item(
+            TableName=table_name,
+            Key={'window_key': {'S': OPEN_WINDOW_KEY}},
+            ConditionExpression='window_id = :window_id',
+            ExpressionAttributeValues={':window_id': {'S': window_id}},
+            ReturnValues='ALL_OLD'
+        )
+    except ClientError as error:
+        if error.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            logger.warning("Event window %s was closed by another invocation", window_id)
+            return 0, []
+        raise
+    attributes = response.get('Attributes', {})
+    if attributes.get('full_run', {}).get('BOOL'):
+        logger.info("Event window %s overflowed %s entities; running a full reconciliation",
+                    window_id, MAX_WINDOW_ENTITIES)
+        return int(attributes['event_count']['N']), []
+    return int(attributes['event_count']['N']), sorted(attributes['entities']['SS'])
+
+
+def flush_window(dynamodb_client, table_name, window_id):
+    """
+    Close a window whose flush is due. Returns the coalesced entities to run
+    the reconciliation for, or None when there is nothing left to run.
+    """
+    event_count, entities = close_window(dynamodb_client, table_name, window_id)
+    if event_count == 0:
+        return None
+    logger.info("Coalesced %s events into one reconciliation. Affected entities: %s",
+                event_count, entities)
+    return entities
+
+
+def is_window_flush(event):
+    """Return True if the event is the delayed SQS message that flushes an event window"""
+    records = event.get('Records') or []
+    if not records or records[0].get('eventSource') != 'aws:sqs':
+        return False
+    try:
+        return 'FlushEventWindow' in json.loads(records[0]['body'])
+    except (ValueError, KeyError):
+        return False
+
+
+def flushed_window_id(event):
+    """Return the window id carried by a flush message"""
+    return json.loads(event['Records'][0]['body'])['FlushEventWindow']
+
+
+def coalesce_event(dynamodb_client, table_name, sqs_client, queue_url, event, window_seconds):
+    """
+    Debounce one EventBridge event.
+    Returns the coalesced entities when this invocation must run the
+    reconciliation for a stale window, otherwise None: either another
+    invocation opened the window, or this one scheduled its flush.
+    """
+    window_id, due = record_event(dynamodb_client, table_name, event_entities(event),
+                                  window_seconds)
+    if window_id is None:
+        logger.info("Event recorded in the open window; its reconciliation runs when the window is flushed.")
+        return None
+    if due:
+        return flush_window(dynamodb_client, table_name, window_id)
+    # SQS delays a message by up to 900 seconds, more than the longest window.
+    sqs_client.send_message(
+        QueueUrl=queue_url,
+        MessageBody=json.dumps({'FlushEventWindow': window_id}),
+        DelaySeconds=window_seconds
+    )
+    logger.info("Opened event window %s, flushing it in %ss", window_id, window_seconds)
+    return None
@@ -0,0 +1,111 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+# pylint: disable=C0301
+# pylint: disable=W1202,W0703
+# pylint: disable=E0401
+###########################################################################
+# Current state of a permission set in IAM Identity Center.               #
+# Every facet (description, managed policies, customer managed policy    #
+# references, inline policy and tags) is read concurrently with full     #
+# pagination into one immutable snapshot the sync functions diff against.#
+# Policies, tags and durations are canonicalized before they are        #
+# compared, so only real differences cause a write.                      #
+###########################################################################
+import re
+import json
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger()
+
+DURATION_PATTERN = re.compile(r'^PT(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?$')
+
+# managed_policies is a tuple of (Name, Arn), customer_policies of (Name, Path)
+# and tags of (Key, Value) pairs, each sorted. inline_policy is the policy
+# document string, empty if the permission set has none.
+PermissionSetState = namedtuple('PermissionSetState', [
+    'arn', 'name', 'description', 'session_duration', 'managed_policies',
+    'customer_policies', 'inline_policy', 'tags'
+])
+
+
+def _paginate(method, result_key, **params):
+    """Collect every page of a NextToken paginated sso-admin list call"""
+    response = method(**params)
+    items = response[result_key]
+    while 'NextToken' in response:
+        response = method(NextToken=response['NextToken'], **params)
+        items += response[result_key]
+    return items
+
+
+def fetch_permission_set_state(ic_admin, instance_arn, perm_set_arn, executor):
+    """Read every facet of one permission set concurrently and return a PermissionSetState"""
+    params = {'InstanceArn': instance_arn, 'PermissionSetArn': perm_set_arn}
+    describe = executor.submit(ic_admin.describe_permission_set, **params)
+    managed = executor.submit(_paginate, ic_admin.list_managed_policies_in_permission_set,
+                              'AttachedManagedPolicies', **params)
+    customer = executor.submit(_paginate, ic_admin.list_customer_managed_policy_references_in_permission_set,
+                               'CustomerManagedPolicyReferences', **params)
+    inline = executor.submit(ic_admin.get_inline_policy_for_permission_set, **params)
+    tags = executor.submit(_paginate, ic_admin.list_tags_for_resource, 'Tags',
+                           InstanceArn=instance_arn, ResourceArn=perm_set_arn)
+    permission_set = describe.result()['PermissionSet']
+    return PermissionSetState(
+        arn=perm_set_arn,
+        name=permission_set['Name'],
+        description=permission_set.get('Description', ''),
+        session_duration=permission_set.get('SessionDuration'),
+        managed_policies=tuple(sorted((policy['Name'], policy['Arn'])
+                                      for policy in managed.result())),
+        customer_policies=tuple(sorted((policy['Name'], policy.get('Path', '/'))
+                                       for policy in customer.result())),
+        inline_policy=inline.result().get('InlinePolicy', ''),
+        tags=tuple(sorted((tag['Key'], tag['Value']) for tag in tags.result()))
+    )
+
+
+def canonical_policy(document):
+    """Normalize a policy document (string or parsed JSON) so equal policies compare equal"""
+    if not document:
+        return ''
+    if isinstance(document, str):
+        document = json.loads(document)
+    if isinstance(document, dict) and isinstance(document.get('Statement'), dict):
+        # A single statement object is the same policy as a list holding it.
+        document = dict(document, Statement=[document['Statement']])
+    return json.dumps(document, sort_keys=True, separators=(',', ':'))
+
+
+def canonical_tags(tags):
+    """Turn a tag list ({'Key','Value'} dicts or (Key, Value) pairs) into an order-insensitive map"""
+    return {tag['Key']: tag['Value'] for tag in tags} if tags and isinstance(tags[0], dict) else dict(tags)
+
+
+def canonical_duration(duration):
+    """Convert an ISO 8601 session duration such as PT1H30M into seconds"""
+    match = DURATION_PATTERN.match(duration or '')
+    if not match:
+        return duration
+    hours, minutes, seconds = (int(part or 0) for part in match.groups())
+    return hours * 3600 + minutes * 60 + seconds
+
+
+def inline_policy_differs(local_inline_policy, perm_set_state):
+    """Return True if the local inline policy is not the one attached to the permission set"""
+    return canonical_policy(local_inline_policy) != canonical_policy(perm_set_state.inline_policy)
+
+
+def settings_differ(local_desc, session_duration, perm_set_state):
+    """Return True if the description or session duration of the permission set differ"""
+    return ((local_desc or '') != (perm_set_state.description or '') or
+            canonical_duration(session_duration) != canonical_duration(perm_set_state.session_duration))
+
+
+def diff_tags(local_tags, perm_set_state):
+    """Return the tags to add or update and the tag keys to remove"""
+    local_tag_map = canonical_tags(local_tags)
+    aws_tag_map = canonical_tags(perm_set_state.tags)
+    changed = [{'Key': key, 'Value': value} for key, value in sorted(local_tag_map.items())
+               if aws_tag_map.get(key) != value]
+    removed = sorted(key for key in aws_tag_map if key not in local_tag_map)
+    return changed, removed
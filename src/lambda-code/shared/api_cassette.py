@@ -0,0 +1,336 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+# pylint: disable=C0301
+# pylint: disable=W1202,W0703
+# pylint: disable=E0401
+###########################################################################
+# Record and replay of the API traffic of an invocation. The recorder    #
+# hooks the botocore events of the default session and writes every call #
+# with its parameters, response, status and timing to a gzip JSON Lines  #
+# cassette, optionally with the account, instance, permission set and    #
+# identity store ids replaced by stable pseudonyms. The player answers   #
+# the same calls from cassettes offline, as fast as possible or at the   #
+# recorded pace divided by a speed factor.                               #
+###########################################################################
+import io
+import os
+import re
+import gzip
+import json
+import time
+import base64
+import hashlib
+import logging
+import datetime
+import functools
+import threading
+from collections import defaultdict, deque
+import boto3
+from botocore.awsrequest import AWSResponse
+from botocore.response import StreamingBody
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+CASSETTE_PREFIX = 'automation-state/cassettes/'
+CASSETTE_VERSION = 1
+# Settings recorded in the cassette header, so a replay runs with the recorded configuration.
+RECORDED_SETTINGS = ('Lambda_Region', 'IC_InstanceArn', 'IdentityStore_Id', 'IC_S3_BucketName',
+                     'GlobalFileName', 'TargetFileName', 'Org_Management_Account',
+                     'AdminDelegated', 'SNS_Topic_Name', 'Session_Duration')
+# Parameters that differ between runs of the same workload and are not matched on replay.
+VOLATILE_PARAMS = {'Body', 'ClientToken', 'ClientRequestToken'}
+# Ids replaced by pseudonyms; only the first group of each pattern is replaced.
+ANONYMIZED_IDS = [
+    re.compile(r'(?<![0-9])([0-9]{12})(?![0-9])'),
+    re.compile(r'ssoins-([0-9a-f]{16})'),
+    re.compile(r'ps-([0-9a-f]{16})'),
+    re.compile(r'(?<![0-9A-Za-z-])d-([0-9a-f]{10})(?![0-9a-f])'),
+    re.compile(r'([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})')
+]
+MISSING_ERROR_CODE = 'CassetteMiss'
+
+
+def default_session():
+    """Return the boto3 default session, creating it if needed, so hooks reach every client"""
+    if boto3.DEFAULT_SESSION is None:
+        boto3.setup_default_session()
+    return boto3.DEFAULT_SESSION
+
+
+def encode_value(value):
+    """Convert a request or response value into JSON compatible data"""
+    if isinstance(value, dict):
+        return {key: encode_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [encode_value(item) for item in value]
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, (bytes, bytearray)):
+        return {'__bytes__': base64.b64encode(value).decode('ascii')}
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+def decode_value(value):
+    """Reverse encode_value"""
+    if isinstance(value, dict):
+        if '__datetime__' in value:
+            return datetime.datetime.fromisoformat(value['__datetime__'])
+        if '__bytes__' in value:
+            return base64.b64decode(value['__bytes__'])
+        return {key: decode_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [decode_value(item) for item in value]
+    return value
+
+
+def call_key(service_name, operation_name, params):
+    """Key that matches a replayed call to a recorded one"""
+    stable = {key: value for key, value in params.items() if key not in VOLATILE_PARAMS}
+    return f"{service_name}.{operation_name}:{json.dumps(stable, sort_keys=True)}"
+
+
+class Anonymizer:
+    """Replace ids with pseudonyms that are stable for one salt, in strings and text bodies"""
+
+    def __init__(self, salt):
+        self.salt = salt
+
+    def _pseudonym(self, match):
+        value = match.group(1)
+        digest = hashlib.sha256((self.salt + value).encode('utf-8')).hexdigest()
+        digits = str(int(digest, 16))
+        replaced = ''.join(
+            char if char == '-' else (digits[index] if value.isdigit() else digest[index])
+            for index, char in enumerate(value))
+        whole = match.group(0)
+        start = match.start(1) - match.start(0)
+        return whole[:start] + replaced + whole[start + len(value):]
+
+    def text(self, value):
+        """Anonymize the ids in one string"""
+        for pattern in ANONYMIZED_IDS:
+            value = pattern.sub(self._pseudonym, value)
+        return value
+
+    def value(self, value):
+        """Anonymize the ids in encoded request or response data"""
+        if isinstance(value, str):
+            return self.text(value)
+        if isinstance(value, list):
+            return [self.value(item) for item in value]
+        if isinstance(value, dict):
+            if '__bytes__' in value:
+                data = base64.b64decode(value['__bytes__'])
+                try:
+                    data = self.text(data.decode('utf-8')).encode('utf-8')
+                except UnicodeDecodeError:
+                    pass
+                return {'__bytes__': base64.b64encode(data).decode('ascii')}
+            return {key: self.value(item) for key, item in value.items()}
+        return value
+
+
+class ApiRecorder:
+    """Records the API calls of every client of the default session while an invocation runs"""
+
+    def __init__(self, function_name, salt=None):
+        self.function_name = function_name
+        self.anonymizer = Anonymizer(salt) if salt else None
+        self.lock = threading.Lock()
+        self.active = False
+        self.calls = []
+        self.header = {}
+        self.started = 0
+
+    def install(self, session):
+        """Hook the botocore events of a session; clients created afterwards are recorded"""
+        session.events.register('provide-client-params', self._on_params)
+        session.events.register('before-call', self._on_before_call)
+        session.events.register('after-call', self._on_after_call)
+
+    def _anonymize(self, value):
+        return self.anonymizer.value(value) if self.anonymizer else value
+
+    def start(self, invocation_id, account_id):
+        """Begin a cassette for one invocation"""
+        with self.lock:
+            self.calls = []
+            self.started = time.time()
+            self.header = {
+                'Cassette': CASSETTE_VERSION,
+                'Function': self.function_name,
+                'InvocationId': invocation_id,
+                'RecordedAt': int(self.started),
+                'Anonymized': self.anonymizer is not None,
+                'AccountId': self._anonymize(account_id),
+                'Settings': self._anonymize({name: os.environ[name] for name in RECORDED_SETTINGS
+                                             if name in os.environ})
+            }
+            self.active = True
+
+    def stop(self):
+        """End the cassette and return it as gzip JSON Lines"""
+        with self.lock:
+            self.active = False
+            lines = [self.header] + self.calls
+            self.calls = []
+        return gzip.compress('\n'.join(json.dumps(line, separators=(',', ':')) for line in lines).encode('utf-8'))
+
+    def _on_params(self, params, context, **kwargs):
+        if self.active:
+            context['cassette_params'] = {key: value for key, value in params.items()
+                                          if key not in VOLATILE_PARAMS}
+
+    def _on_before_call(self, context, **kwargs):
+        if self.active:
+            context['cassette_started'] = time.time()
+
+    def _on_after_call(self, http_response, parsed, model, context, **kwargs):
+        if not self.active or 'cassette_started' not in context:
+            return
+        finished = time.time()
+        if isinstance(parsed.get('Body'), StreamingBody):
+            # Read the body for the cassette and hand the caller an unread copy.
+            data = parsed['Body'].read()
+            parsed['Body'] = StreamingBody(io.BytesIO(data), len(data))
+            response = dict(parsed, Body=data)
+        else:
+            response = dict(parsed)
+        response.get('ResponseMetadata', {}).pop('HTTPHeaders', None)
+        call = {
+            'Service': model.service_model.service_name,
+            'Operation': model.name,
+            'Params': self._anonymize(encode_value(context.get('cassette_params', {}))),
+            'Status': http_response.status_code,
+            'Response': self._anonymize(encode_value(response)),
+            'Offset': round(context['cassette_started'] - self.started, 4),
+            'Duration': round(finished - context['cassette_started'], 4)
+        }
+        with self.lock:
+            if self.active:
+                self.calls.append(call)
+
+
+def recorded(recorder, s3client, bucket_name):
+    """
+    Decorator that records each invocation of a handler to a cassette under
+    automation-state/cassettes/ when a recorder is installed. An invocation
+    nested in a recorded one is part of the outer cassette.
+    """
+    def decorate(handler):
+        if recorder is None:
+            return handler
+
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            if recorder.active:
+                return handler(event, context)
+            invocation_id = getattr(context, 'aws_request_id', None) or str(int(time.time()))
+            recorder.start(invocation_id, context.invoked_function_arn.split(':')[4])
+            try:
+                return handler(event, context)
+            finally:
+                count = len(recorder.calls)
+                cassette = recorder.stop()
+                key = (f"{CASSETTE_PREFIX}{recorder.function_name}/"
+                       f"{time.strftime('%Y/%m/%d/%H%M%S', time.gmtime())}-{invocation_id}.jsonl.gz")
+                try:
+                    s3client.put_object(Bucket=bucket_name, Key=key, Body=cassette,
+                                        ContentType='application/gzip')
+                    logger.info("Recorded %s API calls to s3://%s/%s", count, bucket_name, key)
+                except ClientError as error:
+                    logger.warning("Cannot upload the API cassette: %s", error)
+        return wrapper
+    return decorate
+
+
+def read_cassette(path):
+    """Return the header and the calls of a cassette file"""
+    with gzip.open(path, 'rt', encoding='utf-8') as cassette:
+        lines = [json.loads(line) for line in cassette if line.strip()]
+    return lines[0], lines[1:]
+
+
+class ApiPlayer:
+    """
+    Answers API calls from recorded cassettes. A call is matched on its
+    parameters first and otherwise on its operation, in recorded order;
+    a call with no recorded response fails with a CassetteMiss error.
+    A speed of 0 answers at once, 1 at the recorded pace.
+    """
+
+    def __init__(self, paths, speed=0):
+        self.speed = speed
+        self.headers = []
+        self.calls = []
+        for path in paths:
+            header, calls = read_cassette(path)
+            self.headers.append(header)
+            self.calls += calls
+        self.consumed = [False] * len(self.calls)
+        self.by_key = defaultdict(deque)
+        self.by_operation = defaultdict(deque)
+        for index, call in enumerate(self.calls):
+            self.by_key[call_key(call['Service'], call['Operation'], call['Params'])].append(index)
+            self.by_operation[(call['Service'], call['Operation'])].append(index)
+        self.lock = threading.Lock()
+        self.replayed = 0
+        self.misses = 0
+
+    @property
+    def settings(self):
+        """Recorded settings of all cassettes"""
+        settings = {}
+        for header in self.headers:
+            settings.update(header.get('Settings', {}))
+        return settings
+
+    @property
+    def account_id(self):
+        """Recorded account id"""
+        return self.headers[0].get('AccountId') if self.headers else None
+
+    def install(self, session):
+        """Hook the botocore events of a session; clients created afterwards are replayed"""
+        session.events.register('provide-client-params', self._on_params)
+        session.events.register('before-call', self._on_before_call)
+
+    def _take(self, queue):
+        while queue:
+            index = queue.popleft()
+            if not self.consumed[index]:
+                self.consumed[index] = True
+                return self.calls[index]
+        return None
+
+    def _on_params(self, params, context, **kwargs):
+        context['cassette_params'] = encode_value(params)
+
+    def _on_before_call(self, model, context, **kwargs):
+        service_name = model.service_model.service_name
+        with self.lock:
+            call = self._take(self.by_key[call_key(service_name, model.name, context.get('cassette_params', {}))])
+            if call is None:
+                call = self._take(self.by_operation[(service_name, model.name)])
+            if call is None:
+                self.misses += 1
+            else:
+                self.replayed += 1
+        if call is None:
+            logger.warning("No recorded response for %s.%s", service_name, model.name)
+            return AWSResponse('', 400, {}, None), {
+                'Error': {'Code': MISSING_ERROR_CODE, 'Message': f"No recorded response for {model.name}"},
+                'ResponseMetadata': {'HTTPStatusCode': 400}
+            }
+        if self.speed:
+            time.sleep(call['Duration'] / self.speed)
+        response = decode_value(call['Response'])
+        if isinstance(response.get('Body'), bytes):
+            response['Body'] = StreamingBody(io.BytesIO(response['Body']), len(response['Body']))
+        return AWSResponse('', call['Status'], {}, None), response
+
+    def unused(self):
+        """Number of recorded calls the replay did not make"""
+        return self.consumed.count(False)
@@ -0,0 +1,112 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+# pylint: disable=C0301
+# pylint: disable=W1202,W0703
+# pylint: disable=E0401
+###########################################################################
+# Change report of a reconciliation run. Every create, delete, drift and #
+# skipped item is streamed to a gzip JSON Lines file in /tmp and logged   #
+# only for the first few of each kind; the file is uploaded to S3 once   #
+# at the end and linked from the CodePipeline job result.               #
+###########################################################################
+import os
+import json
+import gzip
+import time
+import logging
+
+logger = logging.getLogger()
+
+REPORT_PREFIX = 'automation-state/reports/'
+# Entries of each kind that are also written to the log.
+LOG_SAMPLE_SIZE = int(os.environ.get('LogSampleSize', '20'))
+# CodePipeline limits the execution summary to 2048 characters.
+SUMMARY_LIMIT = 2048
+
+
+class ChangeReport:
+    """Counts, samples and spools the changes of one invocation"""
+
+    def __init__(self, function_name, run_id, part='1', sample_size=LOG_SAMPLE_SIZE):
+        self.function_name = function_name
+        self.run_id = run_id
+        self.part = str(part)
+        self.sample_size = sample_size
+        self.counts = {}
+        self.path = f"/tmp/{function_name}-{run_id}-{self.part}.jsonl.gz"
+        self.file = gzip.open(self.path, 'wt', encoding='utf-8')
+
+    def record(self, kind, **details):
+        """Add one entry to the report, logging it only while the sample is not full"""
+        count = self.counts.get(kind, 0) + 1
+        self.counts[kind] = count
+        entry = dict(details, Kind=kind, Time=int(time.time()))
+        self.file.write(json.dumps(entry, default=str) + '\n')
+        if count <= self.sample_size:
+            logger.info("%s: %s", kind, details)
+        elif count == self.sample_size + 1:
+            logger.info("More %s entries are only written to the change report", kind)
+
+    def merge_counts(self, counts):
+        """Add the entry counts of a report written by another invocation"""
+        for kind, count in counts.items():
+            self.counts[kind] = self.counts.get(kind, 0) + count
+
+    def summary(self):
+        """One line with the number of entries of each kind"""
+        if not self.counts:
+            return "No changes"
+        return ", ".join(f"{kind}: {count}" for kind, count in sorted(self.counts.items()))
+
+    def key(self):
+        """S3 key of this part of the report"""
+        return f"{run_report_prefix(self.function_name, self.run_id)}{self.part}.jsonl.gz"
+
+    def upload(self, s3client, bucket_name):
+        """Close the spool file, upload it and return its S3 key"""
+        self.file.close()
+        key = self.key()
+        try:
+            s3client.upload_file(self.path, bucket_name, key,
+                                 ExtraArgs={'ContentType': 'application/gzip'})
+        finally:
+            os.remove(self.path)
+        logger.info("Change report %s uploaded to s3://%s/%s", self.summary(), bucket_name, key)
+        return key
+
+    def discard(self):
+        """Close and remove the spool file without uploading it"""
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def report_part(cursor):
+    """Name of the report part of one invocation of a run, unique across rerun passes"""
+    started = cursor['StartedAt'][:19].replace(':', '').replace('-', '')
+    return f"{started}-{cursor['Invocation']}"
+
+
+def run_report_prefix(function_name, run_id):
+    """S3 prefix holding every part of the report of one run"""
+    return f"{REPORT_PREFIX}{function_name}/{run_id}/"
+
+
+def report_url(bucket_name, prefix, region):
+    """Console link to the report objects under a prefix"""
+    return f"https://s3.console.aws.amazon.com/s3/buckets/{bucket_name}?region={region}&prefix={prefix}"
+
+
+def execution_details(run_id, summary, links):
+    """Build the CodePipeline executionDetails, keeping the summary within its size limit"""
+    text = summary + ''.join(f" | {link}" for link in links)
+    if len(text) > SUMMARY_LIMIT:
+        text = text[:SUMMARY_LIMIT - 3] + '...'
+    return {'summary': text, 'externalExecutionId': run_id, 'percentComplete': 100}
+
+
+def bounded(items, limit=LOG_SAMPLE_SIZE):
+    """Log-friendly view of a collection: its size and at most limit items"""
+    items = list(items)
+    if len(items) <= limit:
+        return f"{len(items)} items: {items}"
+    return f"{len(items)} items, first {limit}: {items[:limit]}"
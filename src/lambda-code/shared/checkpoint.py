@@ -0,0 +1,126 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+# pylint: disable=C0301
+# pylint: disable=W1202,W0703
+# pylint: disable=E0401
+#####################################################################
+# Progress cursor that lets a reconciliation run outlive the 900s   #
+# Lambda timeout. The cursor is stored in the solution's S3 bucket  #
+# under automation-state/, which the mapping sync never deletes.    #
+#####################################################################
+import os
+import json
+import uuid
+import logging
+from datetime import datetime, timezone
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+CHECKPOINT_PREFIX = 'automation-state/checkpoints/'
+# Stop picking up new work once less than this is left of the invocation.
+SAFETY_MARGIN_MS = int(os.environ.get('CheckpointSafetyMarginMs', '90000'))
+
+
+class DeadlineApproaching(Exception):
+    """Raised by a reconciliation phase when it has to hand off to a new invocation"""
+
+    def __init__(self, phase, position, pending=None):
+        super().__init__(f"Deadline approaching in phase {phase} at position {position}")
+        self.phase = phase
+        self.position = position
+        self.pending = pending if pending is not None else []
+
+
+def deadline_reached(context, margin_ms=SAFETY_MARGIN_MS):
+    """Return True if the invocation should checkpoint instead of starting more work"""
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return False
+    return context.get_remaining_time_in_millis() < margin_ms
+
+
+def new_cursor(function_name, pipeline_id, phase):
+    """Build an empty progress cursor for a fresh run"""
+    return {
+        'RunId': str(uuid.uuid4()),
+        'Function': function_name,
+        'PipelineId': pipeline_id,
+        'Phase': phase,
+        'Position': 0,
+        'Pending': [],
+        'Invocation': 1,
+        'StartedAt': datetime.now(timezone.utc).isoformat()
+    }
+
+
+def advance_cursor(cursor, deadline):
+    """Copy the progress recorded by a DeadlineApproaching into the cursor"""
+    cursor['Phase'] = deadline.phase
+    cursor['Position'] = deadline.position
+    cursor['Pending'] = deadline.pending
+    cursor['Invocation'] = cursor.get('Invocation', 1) + 1
+    return cursor
+
+
+def checkpoint_key(cursor):
+    """S3 key of the checkpoint object for a cursor"""
+    return f"{CHECKPOINT_PREFIX}{cursor['Function']}/{cursor['RunId']}.json"
+
+
+def save_checkpoint(s3client, bucket_name, cursor):
+    """Write the cursor to S3 and return its key"""
+    key = checkpoint_key(cursor)
+    cursor['SavedAt'] = datetime.now(timezone.utc).isoformat()
+    s3client.put_object(
+        Bucket=bucket_name,
+        Key=key,
+        Body=json.dumps(cursor).encode('utf-8'),
+        ContentType='application/json'
+    )
+    logger.info("Saved checkpoint %s (phase %s, position %s, %s pending)",
+                key, cursor['Phase'], cursor['Position'], len(cursor['Pending']))
+    return key
+
+
+def load_checkpoint(s3client, bucket_name, key):
+    """Read a cursor back from S3, or None if it no longer exists"""
+    try:
+        response = s3client.get_object(Bucket=bucket_name, Key=key)
+        cursor = json.loads(response['Body'].read())
+    except ClientError as error:
+        logger.error("Cannot load checkpoint %s: %s", key, error)
+        return None
+    logger.info("Resuming run %s from phase %s at position %s (invocation %s)",
+                cursor['RunId'], cursor['Phase'], cursor['Position'], cursor['Invocation'])
+    return cursor
+
+
+def delete_checkpoint(s3client, bucket_name, cursor):
+    """Remove the checkpoint of a completed run"""
+    if cursor.get('Invocation', 1) == 1:
+        return
+    try:
+        s3client.delete_object(Bucket=bucket_name, Key=checkpoint_key(cursor))
+    except ClientError as error:
+        logger.warning("Cannot delete checkpoint of run %s: %s", cursor['RunId'], error)
+
+
+def continue_in_pipeline(pipeline_client, pipeline_id, key):
+    """Ask CodePipeline to invoke the action again with the checkpoint key as continuation token"""
+    pipeline_client.put_job_success_result(
+        jobId=pipeline_id,
+        continuationToken=key
+    )
+    logger.info("Returned continuation token %s to CodePipeline job %s", key, pipeline_id)
+
+
+def continue_by_self_invocation(lambda_client, function_name, key, extra=None):
+    """Asynchronously invoke this function again to resume from the checkpoint"""
+    payload = {'ResumeCheckpoint': key}
+    if extra:
+        payload.update(extra)
+    lambda_client.invoke(
+        FunctionName=function_name,
+        InvocationType='Event',
+        Payload=json.dumps(payload).encode('utf-8')
+    )
+    logger.info("Invoked %s again to resume from %s", function_name, key)
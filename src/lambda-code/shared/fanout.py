@@ -0,0 +1,155 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+# pylint: disable=C0301
+# pylint: disable=W1202,W0703
+# pylint: disable=E0401
+######################################################################
+# Fan-out of reconciliation shards to parallel worker invocations.  #
+# The coordinator dispatches one payload per shard through a        #
+# transport, and every worker writes its result to a result store  #
+# the coordinator polls before reporting to CodePipeline.           #
+######################################################################
+import json
+import logging
+from time import sleep
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+SHARD_RESULT_PREFIX = 'automation-state/shards/'
+
+
+def partition(items, shard_size):
+    """Split a list into consecutive shards of at most shard_size items"""
+    return [items[i:i + shard_size] for i in range(0, len(items), shard_size)]
+
+
+class LambdaTransport:
+    """Deliver shard payloads by invoking the worker function asynchronously"""
+
+    def __init__(self, lambda_client, function_name):
+        self.lambda_client = lambda_client
+        self.function_name = function_name
+
+    def dispatch(self, payload):
+        """Send one shard payload"""
+        self.lambda_client.invoke(
+            FunctionName=self.function_name,
+            InvocationType='Event',
+            Payload=json.dumps(payload).encode('utf-8')
+        )
+
+
+class SnsTransport:
+    """Deliver shard payloads through an SNS topic the worker function subscribes to"""
+
+    def __init__(self, sns_client, topic_arn):
+        self.sns_client = sns_client
+        self.topic_arn = topic_arn
+
+    def dispatch(self, payload):
+        """Send one shard payload"""
+        self.sns_client.publish(
+            TopicArn=self.topic_arn,
+            Message=json.dumps(payload)
+        )
+
+
+class SqsTransport:
+    """Deliver shard payloads through an SQS queue mapped to the worker function"""
+
+    def __init__(self, sqs_client, queue_url):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+
+    def dispatch(self, payload):
+        """Send one shard payload"""
+        self.sqs_client.send_message(
+            QueueUrl=self.queue_url,
+            MessageBody=json.dumps(payload)
+        )
+
+
+class LocalTransport:
+    """Run each shard in-process with the given worker callable, for tests and local runs"""
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    def dispatch(self, payload):
+        """Run one shard payload synchronously"""
+        self.worker(json.loads(json.dumps(payload)))
+
+
+class S3ResultStore:
+    """Per-shard results stored as JSON objects in the solution bucket"""
+
+    def __init__(self, s3client, bucket_name):
+        self.s3client = s3client
+        self.bucket_name = bucket_name
+
+    def put(self, run_id, shard_id, result):
+        """Record the result of one shard"""
+        self.s3client.put_object(
+            Bucket=self.bucket_name,
+            Key=f"{SHARD_RESULT_PREFIX}{run_id}/{shard_id}.json",
+            Body=json.dumps(result).encode('utf-8'),
+            ContentType='application/json'
+        )
+
+    def get(self, run_id, shard_id):
+        """Return the result of one shard, or None while it is still running"""
+        try:
+            response = self.s3client.get_object(
+                Bucket=self.bucket_name,
+                Key=f"{SHARD_RESULT_PREFIX}{run_id}/{shard_id}.json"
+            )
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None
+            raise
+        return json.loads(response['Body'].read())
+
+
+class MemoryResultStore:
+    """In-process stand-in for S3ResultStore"""
+
+    def __init__(self):
+        self.results = {}
+
+    def put(self, run_id, shard_id, result):
+        """Record the result of one shard"""
+        self.results[(run_id, shard_id)] = result
+
+    def get(self, run_id, shard_id):
+        """Return the result of one shard, or None while it is still running"""
+        return self.results.get((run_id, shard_id))
+
+
+def wait_for_shards(result_store, run_id, shard_count, collected=None,
+                    should_stop=None, poll_seconds=5):
+    """
+    Poll the result store until every shard reported or should_stop() is true.
+    Returns the results collected so far, keyed by shard id.
+    """
+    collected = dict(collected or {})
+    while len(collected) < shard_count:
+        for shard_id in range(shard_count):
+            if str(shard_id) not in collected:
+                result = result_store.get(run_id, shard_id)
+                if result is not None:
+                    collected[str(shard_id)] = result
+        if len(collected) == shard_count or (should_stop and should_stop()):
+            break
+        sleep(poll_seconds)
+    return collected
+
+
+def aggregate_shard_results(results):
+    """Combine per-shard results into one summary for the pipeline"""
+    summary = {'Shards': len(results), 'Accounts': 0, 'Failed': []}
+    for shard_id in sorted(results, key=int):
+        result = results[shard_id]
+        summary['Accounts'] += result.get('Accounts', 0)
+        if result.get('Status') != 'SUCCEEDED':
+            summary['Failed'].append({'ShardId': shard_id, 'Error': result.get('Error', '')})
+    return summary
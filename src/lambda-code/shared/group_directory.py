@@ -0,0 +1,186 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+# pylint: disable=C0301
+# pylint: disable=W1202,W0703
+# pylint: disable=E0401
+###########################################################################
+# Persistent directory of identity store group names and ids, kept in a  #
+# DynamoDB table with one item per group. The permission set function    #
+# patches it from the group events EventBridge routes to it; the        #
+# assignment function loads it once per pass and falls back to a bulk   #
+# paginated refresh when it is cold, stale or was invalidated.           #
+###########################################################################
+import time
+import logging
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+# Item holding the time of the last full refresh. Deleting it invalidates the directory.
+DIRECTORY_MARKER = '#directory'
+# Group events detected by ICManualActionDetectionRule2.
+DIRECTORY_EVENTS = {'CreateGroup', 'DeleteGroup', 'UpdateGroup', 'UpdateGroupDisplayName'}
+# CloudTrail replaces some values with this placeholder.
+HIDDEN_VALUE_PREFIX = 'HIDDEN_DUE_TO_SECURITY_REASONS'
+BATCH_WRITE_LIMIT = 25
+
+
+def list_identity_store_groups(identitystore_client, identity_store_id):
+    """Return every group of the identity store as a {GroupId: DisplayName} map"""
+    params = {'IdentityStoreId': identity_store_id, 'MaxResults': 100}
+    response = identitystore_client.list_groups(**params)
+    groups = {group['GroupId']: group['DisplayName'] for group in response['Groups']}
+    while response.get('NextToken'):
+        response = identitystore_client.list_groups(NextToken=response['NextToken'], **params)
+        groups.update((group['GroupId'], group['DisplayName']) for group in response['Groups'])
+    return groups
+
+
+def lookup_group_id(identitystore_client, identity_store_id, group_display_name):
+    """Look one group up by display name in the identity store, None if it does not exist"""
+    response = identitystore_client.list_groups(
+        IdentityStoreId=identity_store_id,
+        Filters=[{'AttributePath': 'DisplayName', 'AttributeValue': str(group_display_name)}]
+    )
+    if not response['Groups']:
+        return None
+    return response['Groups'][0]['GroupId']
+
+
+def _write_batch(dynamodb_client, table_name, write_requests):
+    """Write up to 25 requests, retrying unprocessed items with backoff"""
+    request_items = {table_name: write_requests}
+    attempt = 0
+    while request_items:
+        response = dynamodb_client.batch_write_item(RequestItems=request_items)
+        request_items = response.get('UnprocessedItems') or {}
+        if request_items:
+            time.sleep(min(0.1 * 2 ** attempt, 5))
+            attempt += 1
+
+
+def _known_value(value):
+    """Return a CloudTrail string value, or None if it is missing or hidden"""
+    if isinstance(value, str) and value and not value.startswith(HIDDEN_VALUE_PREFIX):
+        return value
+    return None
+
+
+def _event_group(detail):
+    """Extract the group id and new display name of a group event, each None if not recorded"""
+    parameters = detail.get('requestParameters') or {}
+    elements = detail.get('responseElements') or {}
+    group_id = (parameters.get('groupId') or elements.get('groupId') or
+                (elements.get('group') or {}).get('groupId'))
+    display_name = (parameters.get('displayName') or parameters.get('groupDisplayName') or
+                    (elements.get('group') or {}).get('displayName'))
+    for operation in parameters.get('operations') or []:
+        if operation.get('attributePath') == 'displayName':
+            display_name = operation.get('attributeValue')
+    return _known_value(group_id), _known_value(display_name)
+
+
+def invalidate_directory(dynamodb_client, table_name):
+    """Force the next load to refresh the whole directory"""
+    dynamodb_client.delete_item(TableName=table_name, Key={'group_id': {'S': DIRECTORY_MARKER}})
+
+
+def apply_directory_event(dynamodb_client, table_name, event):
+    """
+    Patch the directory with one group event. Events that do not record
+    the group id and name invalidate the directory instead.
+    """
+    detail = event.get('detail', {})
+    event_name = detail.get('eventName')
+    group_id, display_name = _event_group(detail)
+    if event_name == 'DeleteGroup' and group_id:
+        dynamodb_client.delete_item(TableName=table_name, Key={'group_id': {'S': group_id}})
+        logger.info("Removed group %s from the group directory", group_id)
+    elif group_id and display_name:
+        dynamodb_client.put_item(TableName=table_name, Item={
+            'group_id': {'S': group_id}, 'display_name': {'S': display_name}})
+        logger.info("Group directory entry %s is now %s", group_id, display_name)
+    else:
+        invalidate_directory(dynamodb_client, table_name)
+        logger.info("%s event does not name the group, invalidated the group directory", event_name)
+
+
+class GroupDirectory:
+    """Group display name to id lookups backed by the group directory table"""
+
+    def __init__(self, dynamodb_client, table_name, identitystore_client, identity_store_id,
+                 max_age_seconds):
+        self.dynamodb = dynamodb_client
+        self.table_name = table_name
+        self.identitystore = identitystore_client
+        self.identity_store_id = identity_store_id
+        self.max_age_seconds = max_age_seconds
+        self.group_ids = {}
+
+    def _scan(self):
+        """Return the stored {GroupId: DisplayName} map and the marker item, if any"""
+        groups = {}
+        marker = None
+        params = {'TableName': self.table_name}
+        while True:
+            response = self.dynamodb.scan(**params)
+            for item in response['Items']:
+                if item['group_id']['S'] == DIRECTORY_MARKER:
+                    marker = item
+                else:
+                    groups[item['group_id']['S']] = item['display_name']['S']
+            if 'LastEvaluatedKey' not in response:
+                return groups, marker
+            params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def _is_fresh(self, marker):
+        return (marker is not None and
+                marker.get('identity_store_id', {}).get('S') == self.identity_store_id and
+                time.time() - int(marker['refreshed_at']['N']) <= self.max_age_seconds)
+
+    def load(self):
+        """Load the directory, refreshing it from the identity store if it is cold or stale"""
+        stored, marker = self._scan()
+        if self._is_fresh(marker):
+            logger.info("Loaded %s groups from the group directory", len(stored))
+            groups = stored
+        else:
+            groups = self.refresh(stored)
+        self.group_ids = {name: group_id for group_id, name in groups.items()}
+        return self
+
+    def refresh(self, stored):
+        """Replace the stored directory with every group of the identity store"""
+        groups = list_identity_store_groups(self.identitystore, self.identity_store_id)
+        write_requests = [
+            {'PutRequest': {'Item': {'group_id': {'S': group_id}, 'display_name': {'S': name}}}}
+            for group_id, name in groups.items() if stored.get(group_id) != name]
+        write_requests += [
+            {'DeleteRequest': {'Key': {'group_id': {'S': group_id}}}}
+            for group_id in stored if group_id not in groups]
+        for start in range(0, len(write_requests), BATCH_WRITE_LIMIT):
+            _write_batch(self.dynamodb, self.table_name,
+                         write_requests[start:start + BATCH_WRITE_LIMIT])
+        self.dynamodb.put_item(TableName=self.table_name, Item={
+            'group_id': {'S': DIRECTORY_MARKER},
+            'identity_store_id': {'S': self.identity_store_id},
+            'refreshed_at': {'N': str(int(time.time()))}
+        })
+        logger.info("Refreshed the group directory: %s groups, %s changed entries",
+                    len(groups), len(write_requests))
+        return groups
+
+    def group_id(self, group_display_name):
+        """Return the id of a group, looking it up in the identity store if the directory misses it"""
+        group_display_name = str(group_display_name)
+        if group_display_name in self.group_ids:
+            return self.group_ids[group_display_name]
+        group_id = lookup_group_id(self.identitystore, self.identity_store_id, group_display_name)
+        if group_id is not None:
+            try:
+                self.dynamodb.put_item(TableName=self.table_name, Item={
+                    'group_id': {'S': group_id}, 'display_name': {'S': group_display_name}})
+            except ClientError as error:
+                logger.warning("Cannot add group %s to the group directory: %s",
+                               group_display_name, error)
+            self.group_ids[group_display_name] = group_id
+        return group_id
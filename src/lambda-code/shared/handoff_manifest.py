@@ -0,0 +1,107 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+# pylint: disable=C0301
+# pylint: disable=W1202,W0703
+# pylint: disable=E0401
+##########################################################################
+# Handoff manifest from the permission set function to the assignment   #
+# function. It carries the permission set catalog, the account list and #
+# the permission sets a run created, updated or deleted, so the         #
+# assignment function does not enumerate them again. Every run writes  #
+# a new S3 object version, which the SNS message refers to.             #
+##########################################################################
+import json
+import time
+import logging
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+HANDOFF_MANIFEST_KEY = 'automation-state/handoff/manifest.json'
+MANIFEST_SCHEMA_VERSION = 1
+# Events whose effect on account assignments is limited to the permission sets they name.
+PERMISSION_SET_SCOPED_EVENTS = {
+    'AttachManagedPolicyToPermissionSet',
+    'CreateAccountAssignment',
+    'CreatePermissionSet',
+    'DeleteAccountAssignment',
+    'DeleteInlinePolicyFromPermissionSet',
+    'DeletePermissionSet',
+    'DetachManagedPolicyFromPermissionSet',
+    'ObjectCreated',
+    'ObjectDeleted',
+    'ProvisionPermissionSet',
+    'PutInlinePolicyToPermissionSet',
+    'TagResource',
+    'UntagResource',
+    'UpdatePermissionSet'
+}
+PERMISSION_SET_SCOPED_SOURCES = {'sso.amazonaws.com'}
+
+
+def build_manifest(run_id, permission_sets, accounts, changes):
+    """
+    Assemble a manifest.
+    permission_sets maps names to ARNs, accounts is the Organizations account
+    list and changes maps 'Created', 'Updated' and 'Deleted' to ARN collections.
+    """
+    return {
+        'SchemaVersion': MANIFEST_SCHEMA_VERSION,
+        'RunId': run_id,
+        'CreatedAt': int(time.time()),
+        'PermissionSets': permission_sets,
+        'Accounts': [{'Id': str(account['Id']), 'Status': account['Status']}
+                     for account in accounts],
+        'Changes': {kind: sorted(changes.get(kind, []))
+                    for kind in ('Created', 'Updated', 'Deleted')}
+    }
+
+
+def write_manifest(s3client, bucket_name, manifest):
+    """Write the manifest and return a reference to the object version written"""
+    response = s3client.put_object(
+        Bucket=bucket_name,
+        Key=HANDOFF_MANIFEST_KEY,
+        Body=json.dumps(manifest).encode('utf-8'),
+        ContentType='application/json'
+    )
+    logger.info("Wrote handoff manifest of run %s: %s permission sets, %s accounts",
+                manifest['RunId'], len(manifest['PermissionSets']), len(manifest['Accounts']))
+    return {'Key': HANDOFF_MANIFEST_KEY, 'VersionId': response.get('VersionId')}
+
+
+def read_manifest(s3client, bucket_name, reference):
+    """Return the manifest a reference points to, or None if it cannot be used"""
+    params = {'Bucket': bucket_name, 'Key': reference['Key']}
+    if reference.get('VersionId'):
+        params['VersionId'] = reference['VersionId']
+    try:
+        manifest = json.loads(s3client.get_object(**params)['Body'].read())
+    except (ClientError, ValueError) as error:
+        logger.warning("Cannot read handoff manifest %s: %s", reference, error)
+        return None
+    if manifest.get('SchemaVersion') != MANIFEST_SCHEMA_VERSION:
+        logger.warning("Ignoring handoff manifest with schema version %s",
+                       manifest.get('SchemaVersion'))
+        return None
+    return manifest
+
+
+def change_scope(manifest, entities):
+    """
+    Return the ARNs of the permission sets whose assignments an event run must
+    reconcile, or None if the run must reconcile every permission set.
+    """
+    event_names = {entity.split(':', 1)[1] for entity in entities
+                   if entity.startswith('Event:')}
+    sources = {entity.split(':', 1)[1] for entity in entities
+               if entity.startswith('Source:')}
+    if not event_names or not event_names <= PERMISSION_SET_SCOPED_EVENTS:
+        return None
+    if not sources <= PERMISSION_SET_SCOPED_SOURCES:
+        # Organizations has TagResource and UntagResource events of its own.
+        return None
+    scope = {entity.split(':', 1)[1] for entity in entities
+             if entity.startswith('PermissionSet:')}
+    for arns in manifest['Changes'].values():
+        scope.update(arns)
+    return scope
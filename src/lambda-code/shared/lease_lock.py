@@ -0,0 +1,237 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+# pylint: disable=C0301
+# pylint: disable=W1202,W0703
+# pylint: disable=E0401
+###########################################################################
+# Single-flight lease lock for reconciliation runs, kept in DynamoDB.     #
+# The holder renews its lease from a heartbeat thread. Every acquisition  #
+# increments a fencing token, and a holder whose token no longer matches  #
+# stops writing. A run that finds the lock held leaves a rerun request,   #
+# which the holder picks up as one more pass before it releases. Every    #
+# pipeline job waiting on that pass is kept and receives its result.      #
+###########################################################################
+import time
+import logging
+import threading
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+
+class LeaseLost(Exception):
+    """Raised when the lease was taken over and this run must stop writing"""
+
+
+def _conditional_check_failed(error):
+    """Return True if a ClientError is a failed condition expression"""
+    return error.response['Error']['Code'] == 'ConditionalCheckFailedException'
+
+
+def serve_rerun(rerun, cursor):
+    """
+    Return the pipeline job the rerun pass reports to. The other waiting jobs
+    are kept in the cursor and receive the same result from report_waiting_jobs.
+    """
+    pipeline_ids = rerun['PipelineIds']
+    cursor['WaitingPipelineIds'] = pipeline_ids[1:]
+    if len(pipeline_ids) > 1:
+        logger.info("The rerun pass also serves pipeline jobs %s", pipeline_ids[1:])
+    return pipeline_ids[0] if pipeline_ids else ''
+
+
+def report_waiting_jobs(pipeline_client, cursor, failure=None):
+    """Report the result of a rerun pass to the other pipeline jobs waiting on it"""
+    for pipeline_id in cursor.get('WaitingPipelineIds', []):
+        try:
+            if failure is None:
+                pipeline_client.put_job_success_result(jobId=pipeline_id)
+            else:
+                pipeline_client.put_job_failure_result(
+                    jobId=pipeline_id,
+                    failureDetails={'type': 'JobFailed', 'message': failure}
+                )
+        except ClientError as error:
+            logger.warning("Cannot report the result to pipeline job %s: %s", pipeline_id, error)
+    cursor['WaitingPipelineIds'] = []
+
+
+class LeaseLock:
+    """DynamoDB lease lock with heartbeats, fencing tokens and rerun requests"""
+
+    def __init__(self, dynamodb_client, table_name, lock_name, owner,
+                 lease_seconds=120, heartbeat_seconds=30):
+        self.dynamodb = dynamodb_client
+        self.table_name = table_name
+        self.lock_name = lock_name
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.heartbeat_seconds = heartbeat_seconds
+        self.fencing_token = None
+        self.lost = False
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def _key(self):
+        return {'lock_name': {'S': self.lock_name}}
+
+    def acquire(self):
+        """Take the lock if it is free, expired or already ours. Returns True on success."""
+        now = int(time.time())
+        try:
+            response = self.dynamodb.update_item(
+                TableName=self.table_name,
+                Key=self._key(),
+                UpdateExpression='SET lock_owner = :owner, expires_at = :expires ADD fencing_token :one',
+                ConditionExpression='attribute_not_exists(lock_owner) OR expires_at < :now OR lock_owner = :owner',
+                ExpressionAttributeValues={
+                    ':owner': {'S': self.owner},
+                    ':expires': {'N': str(now + self.lease_seconds)},
+                    ':now': {'N': str(now)},
+                    ':one': {'N': '1'}
+                },
+                ReturnValues='ALL_NEW'
+            )
+        except ClientError as error:
+            if _conditional_check_failed(error):
+                return False
+            raise
+        self.fencing_token = response['Attributes']['fencing_token']['N']
+        self.lost = False
+        self._start_heartbeat()
+        logger.info("Acquired lock %s with fencing token %s", self.lock_name, self.fencing_token)
+        return True
+
+    def request_rerun(self, pipeline_id=''):
+        """
+        Ask the current holder for one more pass.
+        Returns False if the lock was released meanwhile and can be acquired instead.
+        """
+        values = {
+            ':true': {'BOOL': True},
+            ':now': {'N': str(int(time.time()))}
+        }
+        update = 'SET rerun_requested = :true'
+        if pipeline_id:
+            # Append, so that a later request does not drop the job of an earlier one.
+            update += ', rerun_pipeline_ids = list_append(if_not_exists(rerun_pipeline_ids, :none), :pipeline_ids)'
+            values[':none'] = {'L': []}
+            values[':pipeline_ids'] = {'L': [{'S': pipeline_id}]}
+        try:
+            self.dynamodb.update_item(
+                TableName=self.table_name,
+                Key=self._key(),
+                UpdateExpression=update,
+                ConditionExpression='attribute_exists(lock_owner) AND expires_at >= :now',
+                ExpressionAttributeValues=values
+            )
+        except ClientError as error:
+            if _conditional_check_failed(error):
+                return False
+            raise
+        logger.info("Lock %s is held by another run; requested a rerun from it", self.lock_name)
+        return True
+
+    def acquire_or_request_rerun(self, pipeline_id=''):
+        """Return True if this run holds the lock, False if it left a rerun request"""
+        while True:
+            if self.acquire():
+                return True
+            if self.request_rerun(pipeline_id):
+                return False
+
+    def release(self):
+        """
+        Release the lock unless a rerun was requested.
+        Returns None once released, or the rerun request (with the ids of the
+        pipeline jobs waiting on it) which this run keeps the lock to serve.
+        """
+        try:
+            self.dynamodb.delete_item(
+                TableName=self.table_name,
+                Key=self._key(),
+                ConditionExpression='lock_owner = :owner AND fencing_token = :token AND attribute_not_exists(rerun_requested)',
+                ExpressionAttributeValues={
+                    ':owner': {'S': self.owner},
+                    ':token': {'N': self.fencing_token}
+                }
+            )
+            self._stop_heartbeat()
+            logger.info("Released lock %s", self.lock_name)
+            return None
+        except ClientError as error:
+            if not _conditional_check_failed(error):
+                raise
+        # Either a rerun is pending or the lease was lost. Claim the request.
+        try:
+            response = self.dynamodb.update_item(
+                TableName=self.table_name,
+                Key=self._key(),
+                UpdateExpression='REMOVE rerun_requested, rerun_pipeline_ids',
+                ConditionExpression='lock_owner = :owner AND fencing_token = :token',
+                ExpressionAttributeValues={
+                    ':owner': {'S': self.owner},
+                    ':token': {'N': self.fencing_token}
+                },
+                ReturnValues='ALL_OLD'
+            )
+        except ClientError as error:
+            if _conditional_check_failed(error):
+                self._stop_heartbeat()
+                self.lost = True
+                logger.warning("Lock %s was taken over before it was released", self.lock_name)
+                return None
+            raise
+        attributes = response['Attributes']
+        logger.info("Rerun requested while holding lock %s; running one more pass", self.lock_name)
+        return {'PipelineIds': [value['S'] for value in attributes.get('rerun_pipeline_ids', {}).get('L', [])]}
+
+    def suspend(self, seconds):
+        """Stop the heartbeat and keep the lock for a continuation invocation of the same owner"""
+        self._stop_heartbeat()
+        self._renew(seconds)
+
+    def check(self):
+        """Raise LeaseLost if another run has taken the lock over"""
+        if self.lost:
+            raise LeaseLost(f"Lease on {self.lock_name} with fencing token {self.fencing_token} was lost")
+
+    def _renew(self, seconds):
+        """Extend the lease if the fencing token is still ours"""
+        try:
+            self.dynamodb.update_item(
+                TableName=self.table_name,
+                Key=self._key(),
+                UpdateExpression='SET expires_at = :expires',
+                ConditionExpression='lock_owner = :owner AND fencing_token = :token',
+                ExpressionAttributeValues={
+                    ':owner': {'S': self.owner},
+                    ':token': {'N': self.fencing_token},
+                    ':expires': {'N': str(int(time.time()) + seconds)}
+                }
+            )
+        except ClientError as error:
+            if _conditional_check_failed(error):
+                self.lost = True
+                logger.error("Lost lock %s: fencing token %s is no longer current",
+                             self.lock_name, self.fencing_token)
+            else:
+                logger.warning("Cannot renew lock %s: %s", self.lock_name, error)
+
+    def _start_heartbeat(self):
+        if self._heartbeat is not None and self._heartbeat.is_alive():
+            return
+        self._stop.clear()
+
+        def beat():
+            while not self._stop.wait(self.heartbeat_seconds):
+                self._renew(self.lease_seconds)
+                if self.lost:
+                    return
+        self._heartbeat = threading.Thread(target=beat, daemon=True)
+        self._heartbeat.start()
+
+    def _stop_heartbeat(self):
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join(timeout=5)
+            self._heartbeat = None
@@ -0,0 +1,85 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+# pylint: disable=C0301
+# pylint: disable=W1202,W0703
+# pylint: disable=E0401
+#########################################################################
+# Permission sets provisioned to the management account, which the     #
+# automation must skip when Identity Center administration is          #
+# delegated. The set is listed in one paginated pass over the          #
+# management account and cached in S3 for both Lambda functions.        #
+#########################################################################
+import json
+import time
+import logging
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+MANAGEMENT_PERMISSION_SETS_KEY = 'automation-state/management-permission-sets.json'
+
+
+def list_management_permission_sets(ic_admin, instance_arn, management_account_id):
+    """Return the set of permission set ARNs provisioned to the management account"""
+    params = {
+        'InstanceArn': instance_arn,
+        'AccountId': management_account_id,
+        'MaxResults': 100
+    }
+    response = ic_admin.list_permission_sets_provisioned_to_account(**params)
+    perm_set_arns = set(response['PermissionSets'])
+    while 'NextToken' in response:
+        response = ic_admin.list_permission_sets_provisioned_to_account(
+            NextToken=response['NextToken'], **params)
+        perm_set_arns.update(response['PermissionSets'])
+    return perm_set_arns
+
+
+def load_cached_management_permission_sets(s3client, bucket_name, management_account_id, max_age_seconds):
+    """Return the cached set if it is recent enough and for the same account, otherwise None"""
+    try:
+        response = s3client.get_object(Bucket=bucket_name, Key=MANAGEMENT_PERMISSION_SETS_KEY)
+        cache = json.loads(response['Body'].read())
+    except (ClientError, ValueError) as error:
+        logger.info("No usable management account permission set cache: %s", error)
+        return None
+    if cache.get('AccountId') != management_account_id:
+        return None
+    if time.time() - cache.get('ListedAt', 0) > max_age_seconds:
+        return None
+    return set(cache['PermissionSets'])
+
+
+def save_management_permission_sets(s3client, bucket_name, management_account_id, perm_set_arns):
+    """Cache the set of permission sets provisioned to the management account"""
+    s3client.put_object(
+        Bucket=bucket_name,
+        Key=MANAGEMENT_PERMISSION_SETS_KEY,
+        Body=json.dumps({
+            'AccountId': management_account_id,
+            'ListedAt': int(time.time()),
+            'PermissionSets': sorted(perm_set_arns)
+        }).encode('utf-8'),
+        ContentType='application/json'
+    )
+
+
+def get_management_permission_sets(ic_admin, s3client, bucket_name, instance_arn,
+                                   management_account_id, max_age_seconds, refresh=False):
+    """
+    Return the permission set ARNs provisioned to the management account.
+    Reuses the S3 cache when it is younger than max_age_seconds unless refresh is set.
+    """
+    if not refresh:
+        cached = load_cached_management_permission_sets(
+            s3client, bucket_name, management_account_id, max_age_seconds)
+        if cached is not None:
+            logger.info("Using cached list of %s permission sets provisioned to the management account",
+                        len(cached))
+            return cached
+    perm_set_arns = list_management_permission_sets(ic_admin, instance_arn, management_account_id)
+    try:
+        save_management_permission_sets(s3client, bucket_name, management_account_id, perm_set_arns)
+    except ClientError as error:
+        logger.warning("Cannot cache the management account permission sets: %s", error)
+    logger.info("%s permission sets are provisioned to the management account", len(perm_set_arns))
+    return perm_set_arns
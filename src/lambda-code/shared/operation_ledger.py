@@ -0,0 +1,136 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+# pylint: disable=C0301
+# pylint: disable=W1202,W0703
+# pylint: disable=E0401
+###########################################################################
+# Durable ledger of failed write operations. An operation that fails    #
+# inline is stored in DynamoDB with its full parameters and error, in   #
+# the operation vocabulary of the work queue, and the next run replays  #
+# the pending entries that still match its desired state, so the system #
+# converges without waiting for another full pass.                      #
+###########################################################################
+import json
+import time
+import logging
+from botocore.exceptions import ClientError
+from work_queue import operation_id, ALREADY_APPLIED_ERRORS, THROTTLING_ERRORS
+
+logger = logging.getLogger()
+
+# Entries that still fail after this many replays are kept for inspection but not replayed.
+MAX_REPLAY_ATTEMPTS = 10
+# Entries expire through the table TTL after two weeks.
+ENTRY_TTL_SECONDS = 14 * 24 * 3600
+# Error codes that mean the target of the operation no longer exists.
+OBSOLETE_ERRORS = {'ResourceNotFoundException'}
+
+
+def error_class(error):
+    """Error code of a ClientError, otherwise the exception class name"""
+    if isinstance(error, ClientError):
+        return error.response['Error']['Code']
+    return type(error).__name__
+
+
+class OperationLedger:
+    """Failed operations of one function, keyed by the deterministic operation id"""
+
+    def __init__(self, dynamodb_client, table_name, source):
+        self.dynamodb = dynamodb_client
+        self.table_name = table_name
+        self.source = source
+
+    def _key(self, op_id):
+        return {'source': {'S': self.source}, 'operation_id': {'S': op_id}}
+
+    def record(self, operation, params, error):
+        """Store a failed operation, counting how often it failed"""
+        now = int(time.time())
+        try:
+            self.dynamodb.update_item(
+                TableName=self.table_name,
+                Key=self._key(operation_id(operation, params)),
+                UpdateExpression='SET op = :op, params = :params, error_class = :error_class, '
+                                 'error_message = :error_message, failed_at = :now, '
+                                 'expires_at = :expires_at ADD attempts :one',
+                ExpressionAttributeValues={
+                    ':op': {'S': operation},
+                    ':params': {'S': json.dumps(params, sort_keys=True)},
+                    ':error_class': {'S': error_class(error)},
+                    ':error_message': {'S': str(error)[:1000]},
+                    ':now': {'N': str(now)},
+                    ':expires_at': {'N': str(now + ENTRY_TTL_SECONDS)},
+                    ':one': {'N': '1'}
+                }
+            )
+            logger.info("Recorded failed %s in the operation ledger", operation)
+        except ClientError as ledger_error:
+            logger.warning("Cannot record failed %s in the operation ledger: %s",
+                           operation, ledger_error)
+
+    def resolve(self, op_id):
+        """Remove an entry that has been applied or is obsolete"""
+        self.dynamodb.delete_item(TableName=self.table_name, Key=self._key(op_id))
+
+    def pending(self):
+        """Yield the stored entries as (operation id, operation, params, attempts)"""
+        params = {
+            'TableName': self.table_name,
+            'KeyConditionExpression': '#source = :source',
+            'ExpressionAttributeNames': {'#source': 'source'},
+            'ExpressionAttributeValues': {':source': {'S': self.source}}
+        }
+        while True:
+            response = self.dynamodb.query(**params)
+            for item in response['Items']:
+                yield (item['operation_id']['S'], item['op']['S'],
+                       json.loads(item['params']['S']), int(item['attempts']['N']))
+            if 'LastEvaluatedKey' not in response:
+                return
+            params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def replay(self, executors, on_applied=None, wanted=None):
+        """
+        Execute the pending entries with idempotent semantics: an operation
+        that was already applied, or whose target no longer exists, is
+        resolved too. An entry that wanted(operation, params) rejects no
+        longer matches the desired state and is resolved without being
+        applied. Stops at the first throttling error. Returns the number
+        of entries applied.
+        """
+        resolved = 0
+        stale = 0
+        for op_id, operation, params, attempts in self.pending():
+            if attempts >= MAX_REPLAY_ATTEMPTS or operation not in executors:
+                logger.error("Not replaying %s %s after %s failed attempts", operation, op_id, attempts)
+                continue
+            if wanted is not None and not wanted(operation, params):
+                logger.info("%s %s no longer matches the desired state, resolved without applying it",
+                            operation, op_id)
+                self.resolve(op_id)
+                stale += 1
+                continue
+            try:
+                response = executors[operation](**params)
+                if on_applied is not None:
+                    on_applied(operation, params, response)
+            except ClientError as error:
+                code = error_class(error)
+                if code in THROTTLING_ERRORS:
+                    logger.warning("Throttled while replaying the operation ledger, "
+                                   "the remaining entries stay pending")
+                    break
+                if (code not in ALREADY_APPLIED_ERRORS.get(operation, set()) and
+                        code not in OBSOLETE_ERRORS):
+                    self.record(operation, params, error)
+                    continue
+                logger.info("%s %s no longer needs to be applied: %s", operation, op_id, code)
+            except Exception as error:
+                self.record(operation, params, error)
+                continue
+            self.resolve(op_id)
+            resolved += 1
+        if resolved or stale:
+            logger.info("Replayed %s operations from the operation ledger, %s were stale",
+                        resolved, stale)
+        return resolved
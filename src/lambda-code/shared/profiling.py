@@ -0,0 +1,112 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+# pylint: disable=C0301
+# pylint: disable=W1202,W0703
+# pylint: disable=E0401
+###########################################################################
+# Opt-in profiling of handler invocations. When enabled, an invocation   #
+# runs under cProfile and tracemalloc; the top CPU hot spots and         #
+# allocation sites are written as a compact JSON report to S3 and the    #
+# full pstats to /tmp. When disabled, the handler is left unwrapped.     #
+###########################################################################
+import os
+import json
+import time
+import uuid
+import pstats
+import logging
+import cProfile
+import functools
+import tracemalloc
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+PROFILE_PREFIX = 'automation-state/profiles/'
+PSTATS_DIR = '/tmp'
+# Stack depth recorded per allocation; one frame keeps the tracing overhead low.
+TRACEMALLOC_FRAMES = 1
+
+
+def hotspots(profiler, top_n):
+    """Return the functions with the most own time, with their call counts and times"""
+    stats = pstats.Stats(profiler).stats
+    ranked = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:top_n]
+    return [{
+        'Function': f"{os.path.basename(filename)}:{line}({name})",
+        'Calls': calls,
+        'OwnSeconds': round(own_time, 4),
+        'CumulativeSeconds': round(cumulative_time, 4)
+    } for (filename, line, name), (_, calls, own_time, cumulative_time, _) in ranked]
+
+
+def allocation_sites(snapshot, top_n):
+    """Return the source lines holding the most memory still allocated at the snapshot"""
+    snapshot = snapshot.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+    return [{
+        'Site': f"{os.path.basename(stat.traceback[0].filename)}:{stat.traceback[0].lineno}",
+        'Bytes': stat.size,
+        'Blocks': stat.count
+    } for stat in snapshot.statistics('lineno')[:top_n]]
+
+
+def write_profile(s3client, bucket_name, function_name, invocation_id, report):
+    """Upload a profile report and return its key"""
+    key = f"{PROFILE_PREFIX}{function_name}/{time.strftime('%Y/%m/%d/%H%M%S', time.gmtime())}-{invocation_id}.json"
+    s3client.put_object(
+        Bucket=bucket_name,
+        Key=key,
+        Body=json.dumps(report, indent=1).encode('utf-8'),
+        ContentType='application/json'
+    )
+    return key
+
+
+def profiled(function_name, s3client, bucket_name, enabled, top_n=25):
+    """
+    Decorator that profiles every invocation of a handler when enabled.
+    An invocation nested in a profiled one, such as an in-process shard,
+    is part of the outer profile.
+    """
+    def decorate(handler):
+        if not enabled:
+            return handler
+
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            if tracemalloc.is_tracing():
+                return handler(event, context)
+            invocation_id = getattr(context, 'aws_request_id', None) or uuid.uuid4().hex
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            profiler = cProfile.Profile()
+            started = time.time()
+            profiler.enable()
+            try:
+                return handler(event, context)
+            finally:
+                profiler.disable()
+                duration = time.time() - started
+                snapshot = tracemalloc.take_snapshot()
+                peak_bytes = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                report_profile(profiler, snapshot, {
+                    'Function': function_name,
+                    'InvocationId': invocation_id,
+                    'DurationSeconds': round(duration, 3),
+                    'PeakTracedBytes': peak_bytes
+                })
+        return wrapper
+
+    def report_profile(profiler, snapshot, report):
+        pstats_path = os.path.join(PSTATS_DIR, f"{function_name}-{report['InvocationId']}.pstats")
+        try:
+            profiler.dump_stats(pstats_path)
+            report['Hotspots'] = hotspots(profiler, top_n)
+            report['AllocationSites'] = allocation_sites(snapshot, top_n)
+            key = write_profile(s3client, bucket_name, function_name, report['InvocationId'], report)
+            logger.info("Profiled %s in %ss, peak traced memory %s bytes: s3://%s/%s, %s",
+                        function_name, report['DurationSeconds'], report['PeakTracedBytes'],
+                        bucket_name, key, pstats_path)
+        except (ClientError, OSError) as error:
+            logger.warning("Cannot write the profile of %s: %s", function_name, error)
+
+    return decorate
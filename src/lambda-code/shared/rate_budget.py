@@ -0,0 +1,55 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+# pylint: disable=C0301
+# pylint: disable=W1202,W0703
+# pylint: disable=E0401
+#########################################################################
+# API call budget shared by every invocation that reconciles in         #
+# parallel. Each call reserves a slot in a one-second window counter   #
+# kept in DynamoDB, so N workers together stay under one global rate.   #
+#########################################################################
+import time
+import logging
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+
+class DynamoDBRateBudget:
+    """Fixed-window rate limiter backed by a DynamoDB counter per second"""
+
+    def __init__(self, dynamodb_client, table_name, budget_name, calls_per_second):
+        self.dynamodb = dynamodb_client
+        self.table_name = table_name
+        self.budget_name = budget_name
+        self.calls_per_second = int(calls_per_second)
+
+    def acquire(self):
+        """Block until a call slot is available in the current window"""
+        while True:
+            window = int(time.time())
+            try:
+                self.dynamodb.update_item(
+                    TableName=self.table_name,
+                    Key={'budget_window': {'S': f"{self.budget_name}#{window}"}},
+                    UpdateExpression='ADD call_count :one SET expires_at = :expires',
+                    ConditionExpression='attribute_not_exists(call_count) OR call_count < :limit',
+                    ExpressionAttributeValues={
+                        ':one': {'N': '1'},
+                        ':limit': {'N': str(self.calls_per_second)},
+                        ':expires': {'N': str(window + 120)}
+                    }
+                )
+                return
+            except ClientError as error:
+                if error.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    # Never stall reconciliation because the budget table is unavailable.
+                    logger.warning("Rate budget unavailable, continuing without it: %s", error)
+                    return
+            time.sleep(max(window + 1 - time.time(), 0.01))
+
+
+def attach_rate_budget(client, budget):
+    """Make every API call of a boto3 client wait for the shared budget"""
+    def _acquire(**kwargs):
+        budget.acquire()
+    client.meta.events.register('before-call', _acquire)
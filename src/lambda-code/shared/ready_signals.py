@@ -0,0 +1,99 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+# pylint: disable=C0301
+# pylint: disable=W1202,W0703
+# pylint: disable=E0401
+###########################################################################
+# Per permission set ready signals between the two Lambda functions. The #
+# permission set function signals each permission set as soon as it is   #
+# synced and provisioned, and that the sync is complete; the assignment  #
+# function creates the assignments of ready permission sets meanwhile    #
+# and marks them applied, so the final pass can skip their creates.      #
+###########################################################################
+import json
+import logging
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+READY_PREFIX = 'automation-state/ready/'
+
+
+class ReadySignals:
+    """Ready, applied and complete markers of one permission set sync run, stored in S3"""
+
+    def __init__(self, s3client, bucket_name, run_id):
+        self.s3client = s3client
+        self.bucket_name = bucket_name
+        self.prefix = f"{READY_PREFIX}{run_id}/"
+        self.ready_arns = {}
+
+    def _put(self, key, body=''):
+        self.s3client.put_object(Bucket=self.bucket_name, Key=self.prefix + key,
+                                 Body=body.encode('utf-8'))
+
+    def _names(self, kind):
+        names = []
+        paginator = self.s3client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=f"{self.prefix}{kind}/"):
+            names += [s3_object['Key'][len(self.prefix) + len(kind) + 1:]
+                      for s3_object in page.get('Contents', [])]
+        return names
+
+    def signal_ready(self, perm_set_name, perm_set_arn):
+        """Signal that a permission set is synced and provisioned"""
+        self._put(f"ready/{perm_set_name}", perm_set_arn)
+
+    def signal_complete(self):
+        """Signal that the sync of every permission set is complete"""
+        self._put('complete')
+
+    def mark_applied(self, perm_set_name):
+        """Record that the assignments of a ready permission set were created"""
+        self._put(f"applied/{perm_set_name}")
+
+    def save_plan(self, plan):
+        """Record the mapping versions and delta base the consumer creates the ready assignments from"""
+        self._put('plan', json.dumps(plan))
+
+    def plan(self):
+        """Return the recorded plan, or None if no consumer recorded one"""
+        try:
+            response = self.s3client.get_object(Bucket=self.bucket_name, Key=self.prefix + 'plan')
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return json.loads(response['Body'].read().decode('utf-8'))
+
+    def ready(self):
+        """Return the ARNs of the permission sets signalled ready so far, by name"""
+        for name in self._names('ready'):
+            if name not in self.ready_arns:
+                response = self.s3client.get_object(Bucket=self.bucket_name,
+                                                    Key=f"{self.prefix}ready/{name}")
+                self.ready_arns[name] = response['Body'].read().decode('utf-8')
+        return dict(self.ready_arns)
+
+    def applied(self):
+        """Return the names of the permission sets whose assignments were created"""
+        return set(self._names('applied'))
+
+    def is_complete(self):
+        """Return True once the permission set function signalled completion"""
+        try:
+            self.s3client.head_object(Bucket=self.bucket_name, Key=self.prefix + 'complete')
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        return True
+
+    def clear(self):
+        """Delete the plan, ready and applied markers; the complete marker stays for late consumers"""
+        keys = [f"{self.prefix}{kind}/{name}" for kind in ('ready', 'applied')
+                for name in self._names(kind)] + [self.prefix + 'plan']
+        for start in range(0, len(keys), 1000):
+            self.s3client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete={'Objects': [{'Key': key} for key in keys[start:start + 1000]],
+                        'Quiet': True})
@@ -0,0 +1,156 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+# pylint: disable=C0301
+# pylint: disable=W1202,W0703
+# pylint: disable=E0401
+##########################################################################
+# Durable work queue for IAM Identity Center write operations.          #
+# Planning code submits operations as idempotent SQS messages, and the  #
+# consumer executes them in batches, reporting partial batch failures   #
+# so SQS retries only the failed messages and finally dead-letters them.#
+##########################################################################
+import json
+import uuid
+import hashlib
+import logging
+from time import sleep
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+# Error codes that mean the operation has already taken effect.
+ALREADY_APPLIED_ERRORS = {
+    'DeleteAccountAssignment': {'ResourceNotFoundException'},
+    'DetachManagedPolicyFromPermissionSet': {'ResourceNotFoundException'},
+    'DetachCustomerManagedPolicyReferenceFromPermissionSet': {'ResourceNotFoundException'},
+}
+THROTTLING_ERRORS = {'ThrottlingException', 'TooManyRequestsException'}
+
+
+def operation_id(operation, params):
+    """Deterministic id of an operation, the same for every run that plans it"""
+    canonical = json.dumps({'Op': operation, 'Params': params}, sort_keys=True)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class OperationQueue:
+    """
+    Buffers submitted operations and sends them to SQS in batches of 10.
+    On a FIFO queue, operations of the same group are executed in order and
+    duplicates submitted within one run are dropped by SQS. The queue object
+    outlives invocations in a warm container, so start_run() must be called
+    at the start of every run.
+    """
+
+    def __init__(self, sqs_client, queue_url, source):
+        self.sqs_client = sqs_client
+        self.queue_url = queue_url
+        self.source = source
+        self.fifo = queue_url.endswith('.fifo')
+        self.run_token = str(uuid.uuid4())
+        self.buffer = []
+        self.submitted = 0
+
+    def start_run(self):
+        """
+        Begin the operations of a new run with a new deduplication token, so
+        SQS does not drop an operation an earlier run submitted within its
+        five-minute deduplication window.
+        """
+        self.run_token = str(uuid.uuid4())
+        self.submitted = 0
+
+    def run_state(self):
+        """Return the deduplication token and count of the current run"""
+        return self.run_token, self.submitted
+
+    def resume_run(self, state):
+        """Continue a run saved with run_state after another run used the queue in between"""
+        self.run_token, self.submitted = state
+
+    def submit(self, operation, params, group=None):
+        """Queue one operation; full batches are sent right away"""
+        self.buffer.append({
+            'OperationId': operation_id(operation, params),
+            'Op': operation,
+            'Params': params,
+            'Source': self.source,
+            'Group': group or self.source
+        })
+        if len(self.buffer) >= 10:
+            self.flush()
+
+    def _entry(self, index, message):
+        """Build the send_message_batch entry of one buffered operation"""
+        entry = {'Id': str(index), 'MessageBody': json.dumps(message)}
+        if self.fifo:
+            entry['MessageGroupId'] = message['Group']
+            entry['MessageDeduplicationId'] = hashlib.sha256(
+                (self.run_token + message['OperationId']).encode('utf-8')).hexdigest()
+        return entry
+
+    def flush(self):
+        """Send every buffered operation, retrying entries SQS did not accept"""
+        attempt = 0
+        while self.buffer:
+            batch = self.buffer[:10]
+            entries = [self._entry(index, message)
+                       for index, message in enumerate(batch)]
+            response = self.sqs_client.send_message_batch(
+                QueueUrl=self.queue_url, Entries=entries)
+            failed = {entry['Id'] for entry in response.get('Failed', [])}
+            self.submitted += len(batch) - len(failed)
+            self.buffer = [batch[int(index)] for index in sorted(failed, key=int)] + self.buffer[10:]
+            if failed:
+                attempt += 1
+                logger.warning("%s operations were not accepted by SQS, retrying", len(failed))
+                sleep(min(2 ** attempt * 0.1, 5))
+        return self.submitted
+
+
+def is_operation_batch(event):
+    """Return True if the event is an SQS batch of queued operations"""
+    records = event.get('Records') or []
+    if not records or records[0].get('eventSource') != 'aws:sqs':
+        return False
+    try:
+        return 'Op' in json.loads(records[0]['body'])
+    except (ValueError, KeyError):
+        return False
+
+
+def process_operation_batch(event, executors):
+    """
+    Execute a batch of queued operations.
+    Returns the partial batch response that makes SQS redeliver only the failures.
+    """
+    failures = []
+    failed_groups = set()
+    throttled = False
+    for record in event['Records']:
+        message = json.loads(record['body'])
+        operation = message['Op']
+        if throttled or message.get('Group') in failed_groups:
+            # Back off the remainder of the batch and keep the order within a
+            # group; SQS delivers these again later.
+            failures.append({'itemIdentifier': record['messageId']})
+            continue
+        try:
+            executors[operation](**message['Params'])
+            logger.info("Executed %s %s", operation, message['OperationId'])
+        except ClientError as error:
+            code = error.response['Error']['Code']
+            if code in ALREADY_APPLIED_ERRORS.get(operation, set()):
+                logger.info("%s %s was already applied", operation, message['OperationId'])
+                continue
+            if code in THROTTLING_ERRORS:
+                throttled = True
+            logger.warning("%s %s failed: %s", operation, message['OperationId'], error)
+            failures.append({'itemIdentifier': record['messageId']})
+            failed_groups.add(message.get('Group'))
+        except Exception as error:
+            logger.error("%s %s failed: %s", operation, message.get('OperationId'), error)
+            failures.append({'itemIdentifier': record['messageId']})
+            failed_groups.add(message.get('Group'))
+    logger.info("Processed %s queued operations, %s failed",
+                len(event['Records']), len(failures))
+    return {'batchItemFailures': failures}
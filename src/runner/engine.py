@@ -0,0 +1,145 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+# pylint: disable=C0301
+# pylint: disable=W1202,W0703
+# pylint: disable=E0401
+###########################################################################
+# Reconciliation engine for runs outside Lambda, such as a CodeBuild     #
+# project or a container. It loads the code of both Lambda functions     #
+# with an explicit configuration, so a standalone run takes the same     #
+# code paths as the handlers, but without the Lambda timeout: shards run #
+# in-process and the permission set sync hands over to the assignment    #
+# reconciliation directly instead of through SNS.                        #
+###########################################################################
+import os
+import sys
+import logging
+import importlib.util
+import boto3
+
+logger = logging.getLogger()
+
+LAMBDA_CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'lambda-code')
+# Module name, code directory and deployed function name of each Lambda function.
+FUNCTIONS = {
+    'auto-permissionsets': ('identity-center-auto-permissionsets', 'ic-permissionsets-enabler'),
+    'auto-assignment': ('identity-center-auto-assign', 'ic-auto-assignment-enabler')
+}
+# The functions import their own and the shared modules by name, as in the Lambda package.
+for code_dir in ['shared'] + [code_dir for code_dir, _ in FUNCTIONS.values()]:
+    if os.path.abspath(os.path.join(LAMBDA_CODE_DIR, code_dir)) not in sys.path:
+        sys.path.insert(0, os.path.abspath(os.path.join(LAMBDA_CODE_DIR, code_dir)))
+from api_cassette import default_session
+
+# Settings a standalone run always uses.
+STANDALONE_SETTINGS = {'FanOutTransport': 'local'}
+# Settings that size the worker pools of both functions.
+WORKER_SETTINGS = ('StateFetchWorkers', 'ProvisionedIndexWorkers')
+# Remaining time a standalone run reports, far beyond any Lambda timeout.
+UNLIMITED_MILLIS = 10 ** 12
+
+
+class RunnerContext:
+    """Stand-in for the Lambda context that never runs out of time"""
+
+    def __init__(self, function_name, region, account_id):
+        self.function_name = function_name
+        self.invoked_function_arn = f"arn:aws:lambda:{region}:{account_id}:function:{function_name}"
+
+    @staticmethod
+    def get_remaining_time_in_millis():
+        """A standalone run has no deadline"""
+        return UNLIMITED_MILLIS
+
+
+class JobResults:
+    """Collects the job results the functions report, in place of the CodePipeline client"""
+
+    def __init__(self):
+        self.succeeded = 0
+        self.failures = []
+
+    def put_job_success_result(self, **params):
+        """Record a successful run"""
+        self.succeeded += 1
+        logger.info("Run succeeded: %s", params.get('executionDetails', {}).get('summary', ''))
+
+    def put_job_failure_result(self, **params):
+        """Record a failed run"""
+        self.failures.append(params['failureDetails']['message'])
+        logger.error("Run failed: %s", params['failureDetails']['message'])
+
+
+def load_functions(settings):
+    """
+    Import both functions with the settings as their environment. The
+    process environment is restored afterwards, so the settings of one
+    engine do not leak into the next.
+    """
+    previous = dict(os.environ)
+    os.environ.update({name: str(value) for name, value in settings.items()})
+    try:
+        return {module_name: load_function(module_name, code_dir)
+                for module_name, (code_dir, _) in FUNCTIONS.items()}
+    finally:
+        os.environ.clear()
+        os.environ.update(previous)
+
+
+def load_function(module_name, code_dir):
+    """Import the handler module of one Lambda function from its code directory"""
+    path = os.path.join(LAMBDA_CODE_DIR, code_dir, module_name + '.py')
+    spec = importlib.util.spec_from_file_location(module_name.replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class Engine:
+    """
+    Both reconciliation functions loaded in one process. The configuration
+    uses the environment variable names of the Lambda functions and is read
+    when the functions are imported, so every engine loads its own copy of
+    them. Each run starts from a clean run state. With a cassette player,
+    every API call is answered from the recorded cassettes, whose settings
+    the configuration overrides.
+    """
+
+    def __init__(self, config, workers=None, player=None):
+        settings = dict(config, **STANDALONE_SETTINGS)
+        if player is not None:
+            settings = dict(player.settings, **settings)
+            player.install(default_session())
+            account_id = player.account_id
+        else:
+            account_id = boto3.client('sts', region_name=settings['Lambda_Region']).get_caller_identity()['Account']
+        if workers:
+            settings.update({name: workers for name in WORKER_SETTINGS})
+        self.results = JobResults()
+        self.modules = load_functions(settings)
+        self.contexts = {}
+        for module_name, (_, function_name) in FUNCTIONS.items():
+            self.modules[module_name].pipeline = self.results
+            self.contexts[module_name] = RunnerContext(function_name, settings['Lambda_Region'], account_id)
+        self.modules['auto-permissionsets'].assignment_trigger = self.trigger_assignments
+
+    def trigger_assignments(self, message):
+        """Run the assignment function with the message the permission set function hands over"""
+        self.modules['auto-assignment'].lambda_handler(
+            {'Records': [{'Sns': {'Message': message}}]}, self.contexts['auto-assignment'])
+
+    def reset_run_state(self):
+        """Clear what an earlier run of this engine left in the module globals"""
+        for module in self.modules.values():
+            module.reset_run_state()
+
+    def sync_permission_sets(self):
+        """Synchronize every permission set, then reconcile the assignments"""
+        self.reset_run_state()
+        module = self.modules['auto-permissionsets']
+        cursor = module.new_cursor('auto-permissionsets', '', module.PERMISSION_SET_PHASES[0])
+        module.run_single_flight(cursor, '', self.contexts['auto-permissionsets'])
+
+    def reconcile_assignments(self):
+        """Reconcile the assignments only"""
+        self.reset_run_state()
+        self.modules['auto-assignment'].lambda_handler({}, self.contexts['auto-assignment'])
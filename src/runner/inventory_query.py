@@ -0,0 +1,192 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+# pylint: disable=C0301
+# pylint: disable=W1202,W0703
+# pylint: disable=E0401
+###########################################################################
+# Queries over the assignment inventory the reconciliation writes.       #
+#   python src/runner/inventory_query.py --bucket BUCKET account 1234...  #
+#   python src/runner/inventory_query.py --bucket BUCKET group Admins     #
+#   python src/runner/inventory_query.py --bucket BUCKET diff \           #
+#       --against-date 2024-01-01                                         #
+# The latest run is used unless --date, --run or --files select another. #
+# Matching rows are printed as JSON Lines.                                #
+###########################################################################
+import os
+import sys
+import json
+import logging
+import argparse
+from collections import defaultdict
+import boto3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'lambda-code', 'identity-center-auto-assign'))
+
+from inventory import COLUMNS, INVENTORY_PREFIX, decode_part
+
+logger = logging.getLogger()
+
+
+class InventorySnapshot:
+    """The rows of one inventory run, with indexes built on first lookup"""
+
+    def __init__(self, bodies):
+        self.rows = set()
+        self.perm_set_names = {}
+        self.group_names = {}
+        self.run_id = None
+        self.snapshot_at = None
+        for body in bodies:
+            part, rows = decode_part(body)
+            self.rows.update(rows)
+            self.perm_set_names.update(part['PermissionSetNames'])
+            self.group_names.update(part['GroupNames'])
+            self.run_id = part['RunId']
+            self.snapshot_at = max(self.snapshot_at or part['SnapshotAt'], part['SnapshotAt'])
+        self.indexes = {}
+
+    def _lookup(self, column, value):
+        if column not in self.indexes:
+            position = COLUMNS.index(column)
+            index = defaultdict(list)
+            for row in self.rows:
+                index[row[position]].append(row)
+            self.indexes[column] = index
+        return [self.named(row) for row in sorted(self.indexes[column].get(value, []))]
+
+    def named(self, row):
+        """Return a row as a dict with the permission set and group names"""
+        named = dict(zip(COLUMNS, row))
+        named['PermissionSetName'] = self.perm_set_names.get(named['PermissionSetArn'])
+        named['GroupName'] = self.group_names.get(named['PrincipalId'])
+        return named
+
+    def by_account(self, account_id):
+        """Assignments in one account"""
+        return self._lookup('AccountId', str(account_id))
+
+    def by_group(self, group):
+        """Assignments of one group, by name or id"""
+        ids = {group_id for group_id, name in self.group_names.items() if name == group}
+        return sorted((row for group_id in ids or {group}
+                       for row in self._lookup('PrincipalId', group_id)),
+                      key=lambda row: (row['AccountId'], row['PermissionSetArn']))
+
+    def by_permission_set(self, perm_set):
+        """Assignments of one permission set, by name or ARN"""
+        arns = {arn for arn, name in self.perm_set_names.items() if name == perm_set}
+        return sorted((row for arn in arns or {perm_set}
+                       for row in self._lookup('PermissionSetArn', arn)),
+                      key=lambda row: (row['AccountId'], row['PrincipalId']))
+
+    def diff(self, other):
+        """
+        Assignments added and removed since another snapshot. An assignment
+        that only moved between the global and the target mappings is unchanged.
+        """
+        mine = {row[:-1]: row for row in self.rows}
+        theirs = {row[:-1]: row for row in other.rows}
+        return {
+            'Added': [self.named(mine[key]) for key in sorted(mine.keys() - theirs.keys())],
+            'Removed': [other.named(theirs[key]) for key in sorted(theirs.keys() - mine.keys())]
+        }
+
+
+def local_parts(paths):
+    """Read inventory parts from local files"""
+    for path in paths:
+        with open(path, 'rb') as part:
+            yield part.read()
+
+
+def _prefixes(s3client, bucket_name, prefix):
+    prefixes = []
+    paginator = s3client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/'):
+        prefixes += [common['Prefix'] for common in page.get('CommonPrefixes', [])]
+    return prefixes
+
+
+def s3_parts(s3client, bucket_name, date=None, run_id=None):
+    """
+    Read the parts of one inventory run from S3: the given run, or the
+    latest run of the given date partition, or of the latest partition.
+    """
+    if date:
+        dates = [f"{INVENTORY_PREFIX}date={date}/"]
+    else:
+        dates = sorted(_prefixes(s3client, bucket_name, INVENTORY_PREFIX))
+    for date_prefix in reversed(dates):
+        run_prefixes = [f"{date_prefix}run={run_id}/"] if run_id else _prefixes(s3client, bucket_name, date_prefix)
+        keys = {}
+        paginator = s3client.get_paginator('list_objects_v2')
+        for run_prefix in run_prefixes:
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=run_prefix):
+                for s3_object in page.get('Contents', []):
+                    keys.setdefault(run_prefix, []).append(s3_object)
+        if not keys:
+            continue
+        latest = max(keys, key=lambda prefix: max(s3_object['LastModified'] for s3_object in keys[prefix]))
+        logger.info("Reading inventory %s", latest)
+        return [s3client.get_object(Bucket=bucket_name, Key=s3_object['Key'])['Body'].read()
+                for s3_object in keys[latest]]
+    raise LookupError(f"No inventory found in s3://{bucket_name}/{INVENTORY_PREFIX}")
+
+
+def load_snapshot(s3client, bucket_name, date, run_id, files):
+    """Load a snapshot from local files or from S3"""
+    if files:
+        return InventorySnapshot(local_parts(files))
+    return InventorySnapshot(s3_parts(s3client, bucket_name, date, run_id))
+
+
+def parse_args(argv):
+    """Parse the command line"""
+    parser = argparse.ArgumentParser(description='Query the assignment inventory of the reconciliation.')
+    parser.add_argument('--bucket', help='Bucket the Lambda functions write their state to')
+    parser.add_argument('--date', help='Date partition, YYYY-MM-DD; the latest by default')
+    parser.add_argument('--run', help='Run id; the latest run of the date partition by default')
+    parser.add_argument('--files', nargs='+', metavar='PART', help='Read local inventory parts instead of S3')
+    parser.add_argument('--log-level', default='WARNING')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('account', help='Assignments in an account').add_argument('account_id')
+    commands.add_parser('group', help='Assignments of a group, by name or id').add_argument('group')
+    commands.add_parser('permission-set', help='Assignments of a permission set, by name or ARN').add_argument('permission_set')
+    diff = commands.add_parser('diff', help='Assignments added and removed since another snapshot')
+    diff.add_argument('--against-date')
+    diff.add_argument('--against-run')
+    diff.add_argument('--against-files', nargs='+', metavar='PART')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Run one query and return the process exit code"""
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(message)s')
+    s3client = None
+    if not args.files or (args.command == 'diff' and not args.against_files):
+        if not args.bucket:
+            logging.error("Either --bucket or the local inventory parts are required.")
+            return 2
+        s3client = boto3.client('s3')
+    snapshot = load_snapshot(s3client, args.bucket, args.date, args.run, args.files)
+    if args.command == 'diff':
+        other = load_snapshot(s3client, args.bucket, args.against_date, args.against_run,
+                              args.against_files)
+        for change, rows in snapshot.diff(other).items():
+            for row in rows:
+                print(json.dumps(dict(row, Change=change)))
+        return 0
+    if args.command == 'account':
+        rows = snapshot.by_account(args.account_id)
+    elif args.command == 'group':
+        rows = snapshot.by_group(args.group)
+    else:
+        rows = snapshot.by_permission_set(args.permission_set)
+    for row in rows:
+        print(json.dumps(row))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,66 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+# pylint: disable=C0301
+# pylint: disable=W1202,W0703
+# pylint: disable=E0401
+###########################################################################
+# Command line entry point of the standalone reconciliation run.         #
+#   python src/runner/reconcile.py --config runner-config.json           #
+#   python src/runner/reconcile.py --replay cassettes/*.jsonl.gz         #
+# Exits non-zero if the run reported a failure.                          #
+###########################################################################
+import sys
+import json
+import time
+import logging
+import argparse
+from engine import Engine
+from api_cassette import ApiPlayer
+
+
+def parse_args(argv):
+    """Parse the command line"""
+    parser = argparse.ArgumentParser(description='Reconcile Identity Center permission sets and assignments.')
+    parser.add_argument('--config', help='JSON object of settings named like the Lambda environment variables')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help='Setting that overrides the configuration file, may be repeated')
+    parser.add_argument('--only', choices=['all', 'assignments'], default='all',
+                        help='Reconcile the assignments only, without syncing the permission sets first')
+    parser.add_argument('--workers', type=int, help='Size of the worker pools of both functions')
+    parser.add_argument('--replay', nargs='+', metavar='CASSETTE',
+                        help='Answer every API call from recorded cassettes instead of AWS')
+    parser.add_argument('--replay-speed', type=float, default=0,
+                        help='Replay at the recorded pace divided by this factor, 0 answers at once')
+    parser.add_argument('--log-level', default='INFO')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Run the reconciliation and return the process exit code"""
+    args = parse_args(argv)
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(levelname)s %(message)s')
+    config = {}
+    if args.config:
+        with open(args.config, encoding='utf-8') as config_file:
+            config = json.load(config_file)
+    for setting in args.set:
+        name, _, value = setting.partition('=')
+        config[name] = value
+    player = ApiPlayer(args.replay, args.replay_speed) if args.replay else None
+    if 'Lambda_Region' not in config and 'Lambda_Region' not in (player.settings if player else {}):
+        logging.error("The configuration has no Lambda_Region.")
+        return 2
+    engine = Engine(config, args.workers, player)
+    started = time.time()
+    if args.only == 'assignments':
+        engine.reconcile_assignments()
+    else:
+        engine.sync_permission_sets()
+    logging.info("Reconciliation took %.1fs", time.time() - started)
+    if player is not None:
+        logging.info("Replayed %s API calls, %s calls had no recorded response, %s recorded calls were not made",
+                     player.replayed, player.misses, player.unused())
+    return 1 if engine.results.failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+import io
+import os
+import json
+import sys
+import pytest
+from botocore.exceptions import ClientError
+
+LAMBDA_CODE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                               'src', 'lambda-code')
+for code_dir in ('shared', 'identity-center-auto-assign', 'identity-center-auto-permissionsets'):
+    sys.path.insert(0, os.path.join(LAMBDA_CODE_DIR, code_dir))
+sys.path.insert(0, os.path.join(os.path.dirname(LAMBDA_CODE_DIR), 'runner'))
+# Settings of the Lambda functions loaded by the tests; no AWS call is made with them.
+FUNCTION_SETTINGS = {
+    'Lambda_Region': 'us-east-1',
+    'IC_S3_BucketName': 'bucket',
+    'FanOutTransport': 'local',
+    'ShardSize': '2'
+}
+
+from engine import load_functions  # pylint: disable=wrong-import-position
+
+
+class StubS3Client:
+    """In-memory stand-in for the object calls of an S3 client"""
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[(Bucket, Key)] = Body
+
+    def get_object(self, Bucket, Key, **kwargs):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': Key}}, 'GetObject')
+        return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.objects.pop((Bucket, Key), None)
+
+
+class StubContext:
+    """Lambda context whose remaining time is set by the test"""
+
+    def __init__(self, remaining_millis=900000):
+        self.remaining_millis = remaining_millis
+        self.function_name = 'test-function'
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_millis
+
+
+@pytest.fixture
+def s3client():
+    return StubS3Client()
+
+
+@pytest.fixture
+def context():
+    return StubContext()
+
+
+class StubLambdaClient:
+    """Collects asynchronous self-invocations instead of invoking the function"""
+
+    def __init__(self):
+        self.payloads = []
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        self.payloads.append(json.loads(Payload))
+
+
+@pytest.fixture
+def functions(s3client):
+    """Both Lambda functions, loaded by the runner engine with in-memory S3 and Lambda clients"""
+    modules = load_functions(FUNCTION_SETTINGS)
+    for module in modules.values():
+        module.s3client = s3client
+        module.lambda_client = StubLambdaClient()
+    return modules
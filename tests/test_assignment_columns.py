@@ -0,0 +1,108 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+import random
+import pytest
+import assignment_columns
+from assignment_columns import AssignmentSet, Interner, FIELD_LIMIT
+
+
+def test_contains_added_assignments_only():
+    assignments = AssignmentSet()
+    assignments.add('111111111111', 'arn:ps-1', 'group-1')
+    assignments.add(222222222222, 'arn:ps-2', 'group-2')
+    assert assignments.contains('111111111111', 'arn:ps-1', 'group-1')
+    assert assignments.contains('222222222222', 'arn:ps-2', 'group-2')
+    assert not assignments.contains('111111111111', 'arn:ps-2', 'group-1')
+    assert not assignments.contains('111111111111', 'arn:ps-1', 'unknown')
+    assert not assignments.contains('333333333333', 'arn:ps-1', 'group-1')
+
+
+def test_duplicates_are_counted_once():
+    assignments = AssignmentSet()
+    for _ in range(3):
+        assignments.add('111111111111', 'arn:ps-1', 'group-1')
+    assert len(assignments.freeze()) == 1
+
+
+def test_adding_after_a_lookup_keeps_earlier_assignments():
+    assignments = AssignmentSet()
+    assignments.add('111111111111', 'arn:ps-1', 'group-1')
+    assert assignments.contains('111111111111', 'arn:ps-1', 'group-1')
+    assignments.add('111111111111', 'arn:ps-1', 'group-0')
+    assert assignments.contains('111111111111', 'arn:ps-1', 'group-0')
+    assert assignments.contains('111111111111', 'arn:ps-1', 'group-1')
+    assert len(assignments) == 2
+
+
+def test_matches_a_set_of_tuples():
+    rng = random.Random(7)
+    expected = set()
+    assignments = AssignmentSet()
+    for _ in range(20000):
+        assignment = (str(rng.randrange(10 ** 11, 10 ** 11 + 300)), f"arn:ps-{rng.randrange(40)}",
+                      f"group-{rng.randrange(200)}")
+        expected.add(assignment)
+        assignments.add(*assignment)
+    assert len(assignments.freeze()) == len(expected)
+    assert list(assignments.keys) == sorted(set(assignments.keys))
+    for assignment in list(expected)[:2000]:
+        assert assignments.contains(*assignment)
+    for _ in range(2000):
+        probe = (str(rng.randrange(10 ** 11, 10 ** 11 + 300)), f"arn:ps-{rng.randrange(40)}",
+                 f"group-{rng.randrange(200)}")
+        assert assignments.contains(*probe) == (probe in expected)
+
+
+def test_freeze_merges_sorted_chunks(monkeypatch):
+    monkeypatch.setattr(assignment_columns, 'SORT_CHUNK_KEYS', 7)
+    rng = random.Random(11)
+    expected = set()
+    assignments = AssignmentSet()
+    for _ in range(500):
+        assignment = (str(rng.randrange(10 ** 11, 10 ** 11 + 20)), f"arn:ps-{rng.randrange(5)}",
+                      f"group-{rng.randrange(10)}")
+        expected.add(assignment)
+        assignments.add(*assignment)
+    assert len(assignments.freeze()) == len(expected)
+    assert list(assignments.keys) == sorted(set(assignments.keys))
+    assert all(assignments.contains(*assignment) for assignment in expected)
+
+
+def test_assigned_principals_merges_with_the_run_of_one_account_and_permission_set():
+    rng = random.Random(13)
+    expected = set()
+    assignments = AssignmentSet()
+    for _ in range(3000):
+        assignment = (str(rng.randrange(10 ** 11, 10 ** 11 + 30)), f"arn:ps-{rng.randrange(8)}",
+                      f"group-{rng.randrange(50)}")
+        expected.add(assignment)
+        assignments.add(*assignment)
+    for _ in range(200):
+        account_id, perm_set_arn = str(rng.randrange(10 ** 11, 10 ** 11 + 31)), f"arn:ps-{rng.randrange(9)}"
+        principal_ids = [f"group-{rng.randrange(55)}" for _ in range(rng.randrange(20))]
+        assert assignments.assigned_principals(account_id, perm_set_arn, principal_ids) == {
+            principal_id for principal_id in principal_ids
+            if (account_id, perm_set_arn, principal_id) in expected}
+
+
+def test_classify_drift_diffs_each_account_and_permission_set(functions):
+    module = functions['auto-assignment']
+    target_expected = AssignmentSet()
+    target_expected.add('111111111111', 'arn:ps-1', 'group-1')
+    target_expected.add('222222222222', 'arn:ps-1', 'group-2')
+    global_expected = {('group-9', 'arn:ps-1')}
+    current = [{'AccountId': account_id, 'PermissionSetArn': 'arn:ps-1', 'PrincipalType': 'GROUP',
+                'PrincipalId': principal_id}
+               for account_id in ('111111111111', '222222222222')
+               for principal_id in ('group-1', 'group-2', 'group-9')]
+    drift = list(module.classify_drift(iter(current), global_expected, target_expected))
+    assert [(assignment['AccountId'], assignment['PrincipalId']) for assignment in drift] == \
+        [('111111111111', 'group-2'), ('222222222222', 'group-1')]
+
+
+def test_interner_limit():
+    interner = Interner()
+    interner.ids = {str(index): index for index in range(FIELD_LIMIT)}
+    with pytest.raises(ValueError):
+        interner.intern('one too many')
+    assert interner.lookup('0') == 0
+    assert interner.lookup('missing') is None
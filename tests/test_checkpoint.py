@@ -0,0 +1,78 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+import pytest
+from checkpoint import (CHECKPOINT_PREFIX, DeadlineApproaching, deadline_reached, new_cursor,
+                        advance_cursor, save_checkpoint, load_checkpoint, delete_checkpoint,
+                        checkpoint_key)
+from fanout import aggregate_shard_results
+
+
+def test_deadline_reached_only_within_the_margin(context):
+    assert not deadline_reached(None)
+    assert not deadline_reached(context, margin_ms=1000)
+    context.remaining_millis = 999
+    assert deadline_reached(context, margin_ms=1000)
+
+
+def test_advance_cursor_records_the_progress(s3client):
+    cursor = new_cursor('auto-assignment', 'job-1', 'global')
+    advance_cursor(cursor, DeadlineApproaching('target', 7, ['pending']))
+    assert (cursor['Phase'], cursor['Position'], cursor['Pending'], cursor['Invocation']) == \
+        ('target', 7, ['pending'], 2)
+
+
+def test_checkpoint_round_trip_and_delete(s3client):
+    cursor = advance_cursor(new_cursor('auto-assignment', 'job-1', 'global'),
+                            DeadlineApproaching('enumerate', 3))
+    key = save_checkpoint(s3client, 'bucket', cursor)
+    assert key == checkpoint_key(cursor)
+    loaded = load_checkpoint(s3client, 'bucket', key)
+    assert loaded == cursor
+    delete_checkpoint(s3client, 'bucket', loaded)
+    assert load_checkpoint(s3client, 'bucket', key) is None
+
+
+def test_first_invocation_has_no_checkpoint_to_delete(s3client):
+    cursor = new_cursor('auto-assignment', '', 'global')
+    s3client.put_object(Bucket='bucket', Key=checkpoint_key(cursor), Body=b'{}')
+    delete_checkpoint(s3client, 'bucket', cursor)
+    assert ('bucket', checkpoint_key(cursor)) in s3client.objects
+
+
+def test_sharded_run_resumes_workers_from_their_checkpoints(functions, monkeypatch, context):
+    """Workers that hit the deadline continue from their checkpoint in a new invocation"""
+    module = functions['auto-assignment']
+    accounts = [{'Id': str(account_id), 'Status': 'ACTIVE'}
+                for account_id in range(100000000000, 100000000005)]
+    processed = []
+
+    def reconcile(cursor, pipeline_id, context, account_ids=None):
+        # Every invocation has time for one account.
+        position = cursor['Position']
+        processed.append(account_ids[position])
+        module.record_change('CreateAccountAssignment', AccountId=account_ids[position])
+        if position + 1 < len(account_ids):
+            raise DeadlineApproaching(cursor['Phase'], position + 1)
+
+    monkeypatch.setattr(module, 'reconcile_assignments', reconcile)
+    cursor = new_cursor('auto-assignment', '', module.ASSIGNMENT_PHASES[0])
+    context.remaining_millis = 0
+    with pytest.raises(DeadlineApproaching) as deadline:
+        module.coordinate_shards(cursor, accounts, context)
+    advance_cursor(cursor, deadline.value)
+    assert cursor['Pending']['ShardCount'] == 3
+    assert list(cursor['Pending']['Results']) == ['2']
+    invocations = 0
+    while module.lambda_client.payloads:
+        payload = module.lambda_client.payloads.pop(0)
+        assert set(payload) == {'ResumeCheckpoint', 'ShardWorker'}
+        module.lambda_handler(payload, context)
+        invocations += 1
+    assert invocations == 2
+    module.coordinate_shards(cursor, accounts, context)
+    assert sorted(processed) == [account['Id'] for account in accounts]
+    assert len(processed) == len(accounts)
+    results = {str(shard_id): module.shard_result_store.get(cursor['RunId'], shard_id)
+               for shard_id in range(3)}
+    assert aggregate_shard_results(results) == {'Shards': 3, 'Accounts': 5, 'Failed': []}
+    # Completed workers leave no checkpoint behind.
+    assert not [key for _, key in module.s3client.objects if key.startswith(CHECKPOINT_PREFIX)]
@@ -0,0 +1,45 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+import os
+from change_report import ChangeReport
+from engine import load_functions
+from conftest import FUNCTION_SETTINGS
+
+ACCOUNTS = [{'Id': str(account_id), 'Status': 'ACTIVE'}
+            for account_id in range(100000000000, 100000000005)]
+
+
+def test_settings_do_not_leak_into_the_process_environment(functions):
+    assert 'ShardSize' not in os.environ
+    assert functions['auto-assignment'].shard_size == 2
+    other = load_functions(dict(FUNCTION_SETTINGS, ShardSize='0'))
+    assert other['auto-assignment'].shard_size == 0
+    assert functions['auto-assignment'].shard_size == 2
+
+
+def test_in_process_shards_keep_the_run_state_of_the_coordinator(functions, monkeypatch, context):
+    module = functions['auto-assignment']
+    reconciled = []
+
+    def reconcile(cursor, pipeline_id, context, account_ids=None):
+        reconciled.append(account_ids)
+        for account_id in account_ids:
+            module.record_change('CreateAccountAssignment', AccountId=account_id)
+
+    monkeypatch.setattr(module, 'reconcile_assignments', reconcile)
+    cursor = module.new_cursor('auto-assignment', '', module.ASSIGNMENT_PHASES[0])
+    report = module.change_report = ChangeReport('auto-assignment', cursor['RunId'])
+    module.coordinate_shards(cursor, ACCOUNTS, context)
+    assert module.change_report is report
+    assert sorted(account_id for shard in reconciled for account_id in shard) == \
+        [account['Id'] for account in ACCOUNTS]
+    assert len(reconciled) == 3
+    assert report.counts == {'CreateAccountAssignment': 5}
+    assert module.pipeline_execution_details(cursor)['summary'].startswith('CreateAccountAssignment: 5')
+
+
+def test_a_new_run_starts_without_the_state_of_the_last_one(functions):
+    module = functions['auto-assignment']
+    module.change_report = ChangeReport('auto-assignment', 'run-1')
+    module.shadow_run = object()
+    module.reset_run_state()
+    assert module.change_report is None and module.shadow_run is None
@@ -0,0 +1,74 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+import json
+from botocore.exceptions import ClientError
+import event_coalescing
+from event_coalescing import coalesce_event, flush_window, flushed_window_id, is_window_flush
+
+
+class StubWindowTable:
+    """In-memory stand-in for the update and delete calls on the open window item"""
+
+    def __init__(self):
+        self.item = None
+
+    def update_item(self, ExpressionAttributeValues, UpdateExpression, ConditionExpression=None, **kwargs):
+        values = ExpressionAttributeValues
+        item = self.item or {}
+        if ConditionExpression and ('full_run' in item or
+                                    len(item.get('entities', {}).get('SS', [])) >= int(values[':cap']['N'])):
+            raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'UpdateItem')
+        item.setdefault('window_id', values[':window_id'])
+        item.setdefault('opened_at', values[':now'])
+        item['event_count'] = {'N': str(int(item.get('event_count', {'N': '0'})['N']) + 1)}
+        if 'full_run' in UpdateExpression:
+            item['full_run'] = {'BOOL': True}
+            item.pop('entities', None)
+        else:
+            entities = set(item.get('entities', {}).get('SS', [])) | set(values[':entities']['SS'])
+            item['entities'] = {'SS': sorted(entities)}
+        self.item = item
+        return {'Attributes': item}
+
+    def delete_item(self, ExpressionAttributeValues, **kwargs):
+        if self.item is None or self.item['window_id'] != ExpressionAttributeValues[':window_id']:
+            raise ClientError({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'DeleteItem')
+        item, self.item = self.item, None
+        return {'Attributes': item}
+
+
+class StubSqsClient:
+    """Records the messages sent to SQS"""
+
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, QueueUrl, MessageBody, DelaySeconds=0):
+        self.messages.append({'body': MessageBody, 'eventSource': 'aws:sqs', 'DelaySeconds': DelaySeconds})
+
+
+def permission_set_event(arn):
+    return {'detail-type': 'AWS API Call via CloudTrail',
+            'detail': {'eventName': 'UpdatePermissionSet',
+                       'requestParameters': {'permissionSetArn': arn}}}
+
+
+def test_opener_schedules_the_flush_instead_of_waiting():
+    table, sqs = StubWindowTable(), StubSqsClient()
+    assert coalesce_event(table, 'table', sqs, 'queue', permission_set_event('ps-1'), 30) is None
+    assert coalesce_event(table, 'table', sqs, 'queue', permission_set_event('ps-2'), 30) is None
+    assert len(sqs.messages) == 1 and sqs.messages[0]['DelaySeconds'] == 30
+    flush = {'Records': sqs.messages}
+    assert is_window_flush(flush)
+    entities = flush_window(table, 'table', flushed_window_id(flush))
+    assert 'PermissionSet:ps-1' in entities and 'PermissionSet:ps-2' in entities
+    # A second delivery of the same flush finds the window closed.
+    assert flush_window(table, 'table', flushed_window_id(flush)) is None
+
+
+def test_overflowing_window_runs_in_full(monkeypatch):
+    monkeypatch.setattr(event_coalescing, 'MAX_WINDOW_ENTITIES', 4)
+    table, sqs = StubWindowTable(), StubSqsClient()
+    for number in range(5):
+        coalesce_event(table, 'table', sqs, 'queue', permission_set_event(f"ps-{number}"), 30)
+    assert table.item['full_run'] == {'BOOL': True} and 'entities' not in table.item
+    assert flush_window(table, 'table', flushed_window_id({'Records': sqs.messages})) == []
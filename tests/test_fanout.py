@@ -0,0 +1,88 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+import pytest
+from fanout import (partition, LocalTransport, MemoryResultStore, S3ResultStore,
+                    wait_for_shards, aggregate_shard_results)
+
+
+def test_partition_splits_into_consecutive_shards():
+    assert partition(list(range(7)), 3) == [[0, 1, 2], [3, 4, 5], [6]]
+
+
+def test_partition_of_exact_multiple_and_empty_list():
+    assert partition(list(range(4)), 2) == [[0, 1], [2, 3]]
+    assert partition([], 5) == []
+
+
+def test_partition_covers_every_item_once():
+    items = [str(account) for account in range(1000, 1103)]
+    shards = partition(items, 10)
+    assert len(shards) == 11
+    assert [item for shard in shards for item in shard] == items
+
+
+def run_shards(store, run_id, shards, failing=()):
+    def worker(payload):
+        status = 'FAILED' if payload['ShardId'] in failing else 'SUCCEEDED'
+        result = {'Accounts': len(payload['AccountIds']), 'Status': status}
+        if status == 'FAILED':
+            result['Error'] = 'boom'
+        store.put(payload['RunId'], payload['ShardId'], result)
+
+    transport = LocalTransport(worker)
+    for shard_id, account_ids in enumerate(shards):
+        transport.dispatch({'RunId': run_id, 'ShardId': shard_id, 'AccountIds': account_ids})
+
+
+def test_local_transport_shards_are_collected_and_aggregated():
+    store = MemoryResultStore()
+    shards = partition([str(account) for account in range(25)], 10)
+    run_shards(store, 'run-1', shards)
+    results = wait_for_shards(store, 'run-1', len(shards), poll_seconds=0)
+    assert sorted(results) == ['0', '1', '2']
+    assert aggregate_shard_results(results) == {'Shards': 3, 'Accounts': 25, 'Failed': []}
+
+
+def test_aggregate_reports_failed_shards_in_shard_order():
+    store = MemoryResultStore()
+    shards = partition([str(account) for account in range(30)], 3)
+    run_shards(store, 'run-1', shards, failing={9, 2})
+    summary = aggregate_shard_results(wait_for_shards(store, 'run-1', len(shards), poll_seconds=0))
+    assert summary['Shards'] == 10
+    assert summary['Accounts'] == 30
+    assert summary['Failed'] == [{'ShardId': '2', 'Error': 'boom'}, {'ShardId': '9', 'Error': 'boom'}]
+
+
+def test_wait_for_shards_stops_with_partial_results_and_resumes_from_them():
+    store = MemoryResultStore()
+    store.put('run-1', 0, {'Accounts': 1, 'Status': 'SUCCEEDED'})
+    partial = wait_for_shards(store, 'run-1', 2, should_stop=lambda: True, poll_seconds=0)
+    assert partial == {'0': {'Accounts': 1, 'Status': 'SUCCEEDED'}}
+    store.put('run-1', 1, {'Accounts': 2, 'Status': 'SUCCEEDED'})
+    assert store.results.pop(('run-1', 0))
+    # Results collected by an earlier invocation are carried over, not read again.
+    results = wait_for_shards(store, 'run-1', 2, collected=partial, poll_seconds=0)
+    assert aggregate_shard_results(results)['Accounts'] == 3
+
+
+def test_results_of_other_runs_are_ignored():
+    store = MemoryResultStore()
+    store.put('run-0', 0, {'Accounts': 5, 'Status': 'SUCCEEDED'})
+    assert wait_for_shards(store, 'run-1', 1, should_stop=lambda: True, poll_seconds=0) == {}
+
+
+def test_s3_result_store_round_trip(s3client):
+    store = S3ResultStore(s3client, 'bucket')
+    assert store.get('run-1', 0) is None
+    store.put('run-1', 0, {'Accounts': 4, 'Status': 'SUCCEEDED'})
+    assert store.get('run-1', 0) == {'Accounts': 4, 'Status': 'SUCCEEDED'}
+    assert ('bucket', 'automation-state/shards/run-1/0.json') in s3client.objects
+
+
+def test_local_transport_passes_a_json_copy_of_the_payload():
+    received = []
+    payload = {'AccountIds': ['1'], 'Nested': {'Key': 'Value'}}
+    LocalTransport(received.append).dispatch(payload)
+    assert received == [payload]
+    assert received[0] is not payload
+    with pytest.raises(TypeError):
+        LocalTransport(received.append).dispatch({'NotJson': object()})
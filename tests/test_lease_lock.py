@@ -0,0 +1,166 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+import time
+import pytest
+from botocore.exceptions import ClientError
+import lease_lock
+from lease_lock import LeaseLock, LeaseLost, serve_rerun, report_waiting_jobs
+
+
+def condition_failed(operation):
+    return ClientError({'Error': {'Code': 'ConditionalCheckFailedException', 'Message': ''}}, operation)
+
+
+class StubLockTable:
+    """In-memory lock table evaluating the update and delete calls LeaseLock makes"""
+
+    def __init__(self):
+        self.items = {}
+        self.renewals = 0
+
+    def _holds(self, item, values):
+        return (item is not None and item['lock_owner'] == values[':owner']['S'] and
+                item['fencing_token'] == values[':token']['N'])
+
+    def update_item(self, TableName, Key, UpdateExpression, ExpressionAttributeValues,
+                    ConditionExpression=None, ReturnValues=None):
+        name = Key['lock_name']['S']
+        item = self.items.get(name)
+        values = ExpressionAttributeValues
+        if UpdateExpression.startswith('SET lock_owner'):
+            now = int(values[':now']['N'])
+            if item is not None and item['expires_at'] >= now and item['lock_owner'] != values[':owner']['S']:
+                raise condition_failed('UpdateItem')
+            item = self.items.setdefault(name, {'fencing_token': '0'})
+            item.update(lock_owner=values[':owner']['S'], expires_at=int(values[':expires']['N']),
+                        fencing_token=str(int(item['fencing_token']) + 1))
+            return {'Attributes': {'fencing_token': {'N': item['fencing_token']}}}
+        if UpdateExpression.startswith('SET rerun_requested'):
+            if item is None or 'lock_owner' not in item or item['expires_at'] < int(values[':now']['N']):
+                raise condition_failed('UpdateItem')
+            item['rerun_requested'] = True
+            if ':pipeline_ids' in values:
+                item.setdefault('rerun_pipeline_ids', []).extend(
+                    value['S'] for value in values[':pipeline_ids']['L'])
+            return {}
+        if not self._holds(item, values):
+            raise condition_failed('UpdateItem')
+        if UpdateExpression.startswith('SET expires_at'):
+            self.renewals += 1
+            item['expires_at'] = int(values[':expires']['N'])
+            return {}
+        old = dict(item)
+        item.pop('rerun_requested', None)
+        ids = item.pop('rerun_pipeline_ids', [])
+        return {'Attributes': {'rerun_pipeline_ids': {'L': [{'S': value} for value in ids]}}
+                if 'rerun_requested' in old else {}}
+
+    def delete_item(self, TableName, Key, ConditionExpression, ExpressionAttributeValues):
+        item = self.items.get(Key['lock_name']['S'])
+        if not self._holds(item, ExpressionAttributeValues) or 'rerun_requested' in item:
+            raise condition_failed('DeleteItem')
+        del self.items[Key['lock_name']['S']]
+
+
+def new_lock(table, owner, **kwargs):
+    return LeaseLock(table, 'table', 'auto-assignment', owner, **kwargs)
+
+
+def test_lock_is_exclusive_until_released():
+    table = StubLockTable()
+    first, second = new_lock(table, 'run-1'), new_lock(table, 'run-2')
+    assert first.acquire()
+    assert not second.acquire()
+    assert first.release() is None
+    assert second.acquire()
+    second.release()
+
+
+def test_expired_lease_is_taken_over_and_the_stale_holder_is_fenced_off(monkeypatch):
+    table = StubLockTable()
+    stale, current = new_lock(table, 'run-1'), new_lock(table, 'run-2')
+    assert stale.acquire()
+    stale.suspend(0)
+    clock = time.time() + 5
+    monkeypatch.setattr(lease_lock.time, 'time', lambda: clock)
+    assert current.acquire()
+    assert (stale.fencing_token, current.fencing_token) == ('1', '2')
+    # The heartbeat of the stale holder is rejected by the fencing token.
+    stale._renew(stale.lease_seconds)
+    assert stale.lost
+    with pytest.raises(LeaseLost):
+        stale.check()
+    assert stale.release() is None
+    assert table.items['auto-assignment']['lock_owner'] == 'run-2'
+    current.release()
+
+
+def test_heartbeat_extends_the_lease_until_release():
+    table = StubLockTable()
+    lock = new_lock(table, 'run-1', heartbeat_seconds=0.01)
+    assert lock.acquire()
+    deadline = time.time() + 5
+    while table.renewals < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    assert table.renewals >= 2
+    assert lock.release() is None
+    renewals = table.renewals
+    time.sleep(0.05)
+    assert table.renewals == renewals and not table.items
+
+
+def test_suspended_lock_stays_held_for_the_continuation():
+    table = StubLockTable()
+    lock = new_lock(table, 'run-1')
+    assert lock.acquire()
+    lock.suspend(900)
+    assert table.items['auto-assignment']['expires_at'] >= time.time() + 899
+    assert not new_lock(table, 'run-2').acquire()
+    # The continuation invocation runs under the same owner and takes the lock back.
+    continuation = new_lock(table, 'run-1')
+    assert continuation.acquire()
+    continuation.release()
+
+
+def test_release_serves_every_rerun_request():
+    table = StubLockTable()
+    holder = new_lock(table, 'run-1')
+    assert holder.acquire()
+    assert not new_lock(table, 'run-2').acquire_or_request_rerun('job-2')
+    assert not new_lock(table, 'run-3').acquire_or_request_rerun('job-3')
+    assert holder.release() == {'PipelineIds': ['job-2', 'job-3']}
+    # The lock is kept for the rerun pass and released after it.
+    assert holder.release() is None
+    assert not table.items
+
+
+class StubPipelineClient:
+    """Records the job results reported to CodePipeline"""
+
+    def __init__(self):
+        self.results = []
+
+    def put_job_success_result(self, jobId, **kwargs):
+        self.results.append((jobId, 'Succeeded'))
+
+    def put_job_failure_result(self, jobId, failureDetails, **kwargs):
+        self.results.append((jobId, failureDetails['message']))
+
+
+def test_rerun_reports_to_every_waiting_job():
+    cursor = {}
+    assert serve_rerun({'PipelineIds': ['job-1', 'job-2', 'job-3']}, cursor) == 'job-1'
+    pipeline = StubPipelineClient()
+    report_waiting_jobs(pipeline, cursor)
+    assert pipeline.results == [('job-2', 'Succeeded'), ('job-3', 'Succeeded')]
+    # Each waiting job receives one result only.
+    report_waiting_jobs(pipeline, cursor, 'failed')
+    assert len(pipeline.results) == 2
+
+
+def test_rerun_failure_reaches_waiting_jobs():
+    cursor = {}
+    assert serve_rerun({'PipelineIds': []}, cursor) == ''
+    cursor['WaitingPipelineIds'] = ['job-2']
+    pipeline = StubPipelineClient()
+    report_waiting_jobs(pipeline, cursor, 'Access denied')
+    assert pipeline.results == [('job-2', 'Access denied')]
@@ -0,0 +1,67 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+import time
+from checkpoint import new_cursor
+from mapping_delta import GLOBAL_TARGET, mapping_entries, diff_entries, changed_permission_sets
+
+GLOBAL_MAPPINGS = [
+    {'GlobalGroupName': 'Admins', 'PermissionSetName': ['Admin', 'Billing'], 'TargetAccountid': 'Global'},
+    {'GlobalGroupName': 'Ignored', 'PermissionSetName': ['Admin'], 'TargetAccountid': '111111111111'}
+]
+TARGET_MAPPINGS = [
+    {'TargetGroupName': 'Devs', 'PermissionSetName': ['Dev'], 'TargetAccountid': ['111111111111', 222222222222]}
+]
+
+
+def test_mapping_entries_flattens_both_files():
+    assert mapping_entries(GLOBAL_MAPPINGS, TARGET_MAPPINGS) == {
+        ('Admins', 'Admin', GLOBAL_TARGET),
+        ('Admins', 'Billing', GLOBAL_TARGET),
+        ('Devs', 'Dev', '111111111111'),
+        ('Devs', 'Dev', '222222222222')
+    }
+
+
+def test_diff_entries_returns_sorted_additions_and_removals():
+    previous = {('Devs', 'Dev', '111111111111'), ('Admins', 'Admin', GLOBAL_TARGET),
+                ('Ops', 'Read', '333333333333')}
+    current = {('Devs', 'Dev', '111111111111'), ('Admins', 'Admin', GLOBAL_TARGET),
+               ('Devs', 'Dev', '222222222222'), ('Auditors', 'Read', GLOBAL_TARGET)}
+    added, removed = diff_entries(previous, current)
+    assert added == [('Auditors', 'Read', GLOBAL_TARGET), ('Devs', 'Dev', '222222222222')]
+    assert removed == [('Ops', 'Read', '333333333333')]
+
+
+def test_diff_entries_of_unchanged_mappings_is_empty():
+    entries = mapping_entries(GLOBAL_MAPPINGS, TARGET_MAPPINGS)
+    assert diff_entries(entries, set(entries)) == ([], [])
+
+
+def test_moving_an_account_between_mappings_is_one_removal_and_one_addition():
+    moved = [dict(TARGET_MAPPINGS[0], TargetAccountid=['111111111111', '333333333333'])]
+    added, removed = diff_entries(mapping_entries(GLOBAL_MAPPINGS, TARGET_MAPPINGS),
+                                  mapping_entries(GLOBAL_MAPPINGS, moved))
+    assert added == [('Devs', 'Dev', '333333333333')]
+    assert removed == [('Devs', 'Dev', '222222222222')]
+
+
+def test_changed_permission_sets_finds_recreated_and_new_ones():
+    applied = {'PermissionSets': {'Admin': 'arn:ps-1', 'Dev': 'arn:ps-2'}}
+    current = {'Admin': {'Arn': 'arn:ps-1'}, 'Dev': {'Arn': 'arn:ps-9'}, 'Read': {'Arn': 'arn:ps-3'}}
+    assert changed_permission_sets(applied, current) == ['Dev', 'Read']
+    assert changed_permission_sets(applied, {'Admin': {'Arn': 'arn:ps-1'}}) == []
+
+
+def test_record_without_arns_treats_every_permission_set_as_changed():
+    assert changed_permission_sets({}, {'Admin': {'Arn': 'arn:ps-1'}}) == ['Admin']
+
+
+def test_rerun_pass_does_not_apply_the_mapping_delta(functions, monkeypatch):
+    module = functions['auto-assignment']
+    versions = {'global-mapping.json': 'v1', 'target-mapping.json': 'v1'}
+    applied = {'Versions': versions, 'FullRunAt': time.time()}
+    monkeypatch.setattr(module, 'load_applied_versions', lambda client, bucket: applied)
+    cursor = new_cursor('auto-assignment', 'job-1', module.ASSIGNMENT_PHASES[0])
+    cursor['MappingVersions'] = versions
+    assert module.mapping_delta_base(cursor, None) is applied
+    cursor['Rerun'] = True
+    assert module.mapping_delta_base(cursor, None) is None
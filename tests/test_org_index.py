@@ -0,0 +1,38 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+import pytest
+from org_index import TargetResolver, UnresolvedSelector, expand_target_mappings
+
+INDEX = {
+    'Roots': ['r-1'],
+    'Children': {'r-1': ['ou-a'], 'ou-a': ['ou-b'], 'ou-b': []},
+    'Accounts': {'r-1': ['111111111111'], 'ou-a': ['222222222222'], 'ou-b': ['333333333333']},
+    'Tags': {'111111111111': {}, '222222222222': {'Env': 'prod'}, '333333333333': {'Env': 'dev'}}
+}
+ACCOUNTS = [{'Id': account_id, 'Status': 'ACTIVE'}
+            for account_id in ('111111111111', '222222222222', '333333333333')]
+
+
+def test_selectors_expand_to_eligible_accounts():
+    mappings = [{'TargetGroupName': 'Devs', 'PermissionSetName': ['Dev'], 'TargetAccountid': [],
+                 'TargetOrganizationalUnitIds': ['ou-a'], 'TargetAccountTags': [{'Key': 'Env', 'Value': 'dev'}]}]
+    accounts = ACCOUNTS[:2] + [dict(ACCOUNTS[2], Status='SUSPENDED')]
+    assert expand_target_mappings(mappings, INDEX, accounts) == [
+        {'TargetGroupName': 'Devs', 'PermissionSetName': ['Dev'], 'TargetAccountid': ['222222222222']}]
+
+
+def test_unknown_organizational_unit_fails():
+    with pytest.raises(UnresolvedSelector):
+        TargetResolver(INDEX, ['111111111111']).ou_accounts('ou-typo')
+
+
+def test_tag_selector_without_matches_fails_only_with_a_cached_index():
+    assert TargetResolver(INDEX, ['111111111111']).tag_accounts({'Key': 'Env'}) == set()
+    with pytest.raises(UnresolvedSelector):
+        TargetResolver(dict(INDEX, FromCache=True), ['111111111111']).tag_accounts({'Key': 'Env'})
+    assert TargetResolver(dict(INDEX, FromCache=True), ['222222222222']).tag_accounts(
+        {'Key': 'Env', 'Value': 'prod'}) == {'222222222222'}
+
+
+def test_index_without_tags_fails():
+    with pytest.raises(UnresolvedSelector):
+        TargetResolver(dict(INDEX, Tags=None), ['111111111111']).tag_accounts({'Key': 'Env'})
@@ -0,0 +1,60 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+import json
+from permission_set_state import (PermissionSetState, canonical_policy, canonical_duration,
+                                  inline_policy_differs, settings_differ, diff_tags)
+
+POLICY = {
+    'Version': '2012-10-17',
+    'Statement': {'Effect': 'Allow', 'Action': 's3:GetObject', 'Resource': '*'}
+}
+
+
+def state(**facets):
+    defaults = {'arn': 'arn:ps-1', 'name': 'Admin', 'description': '', 'session_duration': 'PT1H',
+                'managed_policies': (), 'customer_policies': (), 'inline_policy': '', 'tags': ()}
+    return PermissionSetState(**dict(defaults, **facets))
+
+
+def test_canonical_policy_ignores_key_order_and_whitespace():
+    reordered = '{ "Statement": [ {"Resource": "*", "Action": "s3:GetObject", "Effect": "Allow"} ],\n "Version": "2012-10-17" }'
+    assert canonical_policy(POLICY) == canonical_policy(reordered)
+
+
+def test_canonical_policy_of_single_statement_equals_statement_list():
+    listed = dict(POLICY, Statement=[POLICY['Statement']])
+    assert canonical_policy(json.dumps(POLICY)) == canonical_policy(listed)
+
+
+def test_canonical_policy_keeps_real_differences():
+    changed = dict(POLICY, Statement=dict(POLICY['Statement'], Action='s3:PutObject'))
+    assert canonical_policy(POLICY) != canonical_policy(changed)
+
+
+def test_empty_policies_are_equal():
+    assert canonical_policy('') == canonical_policy(None) == canonical_policy({}) == ''
+    assert not inline_policy_differs('', state(inline_policy=''))
+    assert inline_policy_differs(POLICY, state(inline_policy=''))
+    assert not inline_policy_differs(POLICY, state(inline_policy=json.dumps(POLICY, indent=2)))
+
+
+def test_canonical_duration_and_settings():
+    assert canonical_duration('PT1H') == canonical_duration('PT60M') == 3600
+    assert canonical_duration('PT1H30M') == 5400
+    assert not settings_differ('', 'PT60M', state(description=None))
+    assert settings_differ('Admins', 'PT1H', state())
+    assert settings_differ('', 'PT2H', state())
+
+
+def test_diff_tags_returns_changed_tags_and_removed_keys():
+    current = state(tags=(('Owner', 'ops'), ('Stale', 'yes'), ('Team', 'platform')))
+    local = [{'Key': 'Team', 'Value': 'platform'}, {'Key': 'Owner', 'Value': 'security'},
+             {'Key': 'CostCenter', 'Value': '42'}]
+    changed, removed = diff_tags(local, current)
+    assert changed == [{'Key': 'CostCenter', 'Value': '42'}, {'Key': 'Owner', 'Value': 'security'}]
+    assert removed == ['Stale']
+
+
+def test_diff_tags_of_equal_tags_in_other_order_is_empty():
+    current = state(tags=(('A', '1'), ('B', '2')))
+    assert diff_tags([{'Key': 'B', 'Value': '2'}, {'Key': 'A', 'Value': '1'}], current) == ([], [])
+    assert diff_tags([], state()) == ([], [])
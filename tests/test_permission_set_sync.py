@@ -0,0 +1,56 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+
+
+class StubProvisioningClient:
+    """Answers the provisioning status calls of the permission set function"""
+
+    def __init__(self, outdated):
+        self.outdated = outdated
+        self.listed = []
+
+    def list_accounts_for_provisioned_permission_set(self, **params):
+        self.listed.append(params)
+        return {'AccountIds': self.outdated.get(params['PermissionSetArn'], [])}
+
+    def list_permission_set_provisioning_status(self, **params):
+        return {'PermissionSetsProvisioningStatus': []}
+
+
+def test_outdated_sets_are_reprovisioned_with_one_status_call(functions, monkeypatch):
+    module = functions['auto-permissionsets']
+    client = StubProvisioningClient({'arn:ps-outdated': ['111111111111']})
+    provisioned = []
+    monkeypatch.setattr(module, 'ic_admin', client)
+    monkeypatch.setattr(module, 'sleep', lambda seconds: None)
+    monkeypatch.setitem(module.OPERATION_EXECUTORS, 'ProvisionPermissionSet',
+                        lambda **params: provisioned.append(params['PermissionSetArn']) or {})
+    # Neither set was changed by this run; one was left outdated by an earlier one.
+    module.reprovision_permission_sets('outdated', 'arn:ps-outdated', '')
+    module.reprovision_permission_sets('current', 'arn:ps-current', '')
+    assert provisioned == ['arn:ps-outdated']
+    assert [params['ProvisioningStatus'] for params in client.listed] == \
+        ['LATEST_PERMISSION_SET_NOT_PROVISIONED'] * 2
+
+
+class ConflictingClient:
+    """Fails every permission set creation with a ConflictException"""
+
+    def __init__(self, exceptions):
+        self.exceptions = exceptions
+
+    def create_permission_set(self, **params):
+        raise self.exceptions.ConflictException(
+            {'Error': {'Code': 'ConflictException', 'Message': 'in progress'}}, 'CreatePermissionSet')
+
+
+def test_definition_sync_falls_back_to_a_full_sync_when_a_set_cannot_be_created(functions, monkeypatch, context):
+    module = functions['auto-permissionsets']
+    monkeypatch.setattr(module, 'ic_admin', ConflictingClient(module.ic_admin.exceptions))
+    monkeypatch.setattr(module, 'sleep', lambda seconds: None)
+    # The manifest predates the permission set, which another run is creating.
+    monkeypatch.setattr(module, 'read_manifest', lambda *args: {'PermissionSets': {}, 'Accounts': []})
+    monkeypatch.setattr(module, 'read_definition', lambda *args: {
+        'Name': 'admin', 'Description': 'admin', 'Tags': [], 'ManagedPolicies': [], 'InlinePolicies': []})
+    monkeypatch.setattr(module, 'previous_definition', lambda *args: None)
+    cursor = module.new_cursor('auto-permissionsets', '', module.PERMISSION_SET_PHASES[0])
+    assert module.sync_definitions_and_hand_over(cursor, ['permission-sets/admin.json'], context) is None
@@ -0,0 +1,50 @@
+"""Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved"""
+import time
+from checkpoint import SAFETY_MARGIN_MS, new_cursor
+from ready_signals import ReadySignals
+
+MAPPINGS = {
+    'v1': ([{'GlobalGroupName': 'Admins', 'PermissionSetName': ['Admin'], 'TargetAccountid': 'Global'}], []),
+    'v2': ([{'GlobalGroupName': 'Admins', 'PermissionSetName': ['Admin', 'Billing'], 'TargetAccountid': 'Global'}],
+           [])
+}
+
+
+def test_plan_round_trip(s3client):
+    signals = ReadySignals(s3client, 'bucket', 'run-1')
+    assert signals.plan() is None
+    signals.save_plan({'MappingVersions': {'global-mapping.json': 'v1'}, 'DeltaBase': None})
+    assert signals.plan() == {'MappingVersions': {'global-mapping.json': 'v1'}, 'DeltaBase': None}
+
+
+def test_consumer_continuations_create_from_the_recorded_plan(functions, monkeypatch):
+    module = functions['auto-assignment']
+    versions = iter(['v2', 'v3'])
+    bases = []
+
+    def delta_base(cursor, account_ids):
+        bases.append(cursor['MappingVersions'])
+        return {'Versions': {'global': 'v1'}, 'FullRunAt': time.time()}
+
+    monkeypatch.setattr(module, 'current_versions', lambda client, bucket, names: {'global': next(versions)})
+    monkeypatch.setattr(module, 'mapping_delta_base', delta_base)
+    monkeypatch.setattr(module, 'read_mapping_versions',
+                        lambda cursor, mapping_versions, acct_list: MAPPINGS[mapping_versions['global']])
+    signals = ReadySignals(module.s3client, 'bucket', 'run-1')
+    entries = [module.ready_create_entries(new_cursor('auto-assignment-ready', 'job-1', 'global'), [], signals)
+               for _ in range(2)]
+    assert entries[0] == entries[1] == {('Admins', 'Billing', module.GLOBAL_TARGET)}
+    assert bases == [{'global': 'v2'}]
+    assert signals.plan()['MappingVersions'] == {'global': 'v2'}
+
+
+def test_ready_poll_wait_is_bounded_by_the_deadline_and_the_wait_limit(functions, context):
+    module = functions['auto-assignment']
+    message = {'Since': time.time()}
+    assert module.ready_poll_wait(4, message, context) == 4
+    context.remaining_millis = SAFETY_MARGIN_MS + 2000
+    assert module.ready_poll_wait(30, message, context) == 2
+    context.remaining_millis = 0
+    assert module.ready_poll_wait(30, message, context) == 0
+    message['Since'] = time.time() - module.ready_wait_seconds
+    assert module.ready_poll_wait(30, message, None) <= 0.1